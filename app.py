@@ -1,13 +1,28 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime
-import json
 import os
+import uuid
+
+from engine import (
+    SUMMARY_COLUMNS, ExportFormatError, format_malformed_slots,
+    format_unmatched_groups, load_config, subject_issues_frame, warning_ids,
+)
+import email_templates
+import firestore_usage
+import history_store
+import local_store
+import outbox
+import profiling
+from incremental import SnapshotStore
+from parsed_cache import ParsedExportCache
+from upload_cache import ResultCache, analyze_uploads
 
 # Fix for Streamlit Cloud gRPC hang
 os.environ["GRPC_DNS_RESOLVER"] = "native"
 
-CONFIG_FILE = 'modules_config.json'
+# PROFILE=1 turns the timing panel on by default for every session
+PROFILING_DEFAULT = os.environ.get("PROFILE", "") not in ("", "0")
 
 # --- Authentication ---
 def check_password():
@@ -48,26 +63,92 @@ if not check_password():
     st.stop()
 # ----------------------
 
-def load_config():
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config_data, f, indent=4)
-
-def calculate_duration(time_range_srt):
+def secrets_section(name):
+    """
+    st.secrets[name] as a plain dict, or None if missing. Without a secrets file
+    st.secrets is not touched: every read would show a "No secrets found" error.
+    """
+    if not any(os.path.exists(path) for path in st.get_option("secrets.files")):
+        return None
     try:
-        if not isinstance(time_range_srt, str):
-            return 0
-        start_str, end_str = time_range_srt.split('-')
-        fmt = '%H:%M'
-        t_start = datetime.strptime(start_str.strip(), fmt)
-        t_end = datetime.strptime(end_str.strip(), fmt)
-        return (t_end - t_start).total_seconds() / 3600
+        if name in st.secrets:
+            return dict(st.secrets[name])
     except Exception:
-        return 0
+        pass
+    return None
+
+@st.cache_resource
+def get_result_cache():
+    """Processed uploads shared by all sessions of this server process."""
+    return ResultCache()
+
+@st.cache_resource
+def get_snapshot_store():
+    """Snapshot of the last processed export of each set of groups, to diff the next upload against."""
+    return SnapshotStore()
+
+@st.cache_resource
+def get_parse_cache():
+    """Parsed workbooks on disk, so re-uploading the same file skips the Excel parse."""
+    return ParsedExportCache()
+
+@st.cache_resource
+def get_usage_meter():
+    """Firestore reads and writes of this server process, per day, session and page."""
+    return firestore_usage.UsageMeter()
+
+@st.cache_resource
+def usage_budget(settings):
+    """UsageBudget for a settings dict, built once per distinct settings (None: the defaults)."""
+    if settings:
+        try:
+            return firestore_usage.UsageBudget.from_settings(settings)
+        except (TypeError, ValueError):
+            pass # Invalid limits, use the defaults
+    return firestore_usage.UsageBudget()
+
+def get_usage_budget():
+    """Firestore budget from st.secrets["firestore_budget"], or the defaults (environment variables)."""
+    return usage_budget(secrets_section("firestore_budget"))
+
+USAGE_COLUMNS = {"reads": "Lectures", "writes": "Escriptures", "bytes_read": "Bytes llegits", "bytes_written": "Bytes escrits"}
+
+def show_firestore_usage(meter, budget, session):
+    """Today's Firestore totals against the daily budget, this session's usage by page and the last days."""
+    today = meter.day()
+    for key, limit, label in [("reads", budget.daily_reads, "Lectures"), ("writes", budget.daily_writes, "Escriptures")]:
+        if limit:
+            st.progress(min(1.0, today[key] / limit), text=f"{label} d'avui: {today[key]} de {limit}")
+        else:
+            st.caption(f"{label} d'avui: {today[key]}")
+    pages = meter.pages(session)
+    if pages:
+        st.markdown("**Aquesta sessió**")
+        pages_df = pd.DataFrame.from_dict(pages, orient="index").rename(columns=USAGE_COLUMNS)
+        st.dataframe(pages_df.rename_axis("Pàgina"), use_container_width=True)
+    history = meter.history()
+    if history:
+        st.markdown("**Últims dies**")
+        days_df = pd.DataFrame([{"Dia": day, **counts} for day, counts in history]).rename(columns=USAGE_COLUMNS)
+        st.dataframe(days_df, use_container_width=True, hide_index=True)
+    st.caption("Bytes aproximats. Inclou la sincronització en segon pla de tot el servidor.")
+
+def show_profile(runs):
+    """Stages of the last measured run and the totals of the previous ones."""
+    if not runs:
+        st.caption("Encara no hi ha cap execució mesurada.")
+        return
+    last = runs[-1]
+    st.markdown(f"**Última execució ({last['page']}):** {last['total_seconds']:.2f} s, memòria màxima {last['peak_rss_mb']} MB")
+    if last["stages"]:
+        stages_df = pd.DataFrame(last["stages"]).rename(columns={
+            "name": "Etapa", "seconds": "Segons", "rows": "Files", "peak_rss_mb": "Memòria (MB)",
+        })
+        st.dataframe(stages_df, use_container_width=True, hide_index=True)
+    for key, value in last["counters"].items():
+        st.caption(f"{key}: {value}")
+    if len(runs) > 1:
+        st.caption("Anteriors: " + ", ".join(f"{r['total_seconds']:.2f} s" for r in reversed(runs[:-1])))
 
 def highlight_rows(row):
     color = 'background-color: transparent'
@@ -113,1159 +194,706 @@ with st.sidebar:
     st.divider()
     st.header("ℹ️ Instruccions")
     st.markdown("""
-    1. **Gestió**: Puja l'Excel per veure nous avisos.
+    1. **Gestió**: Puja l'Excel (o diversos) per veure nous avisos.
     2. **Historial**: Consulta avisos ja enviats.
     3. **Config**: Revisa les hores per cicle.
     """)
 
+    # Per-run timings, filled in at the end of the script
+    with st.expander("⏱️ Rendiment", expanded=False):
+        st.toggle("Mesurar cada execució", value=PROFILING_DEFAULT, key="profiling",
+                  help=f"Temps per etapa, files, memòria i lectures/escriptures de Firebase. També es desa a {profiling.PROFILE_LOG_FILE}.")
+        profile_panel = st.container()
+
+    # Firestore reads/writes (counted by firestore_usage.CountingClient), filled in at the end of the script
+    with st.expander("🔥 Ús de Firebase", expanded=False):
+        usage_panel = st.container()
+
+# Stages marked with profiling.stage() (here, in the engine and in the caches) go to this run's profile
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex[:8]
+profile = profiling.RunProfile(page, session=st.session_state["session_id"], enabled=st.session_state["profiling"]).activate()
+# Firestore calls of this run are counted for this session and page
+firestore_usage.set_scope(st.session_state["session_id"], page)
+
 # --- Main Area ---
 
 # HELPER: History Logic (MIGRATED TO FIRESTORE)
 # HISTORY_FILE = 'warnings_history.json' # LEGACY
 
-import firebase_admin
-from firebase_admin import credentials, firestore
+@st.cache_resource(show_spinner=False)
+def connect_firebase(settings):
+    """
+    Firestore client for the service account in settings (or serviceAccountKey.json),
+    created once and kept for the whole process. Returns (db, error); db is None offline.
+    firebase_admin (and gRPC) are imported here so pages without history never load them.
+    No st.* calls here: they would be replayed on every cache hit.
+    """
+    import firebase_admin
+    from firebase_admin import credentials, firestore
 
-# Initialize Firebase (Singleton)
-# Initialize Firebase (Singleton)
-db = None # Default to None
-try:
-    if not firebase_admin._apps:
-        secrets_found = False
-        try:
-            if "firebase" in st.secrets:
-                cred = credentials.Certificate(dict(st.secrets["firebase"]))
-                firebase_admin.initialize_app(cred)
-                secrets_found = True
-        except FileNotFoundError:
-            pass # Expected locally
-        except Exception:
-            pass # Other errors, try fallback
-
-        if not secrets_found and os.path.exists('serviceAccountKey.json'):
-            cred = credentials.Certificate('serviceAccountKey.json')
-            firebase_admin.initialize_app(cred)
-        elif not secrets_found:
-            st.error("❌ No s'han trobat credencials de Firebase (Secrets o serviceAccountKey.json).")
-            st.stop()
-
-    # Initialize Client only if app is initialized
-    db = firestore.client()
-
-except Exception as e:
-    st.error(f"Error inicialitzant Firebase: {e}")
-    st.stop() # Stop execution on error
-
-COLLECTION_NAME = 'attendance_warnings'
-
-def load_history():
-    """Fetches all warnings from Firestore."""
     try:
-        # st.info("DEBUG: 1. Iniciant descàrrega de dades (timeout 15s)...")
-        ref = db.collection(COLLECTION_NAME)
-        # Switch from stream() to get() to avoid potential gRPC hangs in Streamlit Cloud
-        # Added timeout to prevent infinite hang
-        docs = ref.get(timeout=15) 
-        # st.info(f"DEBUG: 2. Dades descarregades. Documents trobats: {len(docs)}")
-        
-        history = {}
-        for doc in docs:
-            history[doc.id] = doc.to_dict()
-        return history
+        if not firebase_admin._apps:
+            if settings:
+                try:
+                    firebase_admin.initialize_app(credentials.Certificate(settings))
+                except Exception:
+                    pass # Invalid credentials in Secrets, try fallback
+            if not firebase_admin._apps and os.path.exists('serviceAccountKey.json'):
+                firebase_admin.initialize_app(credentials.Certificate('serviceAccountKey.json'))
+
+        # Initialize Client only if app is initialized
+        if firebase_admin._apps:
+            return firestore_usage.CountingClient(firestore.client(), get_usage_meter()), None
+        return None, None
     except Exception as e:
-        st.error(f"Error detallat carregant Firebase: {e}")
-        return {}
+        return None, str(e)
+
+def init_firebase():
+    """(db, error) for the Firebase credentials in Secrets, or serviceAccountKey.json locally."""
+    return connect_firebase(secrets_section("firebase"))
+
+def show_connection_status():
+    # Without Firebase the app runs offline on the local history (synced when credentials are available)
+    db, error = init_firebase()
+    if error:
+        st.sidebar.error(f"Error inicialitzant Firebase: {error}")
+    if db is None:
+        st.sidebar.info("📴 Mode local: sense connexió a Firebase (Secrets o serviceAccountKey.json).")
+        return
+    budget = get_usage_budget()
+    exceeded = budget.exceeded(get_usage_meter(), st.session_state["session_id"], page)
+    for message in exceeded:
+        st.sidebar.warning(f"🔥 {message}")
+    if exceeded and not use_firestore():
+        st.sidebar.info("Es llegeix la còpia local de l'historial fins que hi hagi pressupost de lectures.")
+
+def use_firestore():
+    """
+    True when reads should go to Firestore: online and within the read budget of this
+    session, page and day. Otherwise (in "fallback" mode) the local copy is read.
+    """
+    db, _ = init_firebase()
+    if db is None:
+        return False
+    budget = get_usage_budget()
+    return not (budget.fallback and budget.reads_exceeded(get_usage_meter(), st.session_state["session_id"], page))
+
+# Local SQLite history is the read path; HistorySync keeps it in step with Firestore in the background
+# (incremental pulls while sessions use history, a full reload at most every HISTORY_TTL_SECONDS)
+HISTORY_TTL_SECONDS = int(os.environ.get("HISTORY_TTL_SECONDS", history_store.HISTORY_TTL_SECONDS))
+
+@st.cache_resource
+def get_local_store():
+    store = local_store.LocalHistoryStore()
+    db, _ = init_firebase()
+    if db is None:
+        # Offline first run: start from the pre-Firestore JSON history
+        store.import_legacy_json()
+    return store
+
+@st.cache_resource
+def get_history_sync():
+    """Background two-way sync shared by all sessions (None when offline)."""
+    db, _ = init_firebase()
+    if db is None:
+        return None
+    # Once the day's read budget is spent, only local changes are pushed
+    meter = get_usage_meter()
+    budget = get_usage_budget()
+    sync = local_store.HistorySync(
+        db, get_local_store(), full_every=HISTORY_TTL_SECONDS,
+        pull_allowed=lambda: not budget.daily_reads_exceeded(meter),
+    )
+    sync.start()
+    return sync
+
+def active_history_sync():
+    """get_history_sync(), marking history as in use (the background sync pauses when nobody uses it)."""
+    sync = get_history_sync()
+    if sync is not None:
+        sync.touch()
+    return sync
+
+def load_history_for(ids):
+    """Fetches the history of the given warning IDs only."""
+    sync = active_history_sync()
+    if sync is not None and not sync.has_synced and use_firestore():
+        # First sync still running: get these documents straight from Firestore
+        try:
+            sync.refresh(ids)
+        except Exception as e:
+            st.error(f"Error detallat carregant Firebase: {e}")
+    return get_local_store().get_many(ids)
 
 def save_history(hist_updates):
     """
-    Saves updates to Firestore.
-    Accepts a dictionary of updates {id: data}.
-    Note: We change the signature slightly to avoid re-uploading the whole DB.
-    But for compatibility with existing code calling save_history(full_history),
-    we can adapt.
+    Saves updates {id: data} locally and queues them for Firestore without waiting for the network.
+    All the updates of one interaction are committed together in a single batch.
     """
+    queue_history(hist_updates, active_history_sync(), get_local_store())
+    clear_history_caches()
+
+def queue_history(hist_updates, sync, store):
+    """
+    The writes of save_history, without any st.* call: safe to run while Streamlit
+    stops the script. The history caches are then cleared by the next run (history_changed).
+    """
+    if sync is not None:
+        sync.push(hist_updates)
+        profiling.count("firestore_writes_queued", len(hist_updates))
+    else:
+        # Kept dirty: uploaded by the first sync once Firebase is available
+        store.put(hist_updates, dirty=True)
+
+def clear_history_caches():
+    # New sent warnings may add filter options and change the counts of the history page
+    load_history_facets.clear()
+    load_history_aggregates.clear()
+    st.session_state.pop("history_changed", None)
+
+SMTP_REQUIRED = ["host", "sender"]
+
+def get_smtp_settings():
+    """SMTP settings for the bulk outbox (st.secrets["smtp"]), or None if not configured or incomplete."""
     try:
-        # If passed the Full History dict, we might want to batch update or just set
-        # Since the app code passes the WHOLE history object, iterating it all is inefficient
-        # but safe for migration.
-        # OPTIMIZATION: In the app logic, we identify 'changes_made'.
-        # However, for now, let's just update the specific keys if possible or
-        # iterating is fine for small datasets.
-        
-        # ACTUALLY: The app code updates the 'history' local dict and calls save_history(history).
-        # We should ideally only update the modified ones.
-        # But to minimal code impact, we can just iterate.
-        
-        batch = db.batch()
-        count = 0
-        for wid, data in hist_updates.items():
-            doc_ref = db.collection(COLLECTION_NAME).document(wid)
-            batch.set(doc_ref, data)
-            count += 1
-            if count == 400: # Batch limit is 500
-                batch.commit()
-                batch = db.batch()
-                count = 0
-        if count > 0:
-            batch.commit()
-            
-    except Exception as e:
-        st.error(f"Error guardant a Firebase: {e}")
+        if "smtp" in st.secrets:
+            settings = dict(st.secrets["smtp"])
+            missing = [key for key in SMTP_REQUIRED if not settings.get(key)]
+            if missing:
+                st.warning(f"Falten camps a [smtp] de Secrets ({', '.join(missing)}): l'enviament per SMTP queda desactivat.")
+                return None
+            return settings
+    except FileNotFoundError:
+        pass # Local execution without secrets.toml
+    except Exception:
+        pass
+    return None
+
+# Sent-warnings view: queried page by page (Firestore when online, the local store otherwise)
+HISTORY_FILTERS = [
+    ("cycle", "cycles", "Filtrar per Cicle"),
+    ("group", "groups", "Filtrar per Grup"),
+    ("subject", "subjects", "Filtrar per Assignatura"),
+    ("student", "students", "Filtrar per Alumne"),
+]
+
+# `remote` (use_firestore()) picks Firestore or the local copy; it is part of the cache key
+@st.cache_data(ttl=60, show_spinner=False)
+def load_history_facets(remote):
+    """Filter options of the history page (one document read, at most once a minute)."""
+    if not remote:
+        return get_local_store().facets()
+    return history_store.load_facets(init_firebase()[0])
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_history_aggregates(remote):
+    """Sent-warning counts by cycle, group, type and month (one document read)."""
+    if not remote:
+        return get_local_store().aggregates()
+    return history_store.load_aggregates(init_firebase()[0])
+
+# Set before writes that may finish while the script is stopping (see queue_history)
+if st.session_state.get("history_changed"):
+    clear_history_caches()
+
+def load_sent_page(filters, cursor, remote):
+    if not remote:
+        return get_local_store().fetch_sent_page(filters, cursor=cursor)
+    return history_store.fetch_sent_page(init_firebase()[0], filters, cursor=cursor)
+
+def count_sent(filters, remote):
+    if not remote:
+        return get_local_store().count_sent(filters)
+    return history_store.count_sent(init_firebase()[0], filters)
 
 if page == "Historial d'Enviats":
     st.header("📨 Historial d'Avisos Enviats")
-    history = load_history()
+    show_connection_status()
+    active_history_sync()
+    remote = use_firestore()
     
-    if history:
-        # Convert Dict to DataFrame
-        # Filter only Notified=True
-        # We need the KEY (ID) to recover data for legacy entries
+    try:
+        with profiling.stage("history_facets"):
+            facets = load_history_facets(remote)
+            aggregates = load_history_aggregates(remote)
+    except Exception as e:
+        st.error(f"Error detallat carregant Firebase: {e}")
+        st.stop()
+    
+    if aggregates["total"]:
+        with st.expander(f"📊 Resum: {aggregates['total']} avisos enviats"):
+            agg_titles = [("by_type", "Per Tipus"), ("by_cycle", "Per Cicle"), ("by_group", "Per Grup"), ("by_month", "Per Mes")]
+            agg_cols = st.columns(len(agg_titles))
+            for col, (key, title) in zip(agg_cols, agg_titles):
+                with col:
+                    st.markdown(f"**{title}**")
+                    counts = pd.Series(aggregates[key], dtype=int).sort_index()
+                    st.dataframe(counts.rename("Enviats"), use_container_width=True)
+    
+    # Filters for History
+    # Row 1: Structural Filters (Cycle, Group)
+    # Row 2: Specific Filters (Subject, Student)
+    filters = {}
+    filter_cols = st.columns(2) + st.columns(2)
+    for col, (field, facet, label) in zip(filter_cols, HISTORY_FILTERS):
+        with col:
+            filters[field] = st.multiselect(label, facets.get(facet, []))
+    
+    # Pagination: cursors[i] is where page i starts; any filter change goes back to page 1
+    # (so does switching between Firestore and the local copy: their cursors differ)
+    filters_key = (remote,) + tuple(tuple(v) for v in filters.values())
+    if st.session_state.get("hist_filters_key") != filters_key:
+        st.session_state["hist_filters_key"] = filters_key
+        st.session_state["hist_cursors"] = [None]
+    cursors = st.session_state["hist_cursors"]
+    
+    if history_store.filter_combinations(filters) > history_store.MAX_DISJUNCTIONS:
+        st.warning(f"Massa combinacions de filtres (màxim {history_store.MAX_DISJUNCTIONS}). Redueix la selecció.")
+        st.stop()
+    
+    try:
+        with profiling.stage("history_page") as stage:
+            page_docs, next_cursor = load_sent_page(filters, cursors[-1], remote)
+            # Unfiltered total straight from the aggregates
+            total_sent = count_sent(filters, remote) if any(filters.values()) else aggregates["total"]
+            stage.rows = len(page_docs)
+    except Exception as e:
+        st.error(f"Error detallat carregant Firebase: {e}")
+        st.stop()
+    
+    if page_docs:
         sent_items = []
-        for key, val in history.items():
-            if val.get('notified', False):
-                # Backfill logic removed/simplified as Firestore data should be clean?
-                # Keeping it just in case of mixed data
-                if val.get('type', '-') == '-' or val.get('type') is None:
-                    try:
-                        parts = key.rsplit('_', 1) 
-                        if len(parts) == 2:
-                            val['type'] = parts[1]
-                    except:
-                        pass
-                
-                # Flatten for DataFrame
-                item = val.copy()
-                item['id'] = key
-                sent_items.append(item)
+        for key, val in page_docs.items():
+            # Legacy entries may lack the type: recover it from the ID
+            val['type'] = history_store.warning_type(key, val)
+            sent_items.append(val)
         
-        if sent_items:
-            df_hist = pd.DataFrame(sent_items)
-            
-            # Ensure columns exist
-            check_cols = ["last_update", "student", "subject", "cycle", "group", "pct", "type"]
-            for c in check_cols:
-                if c not in df_hist.columns:
-                    df_hist[c] = "-"
-            
-            # Fill NaNs just in case
-            df_hist = df_hist.fillna("-")
-            
-            # Display
-            st.markdown(f"**Total Enviats:** {len(df_hist)}")
-            
-            # Reorder
-            cols_show = ["last_update", "student", "group", "subject", "cycle", "pct", "type"]
-            cols_map = {
-                "last_update": "Data Enviament",
-                "student": "Alumne",
-                "group": "Grup",
-                "subject": "Assignatura",
-                "cycle": "Cicle",
-                "pct": "% Assistència",
-                "type": "Tipus Avís"
-            }
-            
-            df_display = df_hist[cols_show].rename(columns=cols_map)
-            # Sort by Date Desc
-            df_display = df_display.sort_values(by="Data Enviament", ascending=False)
-            
-            
-            # Filters for History
-            # Row 1: Structural Filters (Cycle, Group)
-            col1, col2 = st.columns(2)
-            with col1:
-                hist_cycle_filter = st.multiselect("Filtrar per Cicle", sorted(df_display["Cicle"].unique().astype(str)))
-            with col2:
-                hist_group_filter = st.multiselect("Filtrar per Grup", sorted(df_display["Grup"].unique().astype(str)))
-            
-            # Row 2: Specific Filters (Subject, Student)
-            col3, col4 = st.columns(2)
-            with col3:
-                hist_mod_filter = st.multiselect("Filtrar per Assignatura", sorted(df_display["Assignatura"].unique().astype(str)))
-            with col4:
-                hist_stud_filter = st.multiselect("Filtrar per Alumne", sorted(df_display["Alumne"].unique().astype(str)))
-                
-            # Apply Filters
-            if hist_cycle_filter:
-                df_display = df_display[df_display["Cicle"].isin(hist_cycle_filter)]
-            if hist_group_filter:
-                df_display = df_display[df_display["Grup"].isin(hist_group_filter)]
-            if hist_mod_filter:
-                df_display = df_display[df_display["Assignatura"].isin(hist_mod_filter)]
-            if hist_stud_filter:
-                df_display = df_display[df_display["Alumne"].isin(hist_stud_filter)]
-            
-            st.dataframe(df_display, use_container_width=True, hide_index=True)
-            
+        cols_show = ["last_update", "student", "group", "subject", "cycle", "pct", "type"]
+        cols_map = {
+            "last_update": "Data Enviament",
+            "student": "Alumne",
+            "group": "Grup",
+            "subject": "Assignatura",
+            "cycle": "Cicle",
+            "pct": "% Assistència",
+            "type": "Tipus Avís"
+        }
+        # Already sorted by date (newest first)
+        df_display = pd.DataFrame(sent_items).reindex(columns=cols_show).fillna("-").rename(columns=cols_map)
+        
+        st.markdown(f"**Total Enviats:** {total_sent}")
+        st.dataframe(df_display, use_container_width=True, hide_index=True)
+        
+        page_size = history_store.HISTORY_PAGE_SIZE
+        first = (len(cursors) - 1) * page_size
+        nav_prev, nav_info, nav_next = st.columns([1, 2, 1])
+        with nav_prev:
+            if st.button("◀ Anterior", disabled=len(cursors) == 1):
+                cursors.pop()
+                st.rerun()
+        with nav_info:
+            st.caption(f"Avisos {first + 1}–{first + len(page_docs)} de {total_sent}")
+        with nav_next:
+            if st.button("Següent ▶", disabled=next_cursor is None):
+                cursors.append(next_cursor)
+                st.rerun()
+        
+        if remote:
             st.info("💡 Nota: Les dades ara estan sincronitzades amb el núvol (Firebase).")
-            
+        elif init_firebase()[0] is not None:
+            st.info("💡 Nota: S'està mostrant la còpia local (límit de lectures de Firebase).")
         else:
-            st.info("No hi ha cap avís marcat com a enviat a l'historial.")
+            st.info("💡 Nota: Mode local. Els canvis es pujaran a Firebase quan hi hagi connexió.")
+    elif any(filters.values()):
+        st.info("Cap avís enviat coincideix amb els filtres.")
     else:
-        st.info("L'historial està buit (Firebase).")
+        st.info("No hi ha cap avís marcat com a enviat a l'historial.")
 
 elif page == "Models de Correu":
     st.header("📧 Models de Correu")
     st.markdown("A continuació es mostren els plantilles de correu que s'envien automàticament segons l'etapa educativa i el tipus d'avís.")
 
-    tab_eso, tab_batx, tab_pfi, tab_fp = st.tabs(["ESO (3r i 4t)", "Batxillerat", "PFI", "Cicles Formatius (FP)"])
-
-    with tab_eso:
-        st.subheader("Ensenyament Secundari Obligatori (ESO)")
-        
-        st.markdown("### 🟡 Avís 15% (Seguiment)")
-        st.code("""Assumpte: Avís de seguiment d'assistència (15%) - Còmput Global
-
-Benvolgut/da,
-
-Alumne: [Nom de l'Alumne]
-Grup: [Grup]
-
-Us informem que l'alumne ha assolit un 15% de faltes d'assistència en el còmput global del curs.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: [X] h
-- Hores Retards: [X] h
-- Percentatge Actual: [X]%
-
-Aquesta etapa educativa és obligatòria i l'assistència és fonamental per al seguiment del curs. Us recomanem revisar la situació per evitar superar els límits que activarien mètodes de seguiment més estrictes.
-
-Atentament,
-
-Equip docent""", language="text")
-
-        st.markdown("### 🔴 Avís 25% (Protocol Absentisme)")
-        st.code("""Assumpte: Avís important d'absentisme escolar (25%) - Còmput Global
-
-Benvolgut/da,
-
-Alumne: [Nom de l'Alumne]
-Grup: [Grup]
+    templates = email_templates.load_templates()
+    tabs = st.tabs([stage["tab"] for stage in templates.stages.values()])
 
-Us informem que l'alumne ha superat el 25% de faltes d'assistència en el còmput global del curs, el màxim permès.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: [X] h
-- Hores Retards: [X] h
-- Percentatge Actual: [X]%
-
-Recordem que l'Ensenyament Secundari Obligatori (ESO) requereix una assistència continuada. La reiteració en les faltes d'assistència sense justificar pot derivar en l'activació del protocol d'absentisme escolar, la qual cosa podria comportar la intervenció dels serveis socials o educatius competents per garantir el dret a l'escolaritat.
-
-Us preguem que justifiqueu les absències pendents i assegureu l'assistència regular a partir d'ara.
-
-Atentament,
-
-Equip docent""", language="text")
-
-    with tab_batx:
-        st.subheader("Batxillerat")
-        
-        st.markdown("### 🟡 Avís 15% (Preventiu)")
-        st.code("""Assumpte: Avís per faltes d'assistència (15%) - Còmput Global
-
-Benvolgut/da,
-
-Alumne: [Nom de l'Alumne]
-Grup: [Grup]
-
-Us informem que l'alumne ha assolit un 15% de faltes d'assistència en el còmput global del curs.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: [X] h
-- Hores Retards: [X] h
-- Percentatge Actual: [X]%
-
-L'assistència a classe és fonamental per al seguiment del curs. Recordem que superar el 25% de faltes implica la pèrdua del dret a l'avaluació contínua de la primera avaluació.
-
-Us preguem que reviseu la situació.
-
-Atentament,
-
-Equip docent""", language="text")
-
-        st.markdown("### 🔴 Avís 25% (Pèrdua Avaluació Contínua 1a Av.)")
-        st.code("""Assumpte: Comunicació pèrdua dret a l'avaluació contínua (1a avaluació) - Còmput Global
-
-Benvolgut/da,
-
-Alumne: [Nom de l'Alumne]
-Grup: [Grup]
-
-Mitjançant la present us comuniquem que l'alumne ha superat el 25% de faltes d'assistència en el còmput global del curs, el màxim permès.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: [X] h
-- Hores Retards: [X] h
-- Percentatge Actual: [X]%
-
-Això implica la pèrdua del dret a l'avaluació contínua de la primera avaluació de totes les matèries.
-
-Podràs recuperar l'avaluació segons els mecanismes de recuperació establerts pel departament corresponent. Per a qualsevol aclariment, pots adreçar-te al professorat de la matèria o al tutor/a.
-
-Atentament,
-
-Equip docent""", language="text")
-
-    with tab_pfi:
-        st.subheader("PFI (Programes de Formació i Inserció)")
-
-        st.markdown("### 🟡 Avís 15% (Preventiu)")
-        st.code("""Assumpte: Avís per faltes d'assistència (15%) - Còmput Global
-
-Benvolgut/da,
-
-Alumne: [Nom de l'Alumne]
-Grup: [Grup]
-
-Segons el registre d'assistència del centre, has assolit un 15% de faltes d'assistència en el còmput global del curs.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: [X] h
-- Hores Retards: [X] h
-- Percentatge Actual: [X]%
-
-Et recordem que superar el 25% de faltes implica la pèrdua del dret a l'avaluació en 1a convocatòria.
-
-Et demanem que revisis la teva situació i milloris l'assistència. Si ho consideres oportú, posa't en contacte amb el tutor/a.
-
-Atentament,
-
-Equip docent""", language="text")
-
-        st.markdown("### 🔴 Avís 25% (Pèrdua Avaluació 1a Convocatòria)")
-        st.code("""Assumpte: Comunicació pèrdua dret a 1a convocatòria per faltes (25%) - Còmput Global
-
-Benvolgut/da,
-
-Alumne: [Nom de l'Alumne]
-Grup: [Grup]
-
-Segons el registre d’assistència del centre, has superat el 25% de faltes d’assistència en el còmput global del curs, el màxim permès.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: [X] h
-- Hores Retards: [X] h
-- Percentatge Actual: [X]%
-
-D’acord amb la normativa vigent, això implica la pèrdua del dret a l’avaluació en 1a convocatòria.
-
-Podràs acollir-te a la 2a convocatòria en les condicions que fixa la normativa del centre. Per a qualsevol aclariment, pots adreçar-te al/la tutor/a.
-
-Atentament,
-
-Equip docent""", language="text")
-
-    with tab_fp:
-        st.subheader("Formació Professional (Cicles Formatius)")
-        
-        st.markdown("### 🟡 Avís 15% (Preventiu)")
-        st.code("""Assumpte: Avís per faltes d'assistència (primer avís) - [Assignatura]
-
-Benvolgut/da,
-
-Alumne: [Nom de l'Alumne]
-Grup: [Grup]
-
-Segons el registre d'assistència del centre, has assolit un 15% de faltes d'assistència al mòdul [Assignatura].
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: [X] h
-- Hores Retards: [X] h
-- Percentatge Actual: [X]%
-
-Et recordem que, d'acord amb el Reial decret 659/2023, superar el 25% de faltes implica la pèrdua del dret a l'avaluació en 1a convocatòria.
-
-Et demanem que revisis la teva situació i milloris l'assistència. Si ho consideres oportú, posa't en contacte amb el professorat o el tutor/a.
-
-Atentament,
-
-Equip docent""", language="text")
-
-        st.markdown("### 🔴 Avís 25% (Pèrdua Avaluació 1a Convocatòria)")
-        st.code("""Assumpte: Comunicació pèrdua dret a 1a convocatòria per faltes (25%)
-
-Benvolgut/da,
-
-Alumne: [Nom de l'Alumne]
-Grup: [Grup]
-
-Segons el registre d’assistència del centre, has superat el 25% de faltes d’assistència al mòdul [Assignatura], el màxim permès.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: [X] h
-- Hores Retards: [X] h
-- Percentatge Actual: [X]%
-
-D’acord amb el que estableix el Reial decret 659/2023, de 18 de juliol, pel qual es desenvolupa l’ordenació del Sistema de Formació Professional, això implica la pèrdua del dret a l’avaluació en 1a convocatòria d’aquest mòdul.
-
-Podràs acollir-te a la 2a convocatòria en les condicions que fixa la programació del mòdul i la normativa del centre. Per a qualsevol aclariment o per resoldre dubtes, pots adreçar-te al professorat del mòdul, al/la tutor/a o al cap d’estudis.
-
-Atentament,
-
-Equip docent""", language="text")
+    for tab, (stage_key, stage) in zip(tabs, templates.stages.items()):
+        with tab:
+            st.subheader(stage["title"])
+            for wtype, tpl in stage["templates"].items():
+                st.markdown(f"### {tpl['heading']}")
+                st.code(templates.preview(stage_key, wtype), language="text")
 
 elif page == "Gestió d'Avisos":
     st.header("📊 Gestió d'Alumnes i Avisos")
+    show_connection_status()
     
     # Load config needed for processing
     full_config = load_config()
 
-    uploaded_file = st.file_uploader("Puja el fitxer Excel (.xlsx)", type=["xlsx", "xls"])
-    
-    if uploaded_file:
-        try:
-            # Helper to generate Gmail Web Link (More robust than mailto for Web users)
-            import urllib.parse
-            
-            def create_gmail_link(row):
-                is_25 = row['Tipus Avís'] == "25%"
-                cycle = row.get('Cicle (Detectat)', '')
-                is_eso = cycle in ["3 ESO", "4 ESO"]
-
-                is_batx = "BATX" in cycle
-                is_pfi = "PFI" in cycle
-
-                if is_eso:
-                    # --- TEMPLATES ESO ---
-                    if is_25:
-                        subject = f"Avís important d'absentisme escolar (25%) - Còmput Global"
-                        body = f"""Benvolgut/da,
-
-Alumne: {row['Alumne']}
-Grup: {row['Grup']}
-
-Us informem que l'alumne ha superat el 25% de faltes d'assistència en el còmput global del curs, el màxim permès.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: {row['Hores Faltes (Reals)']} h
-- Hores Retards: {row['Hores Retards']} h
-- Percentatge Actual: {row['% Actual']}
-
-Recordem que l'Ensenyament Secundari Obligatori (ESO) requereix una assistència continuada. La reiteració en les faltes d'assistència sense justificar pot derivar en l'activació del protocol d'absentisme escolar, la qual cosa podria comportar la intervenció dels serveis socials o educatius competents per garantir el dret a l'escolaritat.
-
-Us preguem que justifiqueu les absències pendents i assegureu l'assistència regular a partir d'ara.
+    # Status changes are committed in the background; report the ones that failed
+    history_sync = active_history_sync()
+    if history_sync is not None and history_sync.queue.failed:
+        st.error(f"❌ {len(history_sync.queue.failed)} canvis no s'han pogut desar a Firebase: {history_sync.queue.last_error}")
+        if st.button("🔄 Reintentar"):
+            history_sync.queue.retry_failed()
+            st.rerun()
 
-Atentament,
-
-Equip docent"""
-                    else:
-                        subject = f"Avís de seguiment d'assistència (15%) - Còmput Global"
-                        body = f"""Benvolgut/da,
-
-Alumne: {row['Alumne']}
-Grup: {row['Grup']}
-
-Us informem que l'alumne ha assolit un 15% de faltes d'assistència en el còmput global del curs.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: {row['Hores Faltes (Reals)']} h
-- Hores Retards: {row['Hores Retards']} h
-- Percentatge Actual: {row['% Actual']}
-
-Aquesta etapa educativa és obligatòria i l'assistència és fonamental per al seguiment del curs. Us recomanem revisar la situació per evitar superar els límits que activarien mètodes de seguiment més estrictes.
-
-Atentament,
-
-Equip docent"""
-
-                elif is_batx:
-                    # --- TEMPLATES BATXILLERAT ---
-                    if is_25:
-                        subject = f"Comunicació pèrdua dret a l'avaluació contínua (1a avaluació) - Còmput Global"
-                        
-                        body = f"""Benvolgut/da,
-
-Alumne: {row['Alumne']}
-Grup: {row['Grup']}
-
-Mitjançant la present us comuniquem que l'alumne ha superat el 25% de faltes d'assistència en el còmput global del curs, el màxim permès.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: {row['Hores Faltes (Reals)']} h
-- Hores Retards: {row['Hores Retards']} h
-- Percentatge Actual: {row['% Actual']}
-
-Això implica la pèrdua del dret a l'avaluació contínua de la primera avaluació de totes les matèries.
-
-Podràs recuperar l'avaluació segons els mecanismes de recuperació establerts pel departament corresponent. Per a qualsevol aclariment, pots adreçar-te al professorat de la matèria o al tutor/a.
-
-Atentament,
-
-Equip docent"""
-
-                    else:
-                        # --- TEMPLATE 15% BATX ---
-                        subject = f"Avís per faltes d'assistència (15%) - Còmput Global"
-                        
-                        body = f"""Benvolgut/da,
-
-Alumne: {row['Alumne']}
-Grup: {row['Grup']}
-
-Us informem que l'alumne ha assolit un 15% de faltes d'assistència en el còmput global del curs.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: {row['Hores Faltes (Reals)']} h
-- Hores Retards: {row['Hores Retards']} h
-- Percentatge Actual: {row['% Actual']}
-
-L'assistència a classe és fonamental per al seguiment del curs. Recordem que superar el 25% de faltes implica la pèrdua del dret a l'avaluació contínua de la primera avaluació.
-
-Us preguem que reviseu la situació.
-
-Atentament,
-
-Equip docent"""
-
-                elif is_pfi:
-                    # --- TEMPLATES PFI (Global + FP Consequences) ---
-                    if is_25:
-                        subject = f"Comunicació pèrdua dret a 1a convocatòria per faltes (25%) - Còmput Global"
-                        body = f"""Benvolgut/da,
-
-Alumne: {row['Alumne']}
-Grup: {row['Grup']}
-
-Segons el registre d’assistència del centre, has superat el 25% de faltes d’assistència en el còmput global del curs, el màxim permès.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: {row['Hores Faltes (Reals)']} h
-- Hores Retards: {row['Hores Retards']} h
-- Percentatge Actual: {row['% Actual']}
-
-D’acord amb la normativa vigent, això implica la pèrdua del dret a l’avaluació en 1a convocatòria.
-
-Podràs acollir-te a la 2a convocatòria en les condicions que fixa la normativa del centre. Per a qualsevol aclariment, pots adreçar-te al/la tutor/a.
-
-Atentament,
-
-Equip docent"""
-                    else:
-                        subject = f"Avís per faltes d'assistència (15%) - Còmput Global"
-                        body = f"""Benvolgut/da,
-
-Alumne: {row['Alumne']}
-Grup: {row['Grup']}
-
-Segons el registre d'assistència del centre, has assolit un 15% de faltes d'assistència en el còmput global del curs.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: {row['Hores Faltes (Reals)']} h
-- Hores Retards: {row['Hores Retards']} h
-- Percentatge Actual: {row['% Actual']}
-
-Et recordem que superar el 25% de faltes implica la pèrdua del dret a l'avaluació en 1a convocatòria.
-
-Et demanem que revisis la teva situació i milloris l'assistència. Si ho consideres oportú, posa't en contacte amb el tutor/a.
-
-Atentament,
-
-Equip docent"""
-
-                else:
-                    # --- TEMPLATES STANDARD (FP) ---
-                    if is_25:
-                        # --- TEMPLATE 25% (PÈRDUA AVALUACIÓ) ---
-                        subject = "Comunicació pèrdua dret a 1a convocatòria per faltes (25%)"
-                        
-                        body = f"""Benvolgut/da,
-
-Alumne: {row['Alumne']}
-Grup: {row['Grup']}
-
-Segons el registre d’assistència del centre, has superat el 25% de faltes d’assistència al mòdul {row['Assignatura']}, el màxim permès.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: {row['Hores Faltes (Reals)']} h
-- Hores Retards: {row['Hores Retards']} h
-- Percentatge Actual: {row['% Actual']}
-
-D’acord amb el que estableix el Reial decret 659/2023, de 18 de juliol, pel qual es desenvolupa l’ordenació del Sistema de Formació Professional, això implica la pèrdua del dret a l’avaluació en 1a convocatòria d’aquest mòdul.
-
-Podràs acollir-te a la 2a convocatòria en les condicions que fixa la programació del mòdul i la normativa del centre. Per a qualsevol aclariment o per resoldre dubtes, pots adreçar-te al professorat del mòdul, al/la tutor/a o al cap d’estudis.
-
-Atentament,
-
-Equip docent"""
-
-                    else:
-                        # --- TEMPLATE 15% (AVÍS PREVENTIU) ---
-                        subject = f"Avís per faltes d'assistència (primer avís) - {row['Assignatura']}"
-                        
-                        body = f"""Benvolgut/da,
-
-Alumne: {row['Alumne']}
-Grup: {row['Grup']}
-
-Segons el registre d'assistència del centre, has assolit un 15% de faltes d'assistència al mòdul {row['Assignatura']}.
-
-RESUM DE LA SITUACIÓ ACTUAL:
-- Hores Faltes Reals: {row['Hores Faltes (Reals)']} h
-- Hores Retards: {row['Hores Retards']} h
-- Percentatge Actual: {row['% Actual']}
-
-Et recordem que, d'acord amb el Reial decret 659/2023, superar el 25% de faltes implica la pèrdua del dret a l'avaluació en 1a convocatòria.
-
-Et demanem que revisis la teva situació i milloris l'assistència. Si ho consideres oportú, posa't en contacte amb el professorat o el tutor/a.
-
-Atentament,
-
-Equip docent"""
-                
-                # Construct Gmail URL
-                params = {
-                    "view": "cm",
-                    "fs": "1",
-                    "su": subject,
-                    "body": body
-                }
-                query_string = urllib.parse.urlencode(params)
-                return f"https://mail.google.com/mail/?{query_string}"
-
-            # Load Data - Dynamic Header Search
-            temp_df = pd.read_excel(uploaded_file, header=None)
-            
-            header_row_idx = None
-            for i, row in temp_df.iterrows():
-                row_str = row.astype(str).str.strip().tolist()
-                if "Alumne/a" in row_str and "Assignatura" in row_str:
-                    header_row_idx = i
-                    break
-            
-            if header_row_idx is None:
-                st.error("❌ No s'ha trobat la fila de capçalera (Alumne/a, Assignatura...).")
-                st.stop()
-                
-            # Re-read with correct header
-            uploaded_file.seek(0)
-            df = pd.read_excel(uploaded_file, header=header_row_idx)
-            df.columns = df.columns.str.strip()
-            
-            required_cols = ['Alumne/a', 'Tipus', 'Hora', 'Assignatura']
-            missing = [c for c in required_cols if c not in df.columns]
-            
-            if missing:
-                 st.error(f"❌ Falten columnes obligatòries a l'Excel: {', '.join(missing)}")
-            else:
-                # 1. Detect Subjects
-                unique_subjects = sorted(df['Assignatura'].dropna().unique())
-                
-                # Identify columns
-                col_map = {c: c for c in df.columns}
-                # Handle potential variations in column names if needed, but 'Grup (incidència)' is expected
-                grup_col = next((c for c in df.columns if "Grup" in c), None)
+    # Several exports (per group, per term) are merged; shared rows are counted once
+    uploaded_files = st.file_uploader("Puja el fitxer Excel (.xlsx)", type=["xlsx", "xls"], accept_multiple_files=True)
     
-                if not grup_col:
-                    st.error("⚠️ No s'ha trobat la columna 'Grup' (o 'Grup (incidència)'). No es pot determinar el cicle.")
-                    st.stop()
-                
-                # PROCESS DATA
-                st.divider()
-                
-                # --- AUTO-OPEN GMAIL LOGIC (Post-Rerun) ---
-                if "auto_open_gmail" in st.session_state:
-                    url_to_open = st.session_state["auto_open_gmail"]
-                    
-                    # Use Python's native webbrowser module (Works perfectly for local apps)
-                    import webbrowser
-                    try:
-                        webbrowser.open_new_tab(url_to_open)
-                        st.toast("📧 Gmail obert correctament!", icon="🚀")
-                    except Exception as e:
-                        st.error(f"No s'ha pogut obrir el navegador: {e}")
-                        
-                    # Clear state
-                    del st.session_state["auto_open_gmail"]
+    if uploaded_files:
+        try:
+            # Gmail links are rendered only for the row being sent (and in bulk for the CSV)
+            templates = email_templates.load_templates()
 
+            # Load + analyze, cached by file content and config version
+            # (reruns from checkboxes/filters reuse the processed frames)
+            try:
                 with st.spinner("Analitzant dades..."):
-                    # Filter Absences and Delays
-                    # Codes: F, FJ, FJP (Absences); R, RJ, RJP (Delays)
-                    absence_codes = ['F', 'FJ', 'FJP']
-                    delay_codes = ['R', 'RJ', 'RJP']
-                    valid_types = absence_codes + delay_codes
-                    
-                    # Filter rows with valid types
-                    # Use str.strip() to be safe
-                    mask = df['Tipus'].astype(str).str.strip().isin(valid_types)
-                    records = df[mask].copy()
-                    
-                    # Calculate duration
-                    records['Durada'] = records['Hora'].apply(calculate_duration)
-                    records['Grup_Clean'] = records[grup_col].astype(str).str.strip()
-                    records['Tipus_Clean'] = records['Tipus'].astype(str).str.strip()
-                    
-                    # --- NORMALIZATION FOR EB/PER Project Modules ---
-                    # Request: Merge "Mòdul projecte" into "Projecte intermodular" for groups containing "EB" or "PER"
-                    def normalize_project_module(row):
-                        grup = row['Grup_Clean']
-                        subj = row['Assignatura']
-                        
-                        if "EB" in grup or "PER" in grup:
-                            if subj == "Mòdul projecte":
-                                return "Projecte intermodular"
-                        return subj
+                    with profiling.stage("upload"):
+                        uploads = [(f.name, f.getvalue()) for f in uploaded_files]
+                    df_summary, warnings_df, report = analyze_uploads(
+                        uploads, full_config,
+                        cache=get_result_cache(), snapshots=get_snapshot_store(),
+                        parse_cache=get_parse_cache(),
+                    )
+            except ExportFormatError as e:
+                st.error(f"❌ {e}")
+                st.stop()
 
-                    records['Assignatura'] = records.apply(normalize_project_module, axis=1)
-                    # -----------------------------------------------
-                    
-                    # Group by key fields
-                    # We need to sum durations separately for Absences and Delays
+            # PROCESS DATA
+            st.divider()
+
+            # --- AUTO-OPEN GMAIL LOGIC (Post-Rerun) ---
+            if "auto_open_gmail" in st.session_state:
+                url_to_open = st.session_state["auto_open_gmail"]
+
+                # Use Python's native webbrowser module (Works perfectly for local apps)
+                import webbrowser
+                try:
+                    webbrowser.open_new_tab(url_to_open)
+                    st.toast("📧 Gmail obert correctament!", icon="🚀")
+                except Exception as e:
+                    st.error(f"No s'ha pogut obrir el navegador: {e}")
+
+                # Clear state
+                del st.session_state["auto_open_gmail"]
+
+            if report["malformed_slots"]:
+                st.warning(f"⚠️ {format_malformed_slots(report['malformed_slots'])}")
+            if report["unmatched_groups"]:
+                st.warning(f"⚠️ {format_unmatched_groups(report['unmatched_groups'])}")
+            if report["files"] > 1:
+                st.caption(f"{report['files']} fitxers combinats: {report['rows']} registres ({report['duplicate_rows']} repetits entre fitxers descartats).")
+            new_warnings = set(report.get("new_warnings", []))
+            if new_warnings:
+                st.info(f"🆕 {len(new_warnings)} avisos nous respecte a l'última exportació processada.")
+            if report["subject_issues"]:
+                with st.expander(f"⚠️ Assignatures sense hores o ambigües ({len(report['subject_issues'])})", expanded=False):
+                    st.dataframe(subject_issues_frame(report["subject_issues"]), use_container_width=True, hide_index=True)
+
+            # --- RESULTS DISPLAY ---
                     
-                    # Helper to categorize
-                    def get_category(code):
-                        if code in absence_codes: return 'Absence'
-                        if code in delay_codes: return 'Delay'
-                        return 'Other'
+            # 1. SUMMARY REPORT
+            if not df_summary.empty:
+                with st.expander("📊 Resum de Faltes i Retards (Tots els alumnes)", expanded=False):
+                    st.dataframe(df_summary[SUMMARY_COLUMNS], use_container_width=True)
     
-                    records['Category'] = records['Tipus_Clean'].apply(get_category)
-    
-                    # Group by Student, Subject, Group, Category
-                    grouped = records.groupby(['Alumne/a', 'Assignatura', 'Grup_Clean', 'Category'])['Durada'].sum().reset_index()
-                    
-                    # Pivot or iterate to combine
-                    # It's easier to iterate unique (Student, Subject, Group) combinations
-                    unique_combinations = records[['Alumne/a', 'Assignatura', 'Grup_Clean']].drop_duplicates()
-                    
-                    warnings = []
-                    summary_data = []
-                    processing_date = datetime.now().strftime("%d/%m/%Y")
-                    
-                    # Known Cycle Keys
-                    known_cycles = list(full_config.keys())
-                    
-                    # PFI & ESO/BATX Global Configuration & Buffer
-                    # We treat these as "Global" cycles where attendance is calculated on TOTAL hours, not per module.
-                    global_cycles = ["PFIPER", "PFICOM", "3 ESO", "4 ESO", "1 BATX", "2 BATX"]
-                    
-                    global_total_hours = {}
-                    for g_cycle in global_cycles:
-                        # Hardcoded defaults if missing in JSON, or specific overrides
-                        if g_cycle == "3 ESO":
-                            global_total_hours[g_cycle] = 1080
-                        elif g_cycle == "4 ESO":
-                            global_total_hours[g_cycle] = 1080
-                        elif g_cycle == "1 BATX":
-                             # Default if not in config, though it should be. 
-                             # If in config, sum values.
-                             if g_cycle in full_config:
-                                 global_total_hours[g_cycle] = sum(full_config[g_cycle].values())
-                             else:
-                                 global_total_hours[g_cycle] = 1020 # Typical fallback
-                        elif g_cycle == "2 BATX":
-                            global_total_hours[g_cycle] = 1020
-                        elif g_cycle in full_config:
-                            # For PFIs or others defined in JSON
-                            global_total_hours[g_cycle] = sum(full_config[g_cycle].values())
-                    
-                    # Buffer for Global aggregation: {(Student, Group): {'abs': 0, 'delay': 0, 'cycle': ''}}
-                    global_buffer = {}
-                    
-                    # Pre-calculate a normalized config map for each cycle
-                    cycle_normalized_maps = {}
-                    import re
-                    import unicodedata
-                    
-                    for c_code, c_conf in full_config.items():
-                        cycle_normalized_maps[c_code] = {}
-                        for subj_key, hrs in c_conf.items():
-                            # Strip leading code like "0633. ", "MP1226 ", "MP3060_"
-                            # Pattern: Start, optional chars, DIGIT(s), optional chars, (dot OR underscore OR dash OR space)
-                            # This also handles "MP3060_Preparació" -> "Preparació"
-                            norm_name = re.sub(r'^[^\s]*\d+[^\s]*[\._\-\s]\s*', '', subj_key).strip().lower()
-                            # Normalize apostrophes
-                            norm_name = norm_name.replace("’", "'").replace("‘", "'").replace("´", "'").replace("`", "'")
-                            # Normalize Unicode to NFC
-                            norm_name = unicodedata.normalize('NFC', norm_name)
-                            cycle_normalized_maps[c_code][norm_name] = hrs
+            # 2. WARNINGS
+            st.subheader("⚠️ Avisos Generats (>15% i >25%)")
+            if not warnings_df.empty:
+                # --- Persistence Logic ---
+                # Uses GLOBAL load_history/save_history (Firebase)
     
-                    for idx, row in unique_combinations.iterrows():
-                        student = row['Alumne/a']
-                        subject = row['Assignatura']
-                        group_name = row['Grup_Clean']
+                # Add unique ID for tracking
+                # ID = Student + Module + Type (e.g., "John Doe_Math_15%")
+                # We store: {ID: {notified: True, date: ...}}
                         
-                        # Get hours for this combo
-                        # Filter from grouped
-                        combo_stats = grouped[
-                            (grouped['Alumne/a'] == student) & 
-                            (grouped['Assignatura'] == subject) & 
-                            (grouped['Grup_Clean'] == group_name)
-                        ]
+                res_df = warnings_df.copy()
                         
-                        abs_hours = combo_stats[combo_stats['Category'] == 'Absence']['Durada'].sum()
-                        delay_hours = combo_stats[combo_stats['Category'] == 'Delay']['Durada'].sum()
-                        
-                        # Formula: Effective = Absences + (Delays / 3)
-                        effective_hours = abs_hours + (delay_hours / 3.0)
-                        
-                        # 1. Determine Cycle from Group Name
-                        matched_cycle = None
-                        
-                        # Special check for ESO and BATX
-                        if "3" in group_name and "ESO" in group_name:
-                            matched_cycle = "3 ESO"
-                        elif "4" in group_name and "ESO" in group_name:
-                            matched_cycle = "4 ESO"
-                        elif "1" in group_name and "BATX" in group_name:
-                            matched_cycle = "1 BATX"
-                        elif "2" in group_name and "BATX" in group_name:
-                            matched_cycle = "2 BATX"
-                        else:
-                            for c_code in sorted(known_cycles, key=len, reverse=True):
-                                if c_code in group_name:
-                                    matched_cycle = c_code
-                                    break
-                        
-                        # --- SPECIAL LOGIC FOR GLOBAL CYCLES (PFI, ESO, BATX) ---
-                        if matched_cycle in global_cycles:
-                            # Aggregate to buffer
-                            key = (student, group_name)
-                            if key not in global_buffer:
-                                global_buffer[key] = {'abs': 0, 'delay': 0, 'cycle': matched_cycle}
-                            
-                            global_buffer[key]['abs'] += abs_hours
-                            global_buffer[key]['delay'] += delay_hours
-                        
-                        total_module_hours = 0
-                        if matched_cycle:
-                            # 2. Look up hours in that cycle's normalized config
-                            excel_subj_norm = str(subject).strip().lower()
-                            # Normalize apostrophes for lookup too
-                            excel_subj_norm = excel_subj_norm.replace("’", "'").replace("‘", "'").replace("´", "'").replace("`", "'")
-                            # Normalize Unicode to NFC
-                            excel_subj_norm = unicodedata.normalize('NFC', excel_subj_norm)
-                            
-                            cycle_map = cycle_normalized_maps.get(matched_cycle, {})
-                            
-                            if excel_subj_norm in cycle_map:
-                                total_module_hours = cycle_map[excel_subj_norm]
-                            else:
-                                # Fuzzy fallback
-                                for cfg_name, cfg_hours in cycle_map.items():
-                                    if cfg_name in excel_subj_norm or excel_subj_norm in cfg_name:
-                                        total_module_hours = cfg_hours
-                                        break
-                        
-                        # Prepare data for summary (regardless of warning)
-                        pct = 0
-                        if total_module_hours > 0:
-                            pct = (effective_hours / total_module_hours) * 100
-                        
-                        summary_item = {
-                            "Alumne": student,
-                            "Cicle": matched_cycle if matched_cycle else "Desconegut",
-                            "Grup": group_name,
-                            "Assignatura": subject,
-                            "Hores Totals": total_module_hours,
-                            "Hores Faltes": round(abs_hours, 2),
-                            "Hores Retards": round(delay_hours, 2),
-                            "Hores Efectives": round(effective_hours, 2),
-                            "% Assistència": f"{round(pct, 1)}%"
-                        }
-                        summary_data.append(summary_item)
-    
-                        # Check Thresholds (SKIP for Global Cycles)
-                        if matched_cycle in global_cycles:
-                            continue
+                # Create IDs (Composite Key)
+                res_df['Avís ID'] = warning_ids(res_df)
 
-                        if total_module_hours > 0:
-                            warning_type = None
-                            if pct >= 25:
-                                warning_type = "25%"
-                            elif pct >= 15:
-                                warning_type = "15%"
-                                
-                            if warning_type:
-                                warnings.append({
-                                    "Data Avís": processing_date,
-                                    "Alumne": student,
-                                    "Grup": group_name,
-                                    "Assignatura": subject,
-                                    "Cicle (Detectat)": matched_cycle,
-                                    "Hores Faltes (Reals)": round(abs_hours, 2),
-                                    "Hores Retards": round(delay_hours, 2),
-                                    "Hores Efectives (F + R/3)": round(effective_hours, 2),
-                                    "Hores Totals Mòdul": total_module_hours,
-                                    "% Actual": f"{round(pct, 1)}%",
-                                    "Tipus Avís": warning_type
-                                })
-                        else:
-                            # Optional: Log missing config
-                            pass
-                    
-                    # --- PROCESS GLOBAL BUFFER (Global Warnings) ---
-                    for (student, group_name), stats in global_buffer.items():
-                        c_code = stats['cycle']
-                        total_cycle_hours = global_total_hours.get(c_code, 0)
-                        
-                        abs_hours = stats['abs']
-                        delay_hours = stats['delay']
-                        effective_hours = abs_hours + (delay_hours / 3.0)
-                        
-                        pct = 0
-                        if total_cycle_hours > 0:
-                            pct = (effective_hours / total_cycle_hours) * 100
-                            
-                        # Add GLOBAL line to Summary
-                        summary_data.append({
-                            "Alumne": student,
-                            "Assignatura": "GLOBAL (Còmput Total)",
-                            "Grup": group_name,
-                            "Cicle": c_code,
-                            "Hores Totals": total_cycle_hours,
-                            "Hores Faltes": round(abs_hours, 2),
-                            "Hores Retards": round(delay_hours, 2),
-                            "Hores Efectives": round(effective_hours, 2),
-                            "% Assistència": f"{round(pct, 2)}%"
-                        })
-                        
-                        # Generate Warning
-                        if pct >= 15:
-                            warning_type = ""
-                            if pct >= 25:
-                                warning_type = "25%"
-                            elif pct >= 15:
-                                warning_type = "15%"
-                                
-                            if warning_type:
-                                warnings.append({
-                                    "Data Avís": processing_date,
-                                    "Alumne": student,
-                                    "Grup": group_name,
-                                    "Assignatura": "GLOBAL (Còmput Total)",
-                                    "Cicle (Detectat)": c_code,
-                                    "Hores Faltes (Reals)": round(abs_hours, 2),
-                                    "Hores Retards": round(delay_hours, 2),
-                                    "Hores Efectives (F + R/3)": round(effective_hours, 2),
-                                    "Hores Totals Mòdul": total_cycle_hours,
-                                    "% Actual": f"{round(pct, 1)}%",
-                                    "Tipus Avís": warning_type
-                                })
-
-                    # --- RESULTS DISPLAY ---
-                    
-                    # 1. SUMMARY REPORT
-                    if summary_data:
-                        with st.expander("📊 Resum de Faltes i Retards (Tots els alumnes)", expanded=False):
-                            df_summary = pd.DataFrame(summary_data)
-                            # Reorder cols
-                            cols = ["Alumne", "Cicle", "Grup", "Assignatura", "Hores Totals", "Hores Faltes", "Hores Retards", "Hores Efectives", "% Assistència"]
-                            st.dataframe(df_summary[cols], use_container_width=True)
-    
-                    # 2. WARNINGS
-                    st.subheader("⚠️ Avisos Generats (>15% i >25%)")
-                    if warnings:
-                        # --- Persistence Logic ---
-                        # Uses GLOBAL load_history/save_history (Firebase)
-    
-                        history = load_history()
-                        
-                        # Add unique ID for tracking
-                        # ID = Student + Module + Type (e.g., "John Doe_Math_15%")
-                        # We store: {ID: {notified: True, date: ...}}
-                        
-                        res_df = pd.DataFrame(warnings)
-                        
-                        # Create IDs (Composite Key)
-                        res_df['Avís ID'] = res_df['Alumne'] + "_" + res_df['Assignatura'] + "_" + res_df['Tipus Avís']
-                        
-                        # Map current history status
-                        res_df['Avís Enviat'] = res_df['Avís ID'].apply(lambda x: history.get(x, {}).get('notified', False))
-                        res_df['Data Enviament'] = res_df['Avís ID'].apply(lambda x: history.get(x, {}).get('last_update', ''))
+                # Only the history of these warnings is fetched, not the whole collection
+                with profiling.stage("history", rows=len(res_df)):
+                    history = load_history_for(res_df['Avís ID'].unique().tolist())
+
+                    # Map current history status
+                    status = history_store.status_frame(history, res_df['Avís ID'])
+                    res_df['Avís Enviat'] = status['notified'].to_numpy()
+                    res_df['Data Enviament'] = status['last_update'].to_numpy()
                         
-                        # Generate Gmail Links
-                        res_df['Link Gmail'] = res_df.apply(create_gmail_link, axis=1)
-    
-                        # --- FILTERS ---
-                        col1, col2, col3 = st.columns(3)
+                # --- FILTERS ---
+                col1, col2, col3 = st.columns(3)
                         
-                        with col1:
-                            # Filter by Cycle/Group
-                            all_groups = sorted(res_df['Grup'].unique())
-                            sel_groups = st.multiselect("Filtrar per Grup", all_groups)
+                with col1:
+                    # Filter by Cycle/Group
+                    all_groups = sorted(res_df['Grup'].unique())
+                    sel_groups = st.multiselect("Filtrar per Grup", all_groups)
                         
-                        with col2:
-                            # Filter by Student
-                            # If group is selected, filter students
-                            if sel_groups:
-                                avail_students = sorted(res_df[res_df['Grup'].isin(sel_groups)]['Alumne'].unique())
-                            else:
-                                avail_students = sorted(res_df['Alumne'].unique())
-                            sel_students = st.multiselect("Filtrar per Alumne", avail_students)
+                with col2:
+                    # Filter by Student
+                    # If group is selected, filter students
+                    if sel_groups:
+                        avail_students = sorted(res_df[res_df['Grup'].isin(sel_groups)]['Alumne'].unique())
+                    else:
+                        avail_students = sorted(res_df['Alumne'].unique())
+                    sel_students = st.multiselect("Filtrar per Alumne", avail_students)
                             
-                        with col3:
-                             # Filter by Subject
-                            avail_subjs = sorted(res_df['Assignatura'].unique())
-                            sel_subjs = st.multiselect("Filtrar per Assignatura", avail_subjs)
+                with col3:
+                     # Filter by Subject
+                    avail_subjs = sorted(res_df['Assignatura'].unique())
+                    sel_subjs = st.multiselect("Filtrar per Assignatura", avail_subjs)
                         
-                        # Apply Filters
-                        filtered_df = res_df.copy()
-                        if sel_groups:
-                            filtered_df = filtered_df[filtered_df['Grup'].isin(sel_groups)]
-                        if sel_students:
-                            filtered_df = filtered_df[filtered_df['Alumne'].isin(sel_students)]
-                        if sel_subjs:
-                            filtered_df = filtered_df[filtered_df['Assignatura'].isin(sel_subjs)]
+                if new_warnings:
+                    only_new = st.checkbox("🆕 Mostrar només els avisos nous")
+                else:
+                    only_new = False
+                        
+                # Apply Filters
+                filtered_df = res_df.copy()
+                if only_new:
+                    filtered_df = filtered_df[filtered_df['Avís ID'].isin(new_warnings)]
+                if sel_groups:
+                    filtered_df = filtered_df[filtered_df['Grup'].isin(sel_groups)]
+                if sel_students:
+                    filtered_df = filtered_df[filtered_df['Alumne'].isin(sel_students)]
+                if sel_subjs:
+                    filtered_df = filtered_df[filtered_df['Assignatura'].isin(sel_subjs)]
     
-                        st.markdown(f"**Mostrant {len(filtered_df)} avisos de {len(res_df)} totals.**")
-                        
-                        # Reorder columns for clarity
-                        # Checkbox FIRST, then Timestamp
-                        # We HIDE 'Link Gmail' to force usage of Checkbox for "Send + Mark" workflow
-                        cols_order = [
-                            "Avís Enviat", 
-                            "Data Enviament",
-                            "Data Avís", "Alumne", "Grup", "Assignatura", "Cicle (Detectat)",
-                            "Hores Totals Mòdul", 
-                            "Hores Faltes (Reals)", "Hores Retards", "Hores Efectives (F + R/3)",
-                            "% Actual", "Tipus Avís",
-                            "Avís ID",
-                            "Link Gmail" # Kept in df for logic, but will be hidden in editor
-                        ]
-                        
-                        # Columns to actually show in editor
-                        # We exclude 'Link Gmail' explicitly from user view to avoid confusion
-                        show_cols = [c for c in cols_order if c != "Link Gmail" and c in filtered_df.columns]
-                        
-                        # Use Data Editor for interactivity on the FILTERED dataframe
-                        edited_df = st.data_editor(
-                            filtered_df[show_cols], 
-                            column_config={
-                                "Avís Enviat": st.column_config.CheckboxColumn(
-                                    "✅ Enviat / 📧 Enviar",
-                                    help="Marca aquesta casella per GUARDAR l'estat i OBRIR automàticament el correu a Gmail.",
-                                    default=False,
-                                ),
-                                "Data Enviament": st.column_config.TextColumn(
-                                    "Data Enviament",
-                                    disabled=True # Read-only
-                                )
-                            },
-                            disabled=[c for c in show_cols if c != "Avís Enviat"], # Only checkbox editable
-                            use_container_width=True,
-                            hide_index=True,
-                            key="warnings_editor"
-                        )
-                        
-                        # Detect Changes and Save
-                        # IMPORTANT: We must compare against filtered_df processing, but update HISTORY globally
-                        
-                        # We need to reconstruct the full df to compare, or just iterate changes
-                        # Since we only edited 'Avís Enviat', we can track differences
-                        
-                        # Logic to detect changes in 'Avís Enviat' specifically
-                        # We iterate the edited_df (which is a subset)
-                        
-                        # To correctly map back, we rely on 'Avís ID' being present in show_cols
-                        
-                        changes_made = False
-                        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                        # Check generic diff to avoid unnecessary loops if nothing changed
-                        if not filtered_df[show_cols].equals(edited_df):
-                            # Start with empty dict for updates if we want to be clean, 
-                            # but save_history(full_history) needs full dict or we adapt save_history.
-                            # Our save_history implementation handles a dict of {id: data}.
-                            # Since 'history' is the full dict, it's fine.
-                            
-                            for index, row in edited_df.iterrows():
-                                wid = row['Avís ID']
-                                is_checked = row['Avís Enviat']
-                                
-                                # Check against stored
-                                stored_info = history.get(wid, {})
-                                stored_status = stored_info.get('notified', False)
-                                
-                                if is_checked != stored_status:
-                                    # Update history
-                                    new_entry = {
-                                        "notified": is_checked,
-                                        "student": row['Alumne'],
-                                        "subject": row['Assignatura'],
-                                        "group": row['Grup'],
-                                        "cycle": row['Cicle (Detectat)'],
-                                        "pct": row['% Actual'],
-                                        "type": row['Tipus Avís'],
-                                        "last_update": stored_info.get('last_update', '')
-                                    }
-                                    
-                                    if is_checked:
-                                        new_entry["last_update"] = current_time
-                                        # TRIGGER AUTO-OPEN GMAIL
-                                        # Regenerate link for this specific row
-                                        # We need to find the original row data including hidden cols like 'Link Gmail' logic
-                                        # But 'Link Gmail' is computable from row data we have in edited_df? 
-                                        # No, create_gmail_link needs 'Assignatura', 'Tipus Avís', etc. 
-                                        # Fortunately edited_df has these columns (just read-only).
-                                        gmail_link = create_gmail_link(row)
-                                        st.session_state["auto_open_gmail"] = gmail_link
-                                    else:
-                                        new_entry["last_update"] = ""
-                                        
-                                    history[wid] = new_entry
-                                    # We can optimize by only passing 'new_entry' to save_history if we change its signature
-                                    # but current save_history iterates the whole dict provided.
-                                    # Let's fix save_history call to be efficient or accept that it iterates.
-                                    # Actually, let's just pass {wid: new_entry} to save_history?
-                                    # No, let's keep it simple: Pass only UPDATES
-                                    save_history({wid: new_entry})
-                                    changes_made = True
-                            
-                            if changes_made:
-                                st.rerun()
+                st.markdown(f"**Mostrant {len(filtered_df)} avisos de {len(res_df)} totals.**")
+                        
+                # Reorder columns for clarity
+                # Checkbox FIRST, then Timestamp
+                # No 'Link Gmail' column: the checkbox drives the "Send + Mark" workflow
+                cols_order = [
+                    "Avís Enviat", 
+                    "Data Enviament",
+                    "Data Avís", "Alumne", "Grup", "Assignatura", "Cicle (Detectat)",
+                    "Hores Totals Mòdul", 
+                    "Hores Faltes (Reals)", "Hores Retards", "Hores Efectives (F + R/3)",
+                    "% Actual", "Tipus Avís",
+                    "Avís ID",
+                ]
+                        
+                # Columns to actually show in editor
+                show_cols = [c for c in cols_order if c in filtered_df.columns]
+                        
+                # Use Data Editor for interactivity on the FILTERED dataframe
+                with profiling.stage("editor", rows=len(filtered_df)):
+                    st.data_editor(
+                        filtered_df[show_cols], 
+                        column_config={
+                            "Avís Enviat": st.column_config.CheckboxColumn(
+                                "✅ Enviat / 📧 Enviar",
+                                help="Marca aquesta casella per GUARDAR l'estat i OBRIR automàticament el correu a Gmail.",
+                                default=False,
+                            ),
+                            "Data Enviament": st.column_config.TextColumn(
+                                "Data Enviament",
+                                disabled=True # Read-only
+                            )
+                        },
+                        disabled=[c for c in show_cols if c != "Avís Enviat"], # Only checkbox editable
+                        use_container_width=True,
+                        hide_index=True,
+                        key="warnings_editor"
+                    )
+                        
+                # Detect Changes and Save
+                # The editor records its edits as {row position: {column: new value}}; only
+                # those rows are checked against the stored history, and all the changes of
+                # this interaction are queued as one batch
+                edited_rows = st.session_state.get("warnings_editor", {}).get("edited_rows", {})
+                updates = {}
+                current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+                with profiling.stage("editor_changes", rows=len(edited_rows)):
+                    for pos, changes in edited_rows.items():
+                        if "Avís Enviat" not in changes or pos >= len(filtered_df):
+                            continue
+                        row = filtered_df.iloc[pos]
+                        wid = row['Avís ID']
+                        is_checked = bool(changes["Avís Enviat"])
+
+                        # Check against stored
+                        stored_info = history.get(wid, {})
+                        stored_status = stored_info.get('notified', False)
+
+                        if is_checked != stored_status:
+                            # Update history
+                            new_entry = {
+                                "notified": is_checked,
+                                "student": row['Alumne'],
+                                "subject": row['Assignatura'],
+                                "group": row['Grup'],
+                                "cycle": row['Cicle (Detectat)'],
+                                "pct": row['% Actual'],
+                                "type": row['Tipus Avís'],
+                                "last_update": current_time if is_checked else ""
+                            }
+
+                            if is_checked:
+                                # TRIGGER AUTO-OPEN GMAIL
+                                # Link rendered for this row only
+                                st.session_state["auto_open_gmail"] = templates.gmail_link(row)
+
+                            history[wid] = new_entry
+                            updates[wid] = new_entry
+
+                if updates:
+                    save_history(updates)
+                    st.rerun()
     
-                        # --- ROBUST EMAIL ACTION ---
-                        st.divider()
-                        st.subheader("📧 Generador de Correus")
-                        st.info("Si prefereixes enviar-ho manualment sense fer servir la taula:")
-                        
-                        # Create a list of options: "Student - Subject (Type)"
-                        # We need to map back to the dataframe row
-                        email_options = filtered_df.apply(lambda x: f"{x['Alumne']} - {x['Assignatura']} ({x['Tipus Avís']})", axis=1).tolist()
-                        
-                        if email_options:
-                            selected_option = st.selectbox("Selecciona l'alumne per enviar l'avís:", email_options)
-                            
-                            # Find the row
-                            selected_row = None
-                            for idx, row in filtered_df.iterrows():
-                                opt_str = f"{row['Alumne']} - {row['Assignatura']} ({row['Tipus Avís']})"
-                                if opt_str == selected_option:
-                                    selected_row = row
-                                    break
+                # --- ROBUST EMAIL ACTION ---
+                st.divider()
+                st.subheader("📧 Generador de Correus")
+                st.info("Si prefereixes enviar-ho manualment sense fer servir la taula:")
+                        
+                # Options are warning IDs: "Student - Subject (Type)" labels and row positions
+                # are built once, so showing and picking a row are dict lookups
+                email_df = filtered_df[~filtered_df['Avís ID'].duplicated()]
+                email_labels = dict(zip(
+                    email_df['Avís ID'],
+                    email_df['Alumne'].astype(str) + " - " + email_df['Assignatura'].astype(str) + " (" + email_df['Tipus Avís'].astype(str) + ")",
+                ))
+                email_rows = dict(zip(email_df['Avís ID'], range(len(email_df))))
+                        
+                if email_labels:
+                    selected_id = st.selectbox("Selecciona l'alumne per enviar l'avís:", list(email_labels), format_func=email_labels.get)
+                    selected_row = email_df.iloc[email_rows[selected_id]] if selected_id in email_rows else None
                             
-                            if selected_row is not None:
-                                # Logic: Button that MARKS and OPENS
-                                if st.button(f"📧 Enviar i Marcar com a Enviat ({selected_row['Alumne']})", type="primary", use_container_width=True):
-                                    # 1. Update History
-                                    wid = selected_row['Avís ID']
-                                    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    if selected_row is not None:
+                        # Logic: Button that MARKS and OPENS
+                        if st.button(f"📧 Enviar i Marcar com a Enviat ({selected_row['Alumne']})", type="primary", use_container_width=True):
+                            # 1. Update History
+                            wid = selected_row['Avís ID']
+                            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                                     
-                                    new_entry = {
-                                        "notified": True,
-                                        "student": selected_row['Alumne'],
-                                        "subject": selected_row['Assignatura'],
-                                        "group": selected_row['Grup'],
-                                        "cycle": selected_row['Cicle (Detectat)'],
-                                        "pct": selected_row['% Actual'],
-                                        "type": selected_row['Tipus Avís'],
-                                        "last_update": current_time
-                                    }
-                                    history[wid] = new_entry
-                                    save_history({wid: new_entry}) # Pass update only
+                            new_entry = {
+                                "notified": True,
+                                "student": selected_row['Alumne'],
+                                "subject": selected_row['Assignatura'],
+                                "group": selected_row['Grup'],
+                                "cycle": selected_row['Cicle (Detectat)'],
+                                "pct": selected_row['% Actual'],
+                                "type": selected_row['Tipus Avís'],
+                                "last_update": current_time
+                            }
+                            history[wid] = new_entry
+                            save_history({wid: new_entry}) # Pass update only
                                     
-                                    # 2. Trigger Auto Open
-                                    gmail_link = create_gmail_link(selected_row)
-                                    st.session_state["auto_open_gmail"] = gmail_link
-                                    st.rerun()
+                            # 2. Trigger Auto Open
+                            gmail_link = templates.gmail_link(selected_row)
+                            st.session_state["auto_open_gmail"] = gmail_link
+                            st.rerun()
                                     
+                else:
+                    st.write("No hi ha avisos per mostrar.")
+
+                # --- BULK OUTBOX ---
+                st.divider()
+                pending_df = filtered_df[~filtered_df['Avís Enviat']]
+                with st.expander(f"📤 Enviament massiu ({len(pending_df)} avisos pendents)", expanded=False):
+                    st.caption("Genera tots els correus pendents dels avisos filtrats, per descarregar-los o enviar-los per SMTP.")
+
+                    def sent_updates(wids):
+                        # All the marked warnings go to history in one batch
+                        sent_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                        rows = pending_df.set_index('Avís ID').loc[list(wids)]
+                        updates = {}
+                        for wid, row in rows.iterrows():
+                            updates[wid] = {
+                                "notified": True,
+                                "student": row['Alumne'],
+                                "subject": row['Assignatura'],
+                                "group": row['Grup'],
+                                "cycle": row['Cicle (Detectat)'],
+                                "pct": row['% Actual'],
+                                "type": row['Tipus Avís'],
+                                "last_update": sent_time
+                            }
+                        return updates
+
+                    # Messages are only rendered while the outbox is open (not on every rerun)
+                    if not pending_df.empty and st.toggle("Preparar els correus", key="outbox_open"):
+                        recipients_file = st.file_uploader("Correus dels alumnes (CSV amb columnes Alumne, Correu) - opcional", type=["csv"], key="outbox_recipients")
+                        recipients = {}
+                        if recipients_file is not None:
+                            try:
+                                recipients = outbox.load_recipients(recipients_file)
+                            except Exception as e:
+                                st.error(f"❌ {e}")
+
+                        smtp_settings = get_smtp_settings()
+                        sender = (smtp_settings or {}).get("sender")
+                        with profiling.stage("outbox", rows=len(pending_df)):
+                            messages = outbox.build_messages(pending_df, templates, sender=sender, recipients=recipients)
+                        with_recipient = [(wid, msg) for wid, msg in messages if msg["To"]]
+                        if recipients_file is not None:
+                            st.markdown(f"**{len(with_recipient)} de {len(messages)} avisos amb adreça de correu.**")
+
+                        out_format = st.radio("Format", ["Fitxers .eml (ZIP)", "Bústia mbox"], horizontal=True, key="outbox_format")
+                        if out_format == "Bústia mbox":
+                            st.download_button("📥 Descarregar mbox", outbox.mbox_bytes(messages), "avisos_pendents.mbox", "application/mbox")
                         else:
-                            st.write("No hi ha avisos per mostrar.")
+                            st.download_button("📥 Descarregar .eml (ZIP)", outbox.eml_zip(messages), "avisos_pendents.zip", "application/zip")
+
+                        if st.button(f"✅ Marcar els {len(messages)} avisos com a enviats"):
+                            save_history(sent_updates(wid for wid, _ in messages))
+                            st.rerun()
+
+                        if smtp_settings is None:
+                            st.info("Per enviar directament, configura el servidor SMTP a Secrets ([smtp]).")
+                        elif not with_recipient:
+                            st.info("Puja el fitxer de correus per poder enviar per SMTP.")
+                        elif st.button(f"📧 Enviar {len(with_recipient)} correus per SMTP", type="primary"):
+                            pool = outbox.SMTPPool(
+                                smtp_settings["host"],
+                                port=smtp_settings.get("port", outbox.SMTP_PORT),
+                                username=smtp_settings.get("username"),
+                                password=smtp_settings.get("password"),
+                                security=smtp_settings.get("security", "starttls"),
+                                connections=smtp_settings.get("connections", outbox.SMTP_CONNECTIONS),
+                                per_minute=smtp_settings.get("per_minute", outbox.SMTP_PER_MINUTE),
+                            )
+                            progress_bar = st.progress(0.0, text="Enviant correus...")
+                            # Sent warnings are marked even if a click interrupts the progress updates
+                            # (the queued emails still go out), so they are never sent twice. That may
+                            # happen while the script is stopping: only queue_history runs then.
+                            sync, store = active_history_sync(), get_local_store()
+                            st.session_state["history_changed"] = True
+                            sent, failed = pool.send_all(
+                                with_recipient,
+                                progress=lambda done, total: progress_bar.progress(done / total, text=f"Enviant correus... {done}/{total}"),
+                                on_finish=lambda sent, failed: queue_history(sent_updates(sent), sync, store) if sent else None,
+                            )
+                            clear_history_caches()
+                            if sent:
+                                st.success(f"✅ {len(sent)} correus enviats i marcats com a enviats.")
+                            if failed:
+                                st.error(f"❌ {len(failed)} correus no s'han pogut enviar: {next(iter(failed.values()))}")
 
-                        st.divider()
-                        csv = filtered_df.to_csv(index=False).encode('utf-8')
-                        st.download_button("📥 Descarregar CSV", csv, "avisos_assistencia.csv", "text/csv")
-                    else:
-                        st.success("✅ No s'han detectat alumnes que superin el 15% de faltes.")
+                st.divider()
+                with profiling.stage("csv", rows=len(filtered_df)):
+                    export_df = filtered_df.assign(**{'Link Gmail': templates.gmail_links(filtered_df)})
+                    csv = export_df.to_csv(index=False).encode('utf-8')
+                st.download_button("📥 Descarregar CSV", csv, "avisos_assistencia.csv", "text/csv")
+            else:
+                st.success("✅ No s'han detectat alumnes que superin el 15% de faltes.")
                         
         except Exception as e:
             st.error(f"Error processant el fitxer: {e}")
+
+# --- Profiling panel (runs that end in st.rerun/st.stop are not recorded) ---
+run_record = profile.finish()
+if run_record is not None:
+    profile_runs = st.session_state.setdefault("profile_runs", [])
+    profile_runs.append(run_record)
+    del profile_runs[:-profiling.MAX_RUNS]
+if st.session_state["profiling"]:
+    with profile_panel:
+        show_profile(st.session_state.get("profile_runs", []))
+with usage_panel:
+    show_firestore_usage(get_usage_meter(), get_usage_budget(), st.session_state["session_id"])
@@ -0,0 +1,167 @@
+"""
+Stage-by-stage benchmark of the analysis pipeline on synthetic exports.
+
+For each size, a workbook is generated once with generate_export (kept in
+--data-dir and reused by later runs) and every stage of engine.analyze is timed
+on its own: Excel ingest, reload from the columnar cache, derived columns, row
+filtering, duration parsing, subject normalization, records, aggregation, cycle
+resolution, subject resolution and warning generation. Each stage runs --repeat
+times and the median is kept.
+
+Results are written as JSON so runs can be compared; with --baseline the stages
+that got slower by more than --tolerance are listed and the exit code is 1.
+
+Usage:
+    python benchmark.py [--sizes 10000 100000 1000000] [--repeat 3] [--out bench_results.json]
+                        [--baseline bench_results_old.json] [--tolerance 0.2]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import engine
+import generate_export
+import ingest
+import parsed_cache
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+DATA_DIR = 'synthetic_exports'
+RESULTS_FILE = 'bench_results.json'
+PROCESSING_DATE = "01/06/2026"
+
+
+def timed(func, repeat):
+    """(median seconds, runs, result of the last run)."""
+    runs = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+    return statistics.median(runs), runs, result
+
+
+def export_path(rows, full_config, data_dir=DATA_DIR, seed=1):
+    """Synthetic export with `rows` incidences, generated on first use."""
+    path = os.path.join(data_dir, f"synthetic_{rows}_s{seed}.xlsx")
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        generate_export.write_export(generate_export.generate(rows, full_config, seed=seed), path)
+    return path
+
+
+def bench_size(path, full_config, repeat=3):
+    stages = {}
+
+    def stage(name, func, times=repeat):
+        median, runs, result = timed(func, times)
+        stages[name] = {"seconds": round(median, 4), "runs": [round(r, 4) for r in runs]}
+        return result
+
+    # Parsing is by far the slowest stage: timed once
+    raw = stage("ingest", lambda: ingest.read_export(path), times=1)
+    with open(path, 'rb') as f:
+        upload = [(os.path.basename(path), f.read())]
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = parsed_cache.ParsedExportCache(tmp)
+        parsed_cache.read_exports(upload, cache=cache)
+        stage("ingest_cached", lambda: parsed_cache.read_exports(upload, cache=cache))
+
+    df = stage("derive", lambda: engine.derive_columns(raw.copy()))
+    grup_col = engine.validate_columns(df)
+    mask = stage("filter", lambda: engine.valid_rows(df))
+    counted = df[mask]
+    stage("durations", lambda: engine.slot_hours(raw.loc[mask, 'Hora']))
+    stage("normalize", lambda: engine.normalize_subjects(counted))
+    records, _ = stage("records", lambda: engine.prepare_records(df, grup_col))
+    combos = stage("aggregate", lambda: engine.aggregate_hours(records))
+
+    # Resolution and thresholds add columns to the combinations: each run gets a copy
+    stage("cycles", lambda: engine.resolve_cycles(combos.copy(), full_config))
+    engine.resolve_cycles(combos, full_config)
+    stage("subjects", lambda: engine.resolve_subject_hours(combos.copy(), full_config))
+    engine.resolve_subject_hours(combos, full_config)
+    _, warnings_df = stage("warnings", lambda: engine.apply_thresholds(combos.copy(), full_config, PROCESSING_DATE))
+
+    stage("analyze", lambda: engine.analyze(df, full_config, processing_date=PROCESSING_DATE))
+
+    return {
+        "rows": len(raw),
+        "file_bytes": os.path.getsize(path),
+        "records": len(records),
+        "combinations": len(combos),
+        "warnings": len(warnings_df),
+        "records_bytes": int(records.memory_usage(deep=True).sum()),
+        "stages": stages,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Stages slower than the baseline by more than tolerance, as printable lines."""
+    previous = {entry["rows"]: entry["stages"] for entry in baseline.get("sizes", [])}
+    slower = []
+    for entry in results["sizes"]:
+        for name, timing in entry["stages"].items():
+            before = previous.get(entry["rows"], {}).get(name)
+            if before and before["seconds"] > 0:
+                ratio = timing["seconds"] / before["seconds"]
+                if ratio > 1 + tolerance:
+                    slower.append(f"{entry['rows']} files, {name}: {before['seconds']:.3f}s -> {timing['seconds']:.3f}s (x{ratio:.2f})")
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mesura el temps de cada etapa de l'anàlisi amb exportacions sintètiques.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Nombre de files de cada exportació")
+    parser.add_argument("--repeat", type=int, default=3, help="Execucions de cada etapa (es guarda la mediana)")
+    parser.add_argument("--config", default=engine.CONFIG_FILE, help="Fitxer de configuració d'hores per cicle")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Directori de les exportacions generades")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default=RESULTS_FILE, help="Fitxer JSON de resultats")
+    parser.add_argument("--baseline", help="Resultats anteriors amb què comparar")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Alentiment admès respecte a la referència (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    full_config = engine.load_config(args.config)
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "sizes": [],
+    }
+    for rows in args.sizes:
+        path = export_path(rows, full_config, args.data_dir, args.seed)
+        entry = bench_size(path, full_config, args.repeat)
+        results["sizes"].append(entry)
+        print(f"{rows} files:")
+        for name, timing in entry["stages"].items():
+            print(f"  {name:<14}{timing['seconds']:>9.3f}s")
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Resultats desats a {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for line in slower:
+            print(f"Més lent: {line}", file=sys.stderr)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+Warning emails, from the templates in email_templates.json.
+
+Templates are keyed by (stage, type): the stage (ESO, BATX, PFI or FP) comes from the
+detected cycle and the type is "15%" or "25%". They are compiled once per process and
+shared by the Gmail links of the Gestió page (rendered only for the row being sent),
+the links of the CSV export and the bulk outbox (rendered in bulk, per template) and
+the previews of the "Models de Correu" page.
+
+Placeholders: {student}, {group}, {subject}, {absence_hours}, {delay_hours}, {pct}.
+"""
+import json
+import string
+import urllib.parse
+from functools import lru_cache
+
+import pandas as pd
+
+TEMPLATES_FILE = 'email_templates.json'
+
+GMAIL_COMPOSE_URL = "https://mail.google.com/mail/?view=cm&fs=1"
+
+# Placeholder -> column of the warnings table
+FIELDS = {
+    "student": "Alumne",
+    "group": "Grup",
+    "subject": "Assignatura",
+    "absence_hours": "Hores Faltes (Reals)",
+    "delay_hours": "Hores Retards",
+    "pct": "% Actual",
+}
+
+# Placeholder values shown on the "Models de Correu" page
+PREVIEW_VALUES = {
+    "student": "[Nom de l'Alumne]",
+    "group": "[Grup]",
+    "subject": "[Assignatura]",
+    "absence_hours": "[X]",
+    "delay_hours": "[X]",
+    "pct": "[X]%",
+}
+
+
+def stage_for_cycle(cycle):
+    """Template stage of a detected cycle code."""
+    cycle = cycle if isinstance(cycle, str) else ''
+    if cycle in ["3 ESO", "4 ESO"]:
+        return "ESO"
+    if "BATX" in cycle:
+        return "BATX"
+    if "PFI" in cycle:
+        return "PFI"
+    return "FP"
+
+
+def template_type(warning_type):
+    return "25%" if warning_type == "25%" else "15%"
+
+
+def _quote_column(values):
+    # Each distinct value is encoded once
+    encoded = {v: urllib.parse.quote_plus(v) for v in set(values)}
+    return [encoded[v] for v in values]
+
+
+class Template:
+    """
+    A template string parsed once into (literal, placeholder) parts.
+    Literals are also kept URL-encoded: quote_plus works character by character, so
+    the encoded template is the encoded literals joined with the encoded values.
+    """
+
+    def __init__(self, text):
+        self.parts = []
+        for literal, field, _, _ in string.Formatter().parse(text):
+            if field is not None and field not in FIELDS:
+                raise ValueError(f"Camp desconegut a la plantilla: {{{field}}}")
+            self.parts.append((literal, field))
+        self.quoted_parts = [(urllib.parse.quote_plus(lit), field) for lit, field in self.parts]
+
+    def render(self, values):
+        return "".join(lit + (str(values[f]) if f is not None else "") for lit, f in self.parts)
+
+    def render_frame(self, df, quoted=False):
+        """Renders every row of a warnings DataFrame; quoted=True returns the URL-encoded texts."""
+        columns = {}
+        for _, field in self.parts:
+            if field is not None and field not in columns:
+                text = df[FIELDS[field]].astype(str).tolist()
+                columns[field] = _quote_column(text) if quoted else text
+        pieces = []
+        for literal, field in (self.quoted_parts if quoted else self.parts):
+            if literal:
+                pieces.append([literal] * len(df))
+            if field is not None:
+                pieces.append(columns[field])
+        return ["".join(parts) for parts in zip(*pieces)] if pieces else [""] * len(df)
+
+
+def gmail_url(subject, body):
+    # Same encoding as urllib.parse.urlencode, without its per-call overhead
+    quote = urllib.parse.quote_plus
+    return f"{GMAIL_COMPOSE_URL}&su={quote(subject)}&body={quote(body)}"
+
+
+class EmailTemplates:
+    """Compiled templates of a templates file."""
+
+    def __init__(self, spec):
+        self.stages = spec["stages"]
+        self.compiled = {}
+        for stage, stage_spec in self.stages.items():
+            for wtype, tpl in stage_spec["templates"].items():
+                self.compiled[(stage, wtype)] = (Template(tpl["subject"]), Template("\n".join(tpl["body"])))
+
+    def render(self, row):
+        """(subject, body) of the email for one warning row."""
+        subject_tpl, body_tpl = self.compiled[(stage_for_cycle(row.get('Cicle (Detectat)', '')), template_type(row['Tipus Avís']))]
+        values = {field: row[col] for field, col in FIELDS.items()}
+        return subject_tpl.render(values), body_tpl.render(values)
+
+    def gmail_link(self, row):
+        """Gmail compose URL for one warning row."""
+        return gmail_url(*self.render(row))
+
+    def _render_groups(self, df, quoted=False):
+        # Rows sharing a template are rendered together
+        stages = df['Cicle (Detectat)'].map(stage_for_cycle)
+        types = df['Tipus Avís'].map(template_type)
+        for key, rows in df.groupby([stages, types], sort=False):
+            subject_tpl, body_tpl = self.compiled[key]
+            yield rows.index, subject_tpl.render_frame(rows, quoted), body_tpl.render_frame(rows, quoted)
+
+    def render_all(self, df):
+        """Subjects and bodies for every row of a warnings DataFrame, as two Series aligned with df."""
+        subjects = pd.Series("", index=df.index, dtype=object)
+        bodies = pd.Series("", index=df.index, dtype=object)
+        for index, group_subjects, group_bodies in self._render_groups(df):
+            subjects[index] = group_subjects
+            bodies[index] = group_bodies
+        return subjects, bodies
+
+    def gmail_links(self, df):
+        """Gmail compose URLs for every row of a warnings DataFrame, rendered per (stage, type)."""
+        links = pd.Series("", index=df.index, dtype=object)
+        for index, subjects, bodies in self._render_groups(df, quoted=True):
+            links[index] = [f"{GMAIL_COMPOSE_URL}&su={su}&body={bo}" for su, bo in zip(subjects, bodies)]
+        return links
+
+    def preview(self, stage, wtype):
+        """Template text with placeholder values, as shown on the "Models de Correu" page."""
+        subject_tpl, body_tpl = self.compiled[(stage, wtype)]
+        return f"Assumpte: {subject_tpl.render(PREVIEW_VALUES)}\n\n{body_tpl.render(PREVIEW_VALUES)}"
+
+
+@lru_cache(maxsize=4)
+def load_templates(path=TEMPLATES_FILE):
+    """Templates compiled once per file and shared by every session."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return EmailTemplates(json.load(f))
@@ -0,0 +1,544 @@
+"""
+Headless attendance-analysis engine.
+
+Everything the "Gestió d'Avisos" page computes from an Excel export lives here,
+so it can run outside of Streamlit (batch runs, benchmarks, caching).
+
+Usage:
+    python engine.py export.xlsx [more.xlsx ...] [--config modules_config.json] [--out-dir .] [--snapshot export_snapshot.pkl]
+                            [--parse-cache .parsed_cache | --no-parse-cache] [--memory]
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import profiling
+from ingest import ExportFormatError, find_group_column
+from resolvers import (
+    MATCH_AMBIGUOUS, UNRESOLVED, get_cycle_resolver, get_subject_index,
+)
+
+CONFIG_FILE = 'modules_config.json'
+
+# Codes: F, FJ, FJP (Absences); R, RJ, RJP (Delays)
+ABSENCE_CODES = ['F', 'FJ', 'FJP']
+DELAY_CODES = ['R', 'RJ', 'RJP']
+VALID_TYPES = ABSENCE_CODES + DELAY_CODES
+
+REQUIRED_COLUMNS = ['Alumne/a', 'Tipus', 'Hora', 'Assignatura']
+# One summary row per (Student, Subject, Group)
+COMBO_KEYS = ['Alumne/a', 'Assignatura', 'Grup_Clean']
+
+# Columns of the records frame; the others (teacher, comment, date...) are dropped before copying
+RECORD_COLUMNS = COMBO_KEYS + ['Tipus_Clean', 'Durada', 'Category']
+# Few distinct values compared with the number of rows: kept as categoricals
+CATEGORY_COLUMNS = ['Alumne/a', 'Assignatura', 'Grup_Clean', 'Tipus_Clean', 'Category']
+
+# PFI & ESO/BATX are "Global" cycles: attendance is calculated on TOTAL hours, not per module.
+GLOBAL_CYCLES = ["PFIPER", "PFICOM", "3 ESO", "4 ESO", "1 BATX", "2 BATX"]
+GLOBAL_SUBJECT = "GLOBAL (Còmput Total)"
+UNKNOWN_CYCLE = "Desconegut"
+EMPTY_SLOT = "(buit)"
+
+SUMMARY_COLUMNS = [
+    "Alumne", "Cicle", "Grup", "Assignatura", "Hores Totals",
+    "Hores Faltes", "Hores Retards", "Hores Efectives", "% Assistència"
+]
+WARNING_COLUMNS = [
+    "Data Avís", "Alumne", "Grup", "Assignatura", "Cicle (Detectat)",
+    "Hores Faltes (Reals)", "Hores Retards", "Hores Efectives (F + R/3)",
+    "Hores Totals Mòdul", "% Actual", "Tipus Avís"
+]
+
+
+def load_config(path=CONFIG_FILE):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def slot_duration(time_range_srt):
+    """Hours in a "HH:MM-HH:MM" slot, or None if it cannot be parsed."""
+    try:
+        start_str, end_str = time_range_srt.split('-')
+        fmt = '%H:%M'
+        t_start = datetime.strptime(start_str.strip(), fmt)
+        t_end = datetime.strptime(end_str.strip(), fmt)
+        return (t_end - t_start).total_seconds() / 3600
+    except Exception:
+        return None
+
+
+def slot_hours(hora):
+    """
+    Vectorized duration stage for the "Hora" column.
+
+    Each distinct slot is parsed once and the result is broadcast to every row;
+    empty cells and slots that cannot be parsed are left as NaN.
+    """
+    codes, uniques = pd.factorize(hora)
+    parsed = [slot_duration(v) if isinstance(v, str) else None for v in uniques]
+
+    # Last position catches empty cells (factorize code -1)
+    values = np.array([np.nan if d is None else d for d in parsed] + [np.nan])
+    return pd.Series(values[codes], index=hora.index, name=hora.name)
+
+
+def malformed_slots(hora, hours):
+    """Maps each slot left as NaN by slot_hours to its number of rows; empty cells appear as EMPTY_SLOT."""
+    codes, uniques = pd.factorize(hora[hours.isna()])
+    counts = np.bincount(codes + 1, minlength=len(uniques) + 1)
+    malformed = {}
+    if counts[0]:
+        malformed[EMPTY_SLOT] = int(counts[0])
+    for value, count in zip(uniques, counts[1:]):
+        malformed[str(value)] = int(count)
+    return malformed
+
+
+def normalize_subjects(records):
+    """Normalized Assignatura of every record (string checks run once per distinct group)."""
+    # Merge "Mòdul projecte" into "Projecte intermodular" for groups containing "EB" or "PER"
+    grup = records['Grup_Clean']
+    if not isinstance(grup.dtype, pd.CategoricalDtype):
+        grup = grup.astype('category')
+    merged = grup.str.contains("EB", regex=False) | grup.str.contains("PER", regex=False)
+    project = records['Assignatura'] == "Mòdul projecte"
+    return records['Assignatura'].astype(object).mask(merged.astype(bool) & project, "Projecte intermodular")
+
+
+def get_category(code):
+    if code in ABSENCE_CODES: return 'Absence'
+    if code in DELAY_CODES: return 'Delay'
+    return 'Other'
+
+
+def global_cycle_hours(full_config):
+    """Total yearly hours for each global cycle."""
+    global_total_hours = {}
+    for g_cycle in GLOBAL_CYCLES:
+        # Hardcoded defaults if missing in JSON, or specific overrides
+        if g_cycle in ("3 ESO", "4 ESO"):
+            global_total_hours[g_cycle] = 1080
+        elif g_cycle == "1 BATX":
+            # If in config, sum values. Otherwise typical fallback.
+            if g_cycle in full_config:
+                global_total_hours[g_cycle] = sum(full_config[g_cycle].values())
+            else:
+                global_total_hours[g_cycle] = 1020
+        elif g_cycle == "2 BATX":
+            global_total_hours[g_cycle] = 1020
+        elif g_cycle in full_config:
+            # For PFIs or others defined in JSON
+            global_total_hours[g_cycle] = sum(full_config[g_cycle].values())
+    return global_total_hours
+
+
+def validate_columns(df):
+    """Returns the group column name, raising ExportFormatError if the export is incomplete."""
+    missing = [c for c in REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        raise ExportFormatError(f"Falten columnes obligatòries a l'Excel: {', '.join(missing)}")
+
+    grup_col = find_group_column(df)
+    if not grup_col:
+        raise ExportFormatError("No s'ha trobat la columna 'Grup' (o 'Grup (incidència)'). No es pot determinar el cicle.")
+    return grup_col
+
+
+def aggregate_hours(records):
+    """
+    Absence, delay and effective hours for every (Alumne/a, Assignatura, Grup_Clean) combination.
+
+    A single groupby over the records pivoted on Category; combinations keep the
+    order in which they first appear in the export.
+    """
+    if records.empty:
+        empty = pd.DataFrame(columns=COMBO_KEYS + ['abs', 'delay', 'effective'])
+        return empty.astype({'abs': float, 'delay': float, 'effective': float})
+
+    grouped = records.groupby(COMBO_KEYS + ['Category'], observed=True)['Durada'].sum()
+    stats = grouped.unstack('Category', fill_value=0.0)
+    stats = stats.reindex(columns=['Absence', 'Delay'], fill_value=0.0)
+    stats.columns = ['abs', 'delay']
+
+    order = pd.MultiIndex.from_frame(records[COMBO_KEYS].drop_duplicates())
+    stats = stats.reindex(order).fillna(0.0)
+
+    # Formula: Effective = Absences + (Delays / 3)
+    stats['effective'] = stats['abs'] + (stats['delay'] / 3.0)
+    stats = stats.reset_index()
+    # Back to plain strings: combinations are few and feed the output tables
+    stats[COMBO_KEYS] = stats[COMBO_KEYS].astype(object)
+    return stats
+
+
+def format_pct(pct, digits):
+    # Combinations without configured hours show a plain "0%"
+    return pct.round(digits).map(lambda v: "0%" if pd.isna(v) else f"{v}%")
+
+
+def derive_columns(df):
+    """
+    Adds the columns that only depend on each row: Tipus_Clean, Grup_Clean and Durada
+    (slot_hours, NaN where the slot is malformed). prepare_records reuses them when
+    present, e.g. for exports loaded from parsed_cache.
+    """
+    if 'Tipus' in df.columns:
+        df['Tipus_Clean'] = df['Tipus'].astype(str).str.strip().astype('category')
+    grup_col = find_group_column(df)
+    if grup_col:
+        df['Grup_Clean'] = df[grup_col].astype(str).str.strip().astype('category')
+    if 'Hora' in df.columns:
+        df['Durada'] = slot_hours(df['Hora'])
+    return df
+
+
+def valid_rows(df):
+    """Mask of the rows with a counted type (use str.strip() to be safe)."""
+    if 'Tipus_Clean' in df.columns:
+        return df['Tipus_Clean'].isin(VALID_TYPES)
+    return df['Tipus'].astype(str).str.strip().isin(VALID_TYPES)
+
+
+def prepare_records(df, grup_col, known_subjects=None):
+    """
+    Counted rows of an export with the derived columns used by the aggregation
+    (Durada, Grup_Clean, Tipus_Clean, normalized Assignatura, Category).
+
+    Only RECORD_COLUMNS are kept, with the low-cardinality ones as categoricals.
+    Columns already added by derive_columns are reused. known_subjects optionally
+    holds already normalized subjects, aligned with df; only the rows where it is
+    missing are normalized here.
+    Returns (records, malformed_slots).
+    """
+    mask = valid_rows(df)
+    used = ['Alumne/a', 'Assignatura', 'Hora', 'Tipus', grup_col, 'Tipus_Clean', 'Grup_Clean', 'Durada']
+    records = df.loc[mask, [c for c in dict.fromkeys(used) if c in df.columns]]
+
+    hours = records['Durada'] if 'Durada' in records.columns else slot_hours(records['Hora'])
+    records['Durada'] = hours.fillna(0.0)
+    malformed = malformed_slots(records['Hora'], hours)
+    if 'Grup_Clean' not in records.columns:
+        records['Grup_Clean'] = records[grup_col].astype(str).str.strip()
+    if 'Tipus_Clean' not in records.columns:
+        records['Tipus_Clean'] = records['Tipus'].astype(str).str.strip()
+    if known_subjects is not None:
+        known = known_subjects[mask].astype(object)
+        todo = known.isna()
+        if todo.any():
+            known = known.copy()
+            known[todo] = normalize_subjects(records[todo])
+        records['Assignatura'] = known.astype(object)
+    else:
+        records['Assignatura'] = normalize_subjects(records)
+    records['Category'] = records['Tipus_Clean'].map(get_category)
+
+    records = records[RECORD_COLUMNS].astype({col: 'category' for col in CATEGORY_COLUMNS})
+    return records, malformed
+
+
+def memory_report(df, records):
+    """Deep memory use in bytes of an export and of its records frame (e.g. for `engine.py --memory`)."""
+    export_bytes = int(df.memory_usage(deep=True).sum())
+    # What the counted rows took as plain object columns, before pruning and categoricals
+    counted_bytes = int(df[valid_rows(df)].memory_usage(deep=True).sum())
+    return {
+        "export_bytes": export_bytes,
+        "counted_rows_bytes": counted_bytes,
+        "records_bytes": int(records.memory_usage(deep=True).sum()),
+    }
+
+
+def analyze(df, full_config, processing_date=None):
+    """
+    Computes the attendance summary and the 15%/25% warnings for an export.
+
+    Returns (summary_df, warnings_df, report): the DataFrames use SUMMARY_COLUMNS and
+    WARNING_COLUMNS, report holds data-quality findings (e.g. malformed "Hora" slots).
+    """
+    grup_col = validate_columns(df)
+    with profiling.stage("records", rows=len(df)):
+        records, malformed = prepare_records(df, grup_col)
+    with profiling.stage("aggregate", rows=len(records)) as stage:
+        combos = aggregate_hours(records)
+        stage.rows = len(combos)
+    with profiling.stage("evaluate", rows=len(combos)):
+        summary_df, warnings_df, findings = evaluate(combos, full_config, processing_date)
+    report = {"rows": len(df), "records": len(records), "malformed_slots": malformed, **findings}
+    return summary_df, warnings_df, report
+
+
+def evaluate(combos, full_config, processing_date=None):
+    """
+    Summary and warnings from the per-combination hours of aggregate_hours.
+
+    Returns (summary_df, warnings_df, report) like analyze; report only holds the
+    findings of this stage (unmatched groups and subject issues).
+    """
+    if processing_date is None:
+        processing_date = datetime.now().strftime("%d/%m/%Y")
+
+    unmatched_groups = resolve_cycles(combos, full_config)
+    subject_issues = resolve_subject_hours(combos, full_config)
+    summary_df, warnings_df = apply_thresholds(combos, full_config, processing_date)
+    report = {
+        "unmatched_groups": unmatched_groups,
+        "subject_issues": subject_issues,
+    }
+    return summary_df, warnings_df, report
+
+
+def resolve_cycles(combos, full_config):
+    """
+    Adds the 'Cicle' column to the combinations (each distinct group resolved once).
+    Returns the unmatched groups as {group: combinations}.
+    """
+    resolver = get_cycle_resolver(full_config)
+    combos['Cicle'] = resolver.resolve_series(combos['Grup_Clean'])
+    return combos.loc[combos['Cicle'].isna(), 'Grup_Clean'].value_counts().to_dict()
+
+
+def resolve_subject_hours(combos, full_config):
+    """
+    Adds the configured 'Hores Totals' of each combination's subject in its cycle
+    (each distinct pair resolved once). Returns the unresolved or ambiguous subjects.
+    """
+    subject_index = get_subject_index(full_config)
+    subject_issues = {}
+    pair_hours = {}
+    for pair in zip(combos['Cicle'], combos['Assignatura']):
+        if pair in pair_hours:
+            continue
+        c_code, subject = pair
+        if not c_code:
+            pair_hours[pair] = 0
+            continue
+        index = subject_index.get(c_code)
+        if index is None:
+            hours, status, candidates = 0, UNRESOLVED, ()
+        else:
+            hours, status, candidates = index.lookup(subject)
+        if status in (UNRESOLVED, MATCH_AMBIGUOUS):
+            subject_issues[pair] = (status, candidates)
+        pair_hours[pair] = hours
+    combos['Hores Totals'] = [pair_hours[pair] for pair in zip(combos['Cicle'], combos['Assignatura'])]
+    return subject_issues
+
+
+def apply_thresholds(combos, full_config, processing_date):
+    """
+    Summary and 15%/25% warnings from combinations with 'Cicle' and 'Hores Totals'.
+    Global cycles are checked on the student's total hours instead of per subject.
+    """
+    global_total_hours = global_cycle_hours(full_config)
+
+    has_total = combos['Hores Totals'] > 0
+    pct = combos['effective'] / combos['Hores Totals'].where(has_total) * 100
+    is_global = combos['Cicle'].isin(GLOBAL_CYCLES)
+
+    # Summary for every combination (regardless of warning)
+    summary_df = pd.DataFrame({
+        "Alumne": combos['Alumne/a'],
+        "Cicle": combos['Cicle'].fillna(UNKNOWN_CYCLE),
+        "Grup": combos['Grup_Clean'],
+        "Assignatura": combos['Assignatura'],
+        "Hores Totals": combos['Hores Totals'],
+        "Hores Faltes": combos['abs'].round(2),
+        "Hores Retards": combos['delay'].round(2),
+        "Hores Efectives": combos['effective'].round(2),
+        "% Assistència": format_pct(pct, 1),
+    }, columns=SUMMARY_COLUMNS)
+
+    # Check Thresholds (SKIP for Global Cycles, which are checked on the total below)
+    warn_mask = ~is_global & has_total & (pct >= 15)
+    flagged = combos[warn_mask]
+    warnings_df = pd.DataFrame({
+        "Data Avís": processing_date,
+        "Alumne": flagged['Alumne/a'],
+        "Grup": flagged['Grup_Clean'],
+        "Assignatura": flagged['Assignatura'],
+        "Cicle (Detectat)": flagged['Cicle'],
+        "Hores Faltes (Reals)": flagged['abs'].round(2),
+        "Hores Retards": flagged['delay'].round(2),
+        "Hores Efectives (F + R/3)": flagged['effective'].round(2),
+        "Hores Totals Mòdul": flagged['Hores Totals'],
+        "% Actual": format_pct(pct[warn_mask], 1),
+        "Tipus Avís": np.where(pct[warn_mask] >= 25, "25%", "15%"),
+    }, columns=WARNING_COLUMNS)
+
+    # --- SPECIAL LOGIC FOR GLOBAL CYCLES (PFI, ESO, BATX) ---
+    # Buffer for Global aggregation: {(Student, Group): {'abs': 0, 'delay': 0, 'cycle': ''}}
+    global_buffer = {}
+    global_rows = combos[is_global]
+    for student, group_name, matched_cycle, abs_hours, delay_hours in zip(
+        global_rows['Alumne/a'], global_rows['Grup_Clean'], global_rows['Cicle'],
+        global_rows['abs'].to_numpy(), global_rows['delay'].to_numpy()
+    ):
+        key = (student, group_name)
+        if key not in global_buffer:
+            global_buffer[key] = {'abs': 0, 'delay': 0, 'cycle': matched_cycle}
+
+        global_buffer[key]['abs'] += abs_hours
+        global_buffer[key]['delay'] += delay_hours
+
+    summary_data = []
+    warnings = []
+
+    # --- PROCESS GLOBAL BUFFER (Global Warnings) ---
+    for (student, group_name), stats in global_buffer.items():
+        c_code = stats['cycle']
+        total_cycle_hours = global_total_hours.get(c_code, 0)
+
+        abs_hours = stats['abs']
+        delay_hours = stats['delay']
+        effective_hours = abs_hours + (delay_hours / 3.0)
+
+        pct = 0
+        if total_cycle_hours > 0:
+            pct = (effective_hours / total_cycle_hours) * 100
+
+        # Add GLOBAL line to Summary
+        summary_data.append({
+            "Alumne": student,
+            "Assignatura": GLOBAL_SUBJECT,
+            "Grup": group_name,
+            "Cicle": c_code,
+            "Hores Totals": total_cycle_hours,
+            "Hores Faltes": round(abs_hours, 2),
+            "Hores Retards": round(delay_hours, 2),
+            "Hores Efectives": round(effective_hours, 2),
+            "% Assistència": f"{round(pct, 2)}%"
+        })
+
+        warning_type = None
+        if pct >= 25:
+            warning_type = "25%"
+        elif pct >= 15:
+            warning_type = "15%"
+
+        if warning_type:
+            warnings.append({
+                "Data Avís": processing_date,
+                "Alumne": student,
+                "Grup": group_name,
+                "Assignatura": GLOBAL_SUBJECT,
+                "Cicle (Detectat)": c_code,
+                "Hores Faltes (Reals)": round(abs_hours, 2),
+                "Hores Retards": round(delay_hours, 2),
+                "Hores Efectives (F + R/3)": round(effective_hours, 2),
+                "Hores Totals Mòdul": total_cycle_hours,
+                "% Actual": f"{round(pct, 1)}%",
+                "Tipus Avís": warning_type
+            })
+
+    if summary_data:
+        summary_df = pd.concat([summary_df, pd.DataFrame(summary_data, columns=SUMMARY_COLUMNS)], ignore_index=True)
+    if warnings:
+        warnings_df = pd.concat([warnings_df, pd.DataFrame(warnings, columns=WARNING_COLUMNS)], ignore_index=True)
+    warnings_df = warnings_df.reset_index(drop=True)
+    return summary_df, warnings_df
+
+
+def warning_ids(warnings_df):
+    """Identifier of each warning in history: "<student>_<subject>_<type>"."""
+    return warnings_df['Alumne'] + "_" + warnings_df['Assignatura'] + "_" + warnings_df['Tipus Avís']
+
+
+def format_malformed_slots(malformed):
+    """One-line description of the "Hora" values that could not be parsed."""
+    total = sum(malformed.values())
+    detail = ", ".join(f"'{slot}' ({count})" for slot, count in malformed.items())
+    return f"{total} registres amb hora no vàlida comptats com 0 h: {detail}"
+
+
+def format_unmatched_groups(unmatched):
+    """One-line description of the groups that could not be matched to a cycle."""
+    detail = ", ".join(f"'{group}' ({count})" for group, count in unmatched.items())
+    return f"Grups sense cicle a la configuració ({UNKNOWN_CYCLE}): {detail}"
+
+
+def subject_issues_frame(subject_issues):
+    """Table of the subjects without configured hours or with several candidate matches."""
+    labels = {UNRESOLVED: "Sense hores configurades", MATCH_AMBIGUOUS: "Ambigua"}
+    rows = [
+        {
+            "Cicle": c_code,
+            "Assignatura": subject,
+            "Problema": labels[status],
+            "Candidats": ", ".join(candidates),
+        }
+        for (c_code, subject), (status, candidates) in subject_issues.items()
+    ]
+    return pd.DataFrame(rows, columns=["Cicle", "Assignatura", "Problema", "Candidats"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calcula els avisos d'assistència d'una exportació Excel.")
+    parser.add_argument("excel", nargs="+", help="Fitxers Excel exportats (.xlsx); si n'hi ha diversos es combinen")
+    parser.add_argument("--config", default=CONFIG_FILE, help="Fitxer de configuració d'hores per cicle")
+    parser.add_argument("--out-dir", default=".", help="Directori on desar resum.csv i avisos.csv")
+    parser.add_argument("--snapshot", help="Instantània de l'exportació anterior: es compara amb ella i s'actualitza")
+    parser.add_argument("--parse-cache", default=".parsed_cache", help="Directori amb els Excel ja llegits (format columnar)")
+    parser.add_argument("--no-parse-cache", action="store_true", help="Llegeix sempre l'Excel, sense la memòria cau")
+    parser.add_argument("--memory", action="store_true", help="Mostra la memòria de les dades abans i després de compactar-les")
+    args = parser.parse_args(argv)
+
+    try:
+        import parsed_cache
+
+        cache = None if args.no_parse_cache else parsed_cache.ParsedExportCache(args.parse_cache)
+        uploads = []
+        for path in args.excel:
+            with open(path, 'rb') as f:
+                uploads.append((os.path.basename(path), f.read()))
+        df, _ = parsed_cache.read_exports(uploads, cache=cache)
+        if args.snapshot:
+            import incremental
+
+            previous = incremental.load_snapshot(args.snapshot)
+            summary_df, warnings_df, report, snapshot = incremental.analyze_incremental(
+                df, load_config(args.config), previous
+            )
+            incremental.save_snapshot(snapshot, args.snapshot)
+        else:
+            summary_df, warnings_df, report = analyze(df, load_config(args.config))
+    except ExportFormatError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if args.memory:
+        usage = memory_report(df, prepare_records(df, validate_columns(df))[0])
+        print(
+            f"Memòria: exportació {usage['export_bytes'] / 2**20:.1f} MB, "
+            f"files comptades {usage['counted_rows_bytes'] / 2**20:.1f} MB -> "
+            f"registres {usage['records_bytes'] / 2**20:.1f} MB",
+            file=sys.stderr,
+        )
+    if report["malformed_slots"]:
+        print(f"Avís: {format_malformed_slots(report['malformed_slots'])}", file=sys.stderr)
+    if report["unmatched_groups"]:
+        print(f"Avís: {format_unmatched_groups(report['unmatched_groups'])}", file=sys.stderr)
+    if report["subject_issues"]:
+        print("Avís: assignatures sense hores o ambigües:", file=sys.stderr)
+        print(subject_issues_frame(report["subject_issues"]).to_string(index=False), file=sys.stderr)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    summary_df.to_csv(os.path.join(args.out_dir, "resum.csv"), index=False)
+    warnings_df.to_csv(os.path.join(args.out_dir, "avisos.csv"), index=False)
+    print(f"{len(summary_df)} combinacions, {len(warnings_df)} avisos.")
+    if report.get("new_warnings"):
+        print(f"{len(report['new_warnings'])} avisos nous respecte a l'exportació anterior:")
+        for wid in report["new_warnings"]:
+            print(f"  {wid}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
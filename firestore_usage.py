@@ -0,0 +1,347 @@
+"""
+Firestore usage metering and budgets.
+
+CountingClient wraps the Firestore client: every reference, query and batch obtained
+from it is wrapped too, and each call that reaches the server is counted as Firestore
+bills it (one read per document returned, at least one per query, one per 1000 entries
+for count queries, one write per document written) together with the approximate
+bytes moved. A UsageMeter keeps those counts per day (persisted to USAGE_FILE so the
+daily totals survive restarts), per session and per page of a session.
+
+The session and page are taken from a context variable set at the start of each
+Streamlit run (set_scope); calls from background threads (sync, write queue) are
+counted under BACKGROUND. A UsageBudget says when a session, a page or the whole day
+has used too much, so the app can warn or read its local copy instead.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+import profiling
+
+USAGE_FILE = os.environ.get("FIRESTORE_USAGE_FILE", "firestore_usage.json")
+# Days of totals kept in USAGE_FILE
+KEEP_DAYS = 30
+# Sessions whose counts are kept in memory (oldest dropped first)
+MAX_SESSIONS = 200
+# Seconds between saves of the daily totals
+SAVE_EVERY_SECONDS = 30
+
+# Default limits (0 disables one); the free tier allows 50,000 reads and 20,000 writes a day
+SESSION_READ_BUDGET = int(os.environ.get("FIRESTORE_SESSION_READ_BUDGET", 2000))
+PAGE_READ_BUDGET = int(os.environ.get("FIRESTORE_PAGE_READ_BUDGET", 1000))
+DAILY_READ_BUDGET = int(os.environ.get("FIRESTORE_DAILY_READ_BUDGET", 40000))
+DAILY_WRITE_BUDGET = int(os.environ.get("FIRESTORE_DAILY_WRITE_BUDGET", 16000))
+# "fallback": once a read limit is hit, read the local copy; "warn": only warn
+BUDGET_MODE = os.environ.get("FIRESTORE_BUDGET_MODE", "fallback")
+
+COUNTERS = ["reads", "writes", "bytes_read", "bytes_written"]
+BACKGROUND = "background"
+# Count queries are billed one read per this many index entries
+COUNT_ENTRIES_PER_READ = 1000
+# Fixed overhead Firestore adds to the size of every document
+DOCUMENT_OVERHEAD = 32
+
+WRITE_METHODS = {"set", "update", "create", "delete"}
+READ_METHODS = {"get", "stream", "get_all"}
+# Batch commit, and the commit / restart of each attempt of a transaction
+COMMIT_METHODS = {"commit", "_commit"}
+DISCARD_METHODS = {"_clean_up", "_rollback"}
+
+_scope = contextvars.ContextVar("firestore_usage_scope", default=(BACKGROUND, None))
+
+
+def set_scope(session, page):
+    """Attributes the Firestore calls made from the current context to a session and page."""
+    _scope.set((session, page))
+
+
+def empty_counters():
+    return dict.fromkeys(COUNTERS, 0)
+
+
+def value_size(value):
+    """Approximate stored size of a field value in bytes (Firestore's storage size rules)."""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return len(value.encode()) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(str(k).encode()) + 1 + value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(v) for v in value)
+    # Numbers, timestamps, references and sentinels
+    return 8
+
+
+def document_size(doc_id, data):
+    return len(str(doc_id).encode()) + 1 + DOCUMENT_OVERHEAD + value_size(data or {})
+
+
+class UsageMeter:
+    """Thread-safe read/write counts per day, per session and per page of a session."""
+
+    def __init__(self, path=USAGE_FILE, keep_days=KEEP_DAYS, save_every=SAVE_EVERY_SECONDS,
+                 clock=time.monotonic, today=date.today):
+        self.path = path
+        self.keep_days = keep_days
+        self.save_every = save_every
+        self.clock = clock
+        self.today = today
+        self._lock = threading.Lock()
+        self.days = self._load()
+        self.sessions = OrderedDict()  # session -> {"total": counters, "pages": {page: counters}}
+        self._dirty = False
+        self._last_save = clock()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                days = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {day: {**empty_counters(), **counts} for day, counts in days.items()}
+
+    def record(self, **amounts):
+        """Adds reads/writes/bytes to today and to the session and page of the current scope."""
+        session, page = _scope.get()
+        with self._lock:
+            day = self.days.setdefault(self.today().isoformat(), empty_counters())
+            entry = self.sessions.get(session)
+            if entry is None:
+                entry = self.sessions[session] = {"total": empty_counters(), "pages": {}}
+                while len(self.sessions) > MAX_SESSIONS:
+                    self.sessions.popitem(last=False)
+            page_counts = entry["pages"].setdefault(page, empty_counters())
+            for key, n in amounts.items():
+                day[key] += n
+                entry["total"][key] += n
+                page_counts[key] += n
+            self._dirty = True
+            due = self.clock() - self._last_save >= self.save_every
+        for key, n in amounts.items():
+            if n:
+                profiling.count(f"firestore_{key}", n)
+        if due:
+            self.save()
+
+    def day(self, day=None):
+        """Counters of a day (today by default)."""
+        day = (day or self.today()).isoformat()
+        with self._lock:
+            return dict(self.days.get(day, empty_counters()))
+
+    def session(self, session):
+        with self._lock:
+            entry = self.sessions.get(session)
+            return dict(entry["total"]) if entry else empty_counters()
+
+    def pages(self, session):
+        """{page: counters} of a session."""
+        with self._lock:
+            entry = self.sessions.get(session)
+            return {page: dict(c) for page, c in entry["pages"].items()} if entry else {}
+
+    def page(self, session, page):
+        return self.pages(session).get(page, empty_counters())
+
+    def history(self, days=7):
+        """[(iso date, counters)] of the last days with usage, newest first."""
+        with self._lock:
+            return [(day, dict(c)) for day, c in sorted(self.days.items(), reverse=True)[:days]]
+
+    def save(self):
+        """Writes the daily totals (the last keep_days) if they changed."""
+        with self._lock:
+            self._last_save = self.clock()
+            if not self._dirty or not self.path:
+                return
+            for old in sorted(self.days)[:-self.keep_days]:
+                del self.days[old]
+            data = json.dumps(self.days, indent=1)
+            self._dirty = False
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+
+class UsageBudget:
+    """
+    Read and write limits per session, per page of a session and per day (0 disables
+    a limit). In "fallback" mode, reads go to the local copy once a read limit is hit;
+    in "warn" mode the limits are only reported. Writes are never held back.
+    """
+    LIMITS = ["session_reads", "page_reads", "daily_reads", "daily_writes"]
+
+    def __init__(self, session_reads=SESSION_READ_BUDGET, page_reads=PAGE_READ_BUDGET,
+                 daily_reads=DAILY_READ_BUDGET, daily_writes=DAILY_WRITE_BUDGET, mode=BUDGET_MODE):
+        self.session_reads = session_reads
+        self.page_reads = page_reads
+        self.daily_reads = daily_reads
+        self.daily_writes = daily_writes
+        self.mode = mode
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Budget from a settings mapping (e.g. st.secrets["firestore_budget"]); missing keys keep the defaults."""
+        kwargs = {key: int(settings[key]) for key in cls.LIMITS if key in settings}
+        if "mode" in settings:
+            kwargs["mode"] = str(settings["mode"])
+        return cls(**kwargs)
+
+    @property
+    def fallback(self):
+        return self.mode == "fallback"
+
+    def exceeded(self, meter, session, page):
+        """Messages for the limits already reached, read limits first."""
+        today = meter.day()
+        checks = [
+            ("lectures d'aquesta sessió", meter.session(session)["reads"], self.session_reads),
+            (f"lectures de la pàgina «{page}»", meter.page(session, page)["reads"], self.page_reads),
+            ("lectures d'avui", today["reads"], self.daily_reads),
+            ("escriptures d'avui", today["writes"], self.daily_writes),
+        ]
+        return [f"S'ha arribat al límit de {what}: {used} de {limit}."
+                for what, used, limit in checks if limit and used >= limit]
+
+    def reads_exceeded(self, meter, session, page):
+        today = meter.day()
+        return any(limit and used >= limit for used, limit in [
+            (meter.session(session)["reads"], self.session_reads),
+            (meter.page(session, page)["reads"], self.page_reads),
+            (today["reads"], self.daily_reads),
+        ])
+
+    def daily_reads_exceeded(self, meter):
+        return bool(self.daily_reads) and meter.day()["reads"] >= self.daily_reads
+
+
+_wrapped_types = None
+
+
+def wrapped_types():
+    """Firestore classes whose instances are wrapped (imported on first use, like the client)."""
+    global _wrapped_types
+    if _wrapped_types is None:
+        from google.cloud.firestore_v1.base_aggregation import BaseAggregationQuery
+        from google.cloud.firestore_v1.base_batch import BaseWriteBatch
+        from google.cloud.firestore_v1.base_collection import BaseCollectionReference
+        from google.cloud.firestore_v1.base_document import BaseDocumentReference
+        from google.cloud.firestore_v1.base_query import BaseQuery
+        _wrapped_types = (BaseCollectionReference, BaseDocumentReference, BaseQuery,
+                          BaseAggregationQuery, BaseWriteBatch)
+    return _wrapped_types
+
+
+def _unwrap(value):
+    if isinstance(value, _Metered):
+        return value._target
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unwrap(v) for v in value)
+    return value
+
+
+def _is_snapshot(value):
+    return hasattr(value, "exists") and hasattr(value, "to_dict")
+
+
+def _snapshot_size(snap):
+    return document_size(snap.id, snap.to_dict()) if snap.exists else 0
+
+
+class _Metered:
+    """Proxy of a Firestore client, reference, query or batch that meters its calls."""
+
+    def __init__(self, target, meter):
+        self._target = target
+        self._meter = meter
+        # Writes added to a batch, counted when it is committed
+        self._pending = empty_counters()
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            args = [_unwrap(a) for a in args]
+            kwargs = {k: _unwrap(v) for k, v in kwargs.items()}
+            result = attr(*args, **kwargs)
+            return self._metered(name, args, kwargs, result)
+        return call
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self._target!r})"
+
+    def _metered(self, name, args, kwargs, result):
+        if name in READ_METHODS:
+            return self._count_reads(result, per_reference=name == "get_all")
+        if name in WRITE_METHODS:
+            data = next((a for a in args if isinstance(a, dict)),
+                        kwargs.get("document_data", kwargs.get("field_updates")))
+            written = {"writes": 1, "bytes_written": value_size(data) if data else 0}
+            if hasattr(self._target, "commit"):
+                # Batch or transaction: billed when committed
+                for key, n in written.items():
+                    self._pending[key] += n
+            else:
+                self._meter.record(**written)
+            return result
+        if name in COMMIT_METHODS:
+            self._meter.record(**self._pending)
+            self._pending = empty_counters()
+            return result
+        if name in DISCARD_METHODS:
+            # A retried transaction attempt sets its writes again
+            self._pending = empty_counters()
+            return result
+        if isinstance(result, wrapped_types()):
+            return _Metered(result, self._meter)
+        return result
+
+    def _count_reads(self, result, per_reference=False):
+        if _is_snapshot(result):
+            # DocumentReference.get: one read, found or not
+            self._meter.record(reads=1, bytes_read=_snapshot_size(result))
+            return result
+        if isinstance(result, list):
+            if result and isinstance(result[0], list):
+                # Aggregation results: one read per 1000 counted entries
+                entries = sum(int(r.value) for row in result for r in row)
+                self._meter.record(reads=max(1, -(-entries // COUNT_ENTRIES_PER_READ)))
+            else:
+                self._meter.record(reads=max(1, len(result)),
+                                   bytes_read=sum(_snapshot_size(s) for s in result))
+            return result
+        return self._count_stream(result, min_reads=0 if per_reference else 1)
+
+    def _count_stream(self, snapshots, min_reads):
+        # get_all yields one snapshot (read) per reference; a query stream bills at least one read
+        reads = size = 0
+        try:
+            for snap in snapshots:
+                reads += 1
+                size += _snapshot_size(snap)
+                yield snap
+        finally:
+            self._meter.record(reads=max(min_reads, reads), bytes_read=size)
+
+
+class CountingClient(_Metered):
+    """Firestore client whose reads and writes are counted by a UsageMeter."""
+
+    def __init__(self, db, meter):
+        super().__init__(db, meter)
@@ -0,0 +1,169 @@
+"""
+Synthetic attendance exports for benchmarks.
+
+Writes workbooks with the layout of the school export (five blank rows, then the
+header with an unnamed first column) and realistic contents: group names built
+from the cycles of modules_config.json, subjects of each cycle, the usual "Hora"
+slots and the "Tipus" codes in roughly the proportions of a real export.
+
+Usage:
+    python generate_export.py 100000 [--out synthetic_100000.xlsx] [--seed 1] [--config modules_config.json]
+"""
+import argparse
+import sys
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from engine import CONFIG_FILE, load_config
+
+HEADER_OFFSET = 5  # Blank rows before the header (row 6 in the school export)
+# Excel's row limit, minus the blank rows and the header
+MAX_ROWS = 1_048_576 - HEADER_OFFSET - 1
+COLUMNS = [None, "Alumne/a", "Grup (incidència)", "Data", "Hora", "Tipus", "Assignatura", "Professor/a", "Comentari"]
+
+SLOTS = [
+    "08:00-09:00", "09:00-10:00", "10:00-11:00", "11:30-12:30", "12:30-13:30", "13:30-14:30",
+    "15:00-16:00", "16:00-17:00", "17:00-18:00", "18:20-19:20", "19:20-20:20", "20:20-21:20",
+]
+# Counted codes and a few of the others found in real exports, with similar weights
+TYPE_WEIGHTS = {
+    "F": 0.80, "FJ": 0.09, "FJP": 0.016, "R": 0.067, "RJ": 0.004, "RJP": 0.002,
+    "O": 0.02, "C": 0.002, "M": 0.001,
+}
+WEEKDAYS = ["Dl", "Dt", "Dc", "Dj", "Dv"]
+
+# Subjects that are not in the config (unresolved in a real export too)
+EXTRA_SUBJECTS = ["Tutoria"]
+EXTRA_SUBJECT_SHARE = 0.02
+
+# Roughly one student per 40 incidences, as in the sample export
+ROWS_PER_STUDENT = 40
+
+FIRST_NAMES = [
+    "Aina", "Pau", "Júlia", "Marc", "Laia", "Pol", "Martina", "Jan", "Carla", "Nil",
+    "Paula", "Arnau", "Ona", "Biel", "Lucía", "Hugo", "Sofía", "Mohamed", "Fatima", "Wei",
+]
+SURNAMES = [
+    "Garcia", "Martínez", "López", "Puig", "Vidal", "Soler", "Ferrer", "Roca", "Serra", "Font",
+    "Sánchez", "Pérez", "Casas", "Vila", "Costa", "Riera", "Rovira", "Mas", "Torres", "Navarro",
+]
+TEACHERS = [f"Professor/a {i}" for i in range(1, 61)]
+
+
+def group_names(full_config):
+    """Plausible group names for every configured cycle (e.g. "1 A EB", "3 B ESO", "1 M PFIPER")."""
+    groups = {}
+    for cycle in full_config:
+        if cycle.endswith("ESO") or cycle.endswith("BATX"):
+            level, stage = cycle.split()
+            groups[cycle] = [f"{level} {letter} {stage}" for letter in "AB"]
+        elif cycle.startswith("PFI"):
+            groups[cycle] = [f"1 {shift} {cycle}" for shift in "MT"]
+        else:
+            groups[cycle] = [f"{course} {letter} {cycle}" for course in "12" for letter in "AB"]
+    return groups
+
+
+def school_days(start=date(2025, 9, 15), end=date(2026, 6, 19)):
+    days = []
+    day = start
+    while day <= end:
+        if day.weekday() < 5:
+            days.append(f"{WEEKDAYS[day.weekday()]}, {day:%d/%m/%Y}")
+        day += timedelta(days=1)
+    return days
+
+
+def generate(n_rows, full_config, seed=1):
+    """DataFrame with n_rows synthetic incidences (the export columns, without the blank first one)."""
+    rng = np.random.default_rng(seed)
+    groups = group_names(full_config)
+    all_groups = [(cycle, g) for cycle, names in groups.items() for g in names]
+
+    # Students: each one belongs to a single group
+    n_students = max(len(all_groups), n_rows // ROWS_PER_STUDENT)
+    student_group = rng.integers(0, len(all_groups), n_students)
+    names = np.array([
+        f"{SURNAMES[a]} {SURNAMES[b]}, {FIRST_NAMES[c]} {i}"
+        for i, (a, b, c) in enumerate(zip(
+            rng.integers(0, len(SURNAMES), n_students),
+            rng.integers(0, len(SURNAMES), n_students),
+            rng.integers(0, len(FIRST_NAMES), n_students),
+        ))
+    ])
+
+    # A few students gather most of the incidences
+    weights = rng.pareto(1.5, n_students) + 1
+    student = rng.choice(n_students, n_rows, p=weights / weights.sum())
+    group_idx = student_group[student]
+
+    # Subject: one of the student's cycle subjects, sometimes an unconfigured one
+    subject = np.empty(n_rows, dtype=object)
+    for gi, (cycle, _) in enumerate(all_groups):
+        rows = np.flatnonzero(group_idx == gi)
+        options = list(full_config[cycle])
+        subject[rows] = np.array(options, dtype=object)[rng.integers(0, len(options), len(rows))]
+    extra = rng.random(n_rows) < EXTRA_SUBJECT_SHARE
+    subject[extra] = rng.choice(EXTRA_SUBJECTS, extra.sum())
+
+    days = school_days()
+    types = list(TYPE_WEIGHTS)
+    probs = np.array(list(TYPE_WEIGHTS.values()))
+
+    # Exports are sorted by student, date and slot
+    day = rng.integers(0, len(days), n_rows)
+    slot = rng.integers(0, len(SLOTS), n_rows)
+    order = np.lexsort((slot, day, names[student]))
+
+    df = pd.DataFrame({
+        "Alumne/a": names[student],
+        "Grup (incidència)": np.array([g for _, g in all_groups], dtype=object)[group_idx],
+        "Data": np.array(days, dtype=object)[day],
+        "Hora": np.array(SLOTS, dtype=object)[slot],
+        "Tipus": np.array(types, dtype=object)[rng.choice(len(types), n_rows, p=probs / probs.sum())],
+        "Assignatura": subject,
+        "Professor/a": np.array(TEACHERS, dtype=object)[rng.integers(0, len(TEACHERS), n_rows)],
+        "Comentari": None,
+    })
+    return df.iloc[order].reset_index(drop=True)
+
+
+def write_export(df, path):
+    """Writes df with the export layout (streamed: fine for a million rows)."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Faltes")
+    for _ in range(HEADER_OFFSET):
+        ws.append([])
+    ws.append(COLUMNS)
+    for row in df.itertuples(index=False, name=None):
+        ws.append((None, *row))
+    wb.save(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera una exportació de faltes sintètica (.xlsx).")
+    parser.add_argument("rows", type=int, help="Nombre d'incidències (p. ex. 10000 a 1000000)")
+    parser.add_argument("--out", help="Fitxer de sortida (per defecte synthetic_<files>.xlsx)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--config", default=CONFIG_FILE, help="Fitxer de configuració d'hores per cicle")
+    args = parser.parse_args(argv)
+
+    if not 0 < args.rows <= MAX_ROWS:
+        print(f"Error: el nombre de files ha de ser entre 1 i {MAX_ROWS}", file=sys.stderr)
+        return 1
+    full_config = load_config(args.config)
+    if not full_config:
+        print(f"Error: no s'ha pogut llegir {args.config}", file=sys.stderr)
+        return 1
+    out = args.out or f"synthetic_{args.rows}.xlsx"
+    write_export(generate(args.rows, full_config, seed=args.seed), out)
+    print(f"{args.rows} files escrites a {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,461 @@
+"""
+Warnings history stored in Firestore (collection 'attendance_warnings').
+
+Documents are keyed by "Avís ID" and hold {notified, student, subject, group, cycle,
+pct, type, last_update}. Every write also stamps 'updated_at' with the server time,
+so readers can download only the documents changed since their last sync.
+
+The sent-warnings view queries the collection server-side, one page at a time; its
+filter options come from a facets document ('attendance_meta/facets') that every write
+keeps up to date. The composite indexes these queries need are in firestore.indexes.json.
+
+Sent-warning counts by cycle, group, type and month live in 'attendance_meta/aggregates',
+incremented in the same transaction as the writes that change them.
+"""
+import atexit
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import pandas as pd
+
+COLLECTION_NAME = 'attendance_warnings'
+
+# Server-side modification time, used as the incremental sync watermark
+UPDATED_AT_FIELD = 'updated_at'
+
+# Initial watermark: every stamped document is newer than this
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Full reload (catches deletions) at most this often; incremental syncs in between
+HISTORY_TTL_SECONDS = 24 * 3600
+FETCH_TIMEOUT = 15
+
+# Firestore allows 500 operations per batch or transaction
+BATCH_LIMIT = 400
+
+# Write-behind queue: coalescing window, attempts per batch and first retry delay
+WRITE_WINDOW_SECONDS = 0.5
+WRITE_MAX_ATTEMPTS = 4
+WRITE_BACKOFF_SECONDS = 0.5
+# Longest wait for queued writes when the process exits
+WRITE_SHUTDOWN_SECONDS = 10
+
+# Sent-warnings view: rows per page, and Firestore's limit on 'in' combinations per query
+HISTORY_PAGE_SIZE = 50
+MAX_DISJUNCTIONS = 30
+
+META_COLLECTION = 'attendance_meta'
+FACETS_DOC = 'facets'
+
+# Facet lists of the facets document, and the warning field each one collects
+FACET_FIELDS = {'cycles': 'cycle', 'groups': 'group', 'subjects': 'subject', 'students': 'student'}
+
+AGGREGATES_DOC = 'aggregates'
+
+# Count maps of the aggregates document (besides 'total')
+AGGREGATE_KEYS = ['by_cycle', 'by_group', 'by_type', 'by_month']
+
+# Fields that decide where a sent warning is counted
+AGGREGATE_FIELDS = ['notified', 'cycle', 'group', 'type', 'last_update']
+
+# Fields read by the sent-warnings view (projection)
+SENT_FIELDS = ['last_update', 'student', 'group', 'subject', 'cycle', 'pct', 'type']
+
+# Targeted lookups: document IDs per get_all call, and calls in flight
+GET_ALL_CHUNK = 100
+GET_ALL_WORKERS = 4
+
+
+def fetch_all(db, timeout=FETCH_TIMEOUT):
+    """Downloads the whole collection as {doc_id: data}."""
+    # get() instead of stream() to avoid potential gRPC hangs in Streamlit Cloud
+    docs = db.collection(COLLECTION_NAME).get(timeout=timeout)
+    return {doc.id: doc.to_dict() for doc in docs}
+
+
+def fetch_changed_since(db, watermark, timeout=FETCH_TIMEOUT):
+    """Documents whose updated_at is at or after the watermark."""
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    query = db.collection(COLLECTION_NAME).where(filter=FieldFilter(UPDATED_AT_FIELD, ">=", watermark))
+    docs = query.get(timeout=timeout)
+    return {doc.id: doc.to_dict() for doc in docs}
+
+
+def fetch_by_ids(db, ids, chunk_size=GET_ALL_CHUNK, max_workers=GET_ALL_WORKERS, timeout=FETCH_TIMEOUT):
+    """
+    Fetches only the given documents, as {doc_id: data} (missing documents are left out).
+
+    IDs are split into chunks of chunk_size, each fetched with one get_all call;
+    chunks run concurrently.
+    """
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}
+    collection = db.collection(COLLECTION_NAME)
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+    def fetch_chunk(chunk):
+        refs = [collection.document(wid) for wid in chunk]
+        return {snap.id: snap.to_dict() for snap in db.get_all(refs, timeout=timeout) if snap.exists}
+
+    if len(chunks) == 1:
+        return fetch_chunk(chunks[0])
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as pool:
+        # Each task runs in a copy of the caller's context, so context variables (e.g. the
+        # session and page firestore_usage charges the reads to) reach the workers
+        futures = [pool.submit(contextvars.copy_context().run, fetch_chunk, chunk) for chunk in chunks]
+        for future in futures:
+            found.update(future.result())
+    return found
+
+
+def status_frame(history, ids):
+    """
+    'notified' and 'last_update' for each ID, aligned with ids.
+
+    One reindex of the fetched documents; warnings without history default to
+    not notified and an empty date.
+    """
+    status = pd.DataFrame.from_dict(history, orient='index')
+    status = status.reindex(columns=['notified', 'last_update']).reindex(ids)
+    return pd.DataFrame({
+        'notified': status['notified'].eq(True).to_numpy(),
+        'last_update': status['last_update'].where(status['last_update'].notna(), '').to_numpy(),
+    })
+
+
+def latest_update(docs, default=None):
+    """Highest updated_at among the given documents (legacy documents have none)."""
+    stamps = [d[UPDATED_AT_FIELD] for d in docs.values() if d.get(UPDATED_AT_FIELD) is not None]
+    return max(stamps, default=default)
+
+
+def facet_values(hist_updates):
+    """{facet: sorted values} collected from the notified entries of some updates."""
+    values = {facet: set() for facet in FACET_FIELDS}
+    for data in hist_updates.values():
+        if data.get('notified'):
+            for facet, field in FACET_FIELDS.items():
+                if data.get(field):
+                    values[facet].add(data[field])
+    return {facet: sorted(found) for facet, found in values.items() if found}
+
+
+def warning_type(wid, data):
+    """Type of a warning ("15%"/"25%"); legacy entries without one get it from the ID suffix."""
+    wtype = data.get('type')
+    if wtype is None or wtype == '-':
+        parts = wid.rsplit('_', 1)
+        if len(parts) == 2:
+            return parts[1]
+    return wtype
+
+
+def _aggregate_keys(wid, data):
+    keys = {
+        'by_cycle': data.get('cycle') or '-',
+        'by_group': data.get('group') or '-',
+        'by_type': warning_type(wid, data) or '-',
+    }
+    # last_update is "YYYY-MM-DD HH:MM:SS"
+    if data.get('last_update'):
+        keys['by_month'] = str(data['last_update'])[:7]
+    return keys
+
+
+def empty_aggregates():
+    return {'total': 0, **{key: {} for key in AGGREGATE_KEYS}}
+
+
+def aggregate_deltas(previous, hist_updates):
+    """
+    Count changes caused by writing hist_updates over previous ({doc_id: stored data}).
+    Returns {'total': n, 'by_cycle': {cycle: n}, ...} without zero entries.
+    """
+    deltas = empty_aggregates()
+
+    def count(wid, data, step):
+        deltas['total'] += step
+        for key, value in _aggregate_keys(wid, data).items():
+            deltas[key][value] = deltas[key].get(value, 0) + step
+
+    for wid, data in hist_updates.items():
+        old = previous.get(wid)
+        if old and old.get('notified'):
+            count(wid, old, -1)
+        if data.get('notified'):
+            count(wid, data, 1)
+    for key in AGGREGATE_KEYS:
+        deltas[key] = {value: n for value, n in deltas[key].items() if n}
+    return deltas
+
+
+def save_history(db, hist_updates, timeout=FETCH_TIMEOUT):
+    """
+    Writes {doc_id: data} updates in transactions, stamping each document with the server time.
+    Each transaction also adds its notified values to the facets document and applies its
+    count changes to the aggregates document.
+
+    The count changes are computed against the stored documents read inside the same
+    transaction: when two sessions save the same warning at once, the later commit is
+    retried against the earlier one's result, so each change is counted once.
+    """
+    from firebase_admin import firestore
+
+    collection = db.collection(COLLECTION_NAME)
+    meta = db.collection(META_COLLECTION)
+
+    @firestore.transactional
+    def commit_chunk(transaction, refs, chunk):
+        previous = {
+            snap.id: snap.to_dict()
+            for snap in db.get_all(refs, field_paths=AGGREGATE_FIELDS, transaction=transaction, timeout=timeout)
+            if snap.exists
+        }
+        for ref, data in zip(refs, chunk.values()):
+            transaction.set(ref, {**data, UPDATED_AT_FIELD: firestore.SERVER_TIMESTAMP})
+        facets = facet_values(chunk)
+        if facets:
+            transaction.set(meta.document(FACETS_DOC), {f: firestore.ArrayUnion(v) for f, v in facets.items()}, merge=True)
+        deltas = aggregate_deltas(previous, chunk)
+        if deltas['total'] or any(deltas[key] for key in AGGREGATE_KEYS):
+            increments = {'total': firestore.Increment(deltas['total'])}
+            for key in AGGREGATE_KEYS:
+                increments[key] = {value: firestore.Increment(n) for value, n in deltas[key].items()}
+            transaction.set(meta.document(AGGREGATES_DOC), increments, merge=True)
+
+    items = list(hist_updates.items())
+    # Two operations per transaction are left for the facets and aggregates documents
+    for i in range(0, len(items), BATCH_LIMIT - 2):
+        chunk = dict(items[i:i + BATCH_LIMIT - 2])
+        commit_chunk(db.transaction(), [collection.document(wid) for wid in chunk], chunk)
+
+
+def load_facets(db, timeout=FETCH_TIMEOUT):
+    """Filter options for the sent-warnings view, as {facet: sorted values}."""
+    snap = db.collection(META_COLLECTION).document(FACETS_DOC).get(timeout=timeout)
+    data = snap.to_dict() if snap.exists else None
+    # Writes only add their own values: the document is complete once it has been rebuilt
+    if not data or not data.get('complete'):
+        return rebuild_facets(db, timeout=timeout)
+    return {facet: sorted(data.get(facet, [])) for facet in FACET_FIELDS}
+
+
+def rebuild_facets(db, timeout=FETCH_TIMEOUT):
+    """
+    Recomputes the facets document from the sent warnings (see _rebuild_meta).
+    Only needed once for histories written before facets were maintained.
+    """
+    def summarize(docs):
+        facets = {facet: [] for facet in FACET_FIELDS}
+        facets.update(facet_values(docs))
+        return facets
+
+    return _rebuild_meta(db, FACETS_DOC, list(FACET_FIELDS.values()), summarize, timeout)
+
+
+def load_aggregates(db, timeout=FETCH_TIMEOUT):
+    """Sent-warning counts: {'total': n, 'by_cycle': {...}, 'by_group': {...}, 'by_type': {...}, 'by_month': {...}}."""
+    snap = db.collection(META_COLLECTION).document(AGGREGATES_DOC).get(timeout=timeout)
+    data = snap.to_dict() if snap.exists else None
+    # Increments only count the writes made since the document was (re)built
+    if not data or not data.get('complete'):
+        return rebuild_aggregates(db, timeout=timeout)
+    counts = empty_aggregates()
+    counts['total'] = data.get('total', 0)
+    for key in AGGREGATE_KEYS:
+        counts[key] = {value: n for value, n in data.get(key, {}).items() if n}
+    return counts
+
+
+def rebuild_aggregates(db, timeout=FETCH_TIMEOUT):
+    """
+    Recounts the aggregates document from the sent warnings (see _rebuild_meta).
+    Needed once for older histories, or to repair counts edited by hand.
+    """
+    return _rebuild_meta(db, AGGREGATES_DOC, AGGREGATE_FIELDS, lambda docs: aggregate_deltas({}, docs), timeout)
+
+
+def _rebuild_meta(db, doc_id, field_paths, summarize, timeout):
+    """
+    Replaces a meta document with summarize({doc_id: data}) of the sent warnings, marked complete.
+
+    save_history updates these documents in its transactions, so the rebuild runs in a
+    transaction too, reading the meta document before querying the warnings. A save
+    then cannot commit between the query and the rewrite: it either commits first (its
+    rows are in the query result and the rewrite replaces its increment) or waits for
+    the rebuild and is applied on top of it. Either way each change is counted once.
+    """
+    from firebase_admin import firestore
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    ref = db.collection(META_COLLECTION).document(doc_id)
+    query = (db.collection(COLLECTION_NAME)
+             .where(filter=FieldFilter('notified', '==', True))
+             .select(field_paths))
+
+    @firestore.transactional
+    def rebuild(transaction):
+        ref.get(transaction=transaction, timeout=timeout)
+        docs = {snap.id: {**snap.to_dict(), 'notified': True}
+                for snap in query.get(transaction=transaction, timeout=timeout)}
+        values = summarize(docs)
+        transaction.set(ref, {**values, 'complete': True})
+        return values
+
+    return rebuild(db.transaction())
+
+
+def filter_combinations(filters):
+    """Number of equality combinations a set of 'in' filters expands to."""
+    total = 1
+    for values in filters.values():
+        if values:
+            total *= len(values)
+    return total
+
+
+def _sent_query(db, filters):
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    query = db.collection(COLLECTION_NAME).where(filter=FieldFilter('notified', '==', True))
+    for field, values in filters.items():
+        if values:
+            query = query.where(filter=FieldFilter(field, 'in', list(values)))
+    return query
+
+
+def fetch_sent_page(db, filters, page_size=HISTORY_PAGE_SIZE, cursor=None, timeout=FETCH_TIMEOUT):
+    """
+    One page of sent warnings, newest first.
+
+    filters maps a field (cycle, group, subject, student) to the accepted values; empty
+    lists do not filter. Returns ({doc_id: data}, next_cursor); next_cursor is None on
+    the last page and is passed back as cursor to read the following page.
+    """
+    from google.cloud.firestore_v1 import Query
+
+    query = (_sent_query(db, filters)
+             .order_by('last_update', direction=Query.DESCENDING)
+             .select(SENT_FIELDS)
+             # One extra document tells whether there is a next page
+             .limit(page_size + 1))
+    if cursor is not None:
+        query = query.start_after(cursor)
+    snaps = query.get(timeout=timeout)
+    next_cursor = snaps[page_size - 1] if len(snaps) > page_size else None
+    return {snap.id: snap.to_dict() for snap in snaps[:page_size]}, next_cursor
+
+
+def count_sent(db, filters, timeout=FETCH_TIMEOUT):
+    """Number of sent warnings matching the filters (server-side count aggregation)."""
+    result = _sent_query(db, filters).count().get(timeout=timeout)
+    return int(result[0][0].value)
+
+
+class WriteQueue:
+    """
+    Write-behind queue for history updates.
+
+    put() only records the updates; a background thread waits window seconds so every
+    change from one interaction lands in the same batch, coalesces repeated writes to a
+    document (last one wins) and commits them with save_history, retrying with
+    exponential backoff. on_commit(updates) / on_failure(updates, error) report the outcome.
+    At interpreter exit, flush() waits up to WRITE_SHUTDOWN_SECONDS for queued writes.
+    """
+
+    def __init__(self, db, window=WRITE_WINDOW_SECONDS, max_attempts=WRITE_MAX_ATTEMPTS,
+                 backoff=WRITE_BACKOFF_SECONDS, on_commit=None, on_failure=None, save=None):
+        self.db = db
+        self.window = window
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.on_commit = on_commit
+        self.on_failure = on_failure
+        self.save = save or save_history
+        self._pending = {}
+        self._in_flight = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self.failed = {}
+        self.last_error = None
+        self.commits = 0
+
+    def put(self, hist_updates):
+        """Queues {doc_id: data} updates; returns immediately."""
+        if not hist_updates:
+            return
+        with self._cond:
+            self._pending.update(hist_updates)
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is None:
+                    # The writer is a daemon thread: give queued changes a chance to land on exit
+                    atexit.register(self.flush, WRITE_SHUTDOWN_SECONDS)
+                self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def requeue(self, hist_updates):
+        """put() for the updates whose documents are not already pending or being committed."""
+        with self._cond:
+            fresh = {k: v for k, v in hist_updates.items() if k not in self._pending and k not in self._in_flight}
+            for key in fresh:
+                self.failed.pop(key, None)
+        self.put(fresh)
+
+    def retry_failed(self):
+        """Queues again the updates whose commit failed."""
+        with self._cond:
+            failed, self.failed = self.failed, {}
+        self.put(failed)
+
+    def flush(self, timeout=None):
+        """Blocks until everything queued so far is committed or failed. Returns True if drained."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # Let the rest of this interaction's changes arrive
+            time.sleep(self.window)
+            with self._cond:
+                self._in_flight, self._pending = self._pending, {}
+            self._commit(self._in_flight)
+            with self._cond:
+                self._in_flight = {}
+                self._cond.notify_all()
+
+    def _commit(self, updates):
+        error = None
+        for attempt in range(self.max_attempts):
+            try:
+                self.save(self.db, updates)
+            except Exception as e:
+                error = e
+                if attempt + 1 < self.max_attempts:
+                    time.sleep(self.backoff * (2 ** attempt))
+                continue
+            self.commits += 1
+            if self.on_commit:
+                self.on_commit(updates)
+            return
+        self.last_error = error
+        with self._cond:
+            self.failed.update(updates)
+        if self.on_failure:
+            self.on_failure(updates, error)
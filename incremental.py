@@ -0,0 +1,218 @@
+"""
+Incremental reprocessing of successive exports.
+
+The weekly export is cumulative: most of its rows were already in the previous one.
+An ExportSnapshot keeps, for the last processed export, the normalized key of every
+distinct row (identified by a hash of its raw cells), how many times each row
+appeared, the per-combination hours and the warnings raised. A new export is diffed
+against it by row hash:
+
+- rows seen before reuse their normalized subject (no per-row normalization);
+- only the (student, subject, group) combinations whose rows were added or removed
+  are re-aggregated, the others keep the snapshot's hours;
+- warnings that were not raised last time are reported as newly crossed.
+
+The per-combination evaluation (cycle, configured hours, thresholds, global cycles)
+is vectorized and memoized per config, so it always runs on the merged hours.
+"""
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+import profiling
+from engine import (
+    COMBO_KEYS, aggregate_hours, evaluate, prepare_records, validate_columns, warning_ids,
+)
+
+SNAPSHOT_FILE = 'export_snapshot.pkl'
+SNAPSHOT_DIR = 'export_snapshots'
+# Snapshots kept in memory by SnapshotStore; the rest are reloaded from disk
+SNAPSHOTS_IN_MEMORY = 4
+
+
+def row_hashes(df):
+    """64-bit hash of every row's raw cells (equal rows give equal hashes)."""
+    return pd.Series(pd.util.hash_pandas_object(df, index=False).to_numpy(), index=df.index)
+
+
+class ExportSnapshot:
+    """What is kept from a processed export to diff the next one against."""
+
+    def __init__(self, columns, row_keys, row_counts, combos, warning_ids):
+        self.columns = list(columns)
+        self.row_keys = row_keys      # row hash -> COMBO_KEYS of a counted row
+        self.row_counts = row_counts  # row hash -> occurrences among counted rows
+        self.combos = combos          # aggregate_hours output indexed by COMBO_KEYS
+        self.warning_ids = set(warning_ids)
+        # Set by SnapshotStore: the uploaded files, and the warnings of the export before them
+        self.source = None
+        self.previous_warning_ids = None
+
+
+def export_scope(df):
+    """Key of the set of groups in an export: exports of other groups do not share snapshots."""
+    groups = sorted(df[validate_columns(df)].dropna().astype(str).unique())
+    return hashlib.sha256("\n".join(groups).encode()).hexdigest()[:16]
+
+
+def _touched_keys(record_hashes, records, previous, new_counts):
+    # Row hashes whose number of occurrences changed, in either direction
+    diff = new_counts.sub(previous.row_counts, fill_value=0)
+    changed = diff.index[diff != 0]
+
+    new_keys = records.loc[record_hashes.isin(changed).to_numpy(), COMBO_KEYS].astype(object)
+    removed = previous.row_keys.reindex(changed.difference(new_counts.index)).dropna().astype(object)
+    return pd.MultiIndex.from_frame(pd.concat([new_keys, removed], ignore_index=True)).unique()
+
+
+def _merge_combos(records, previous, touched):
+    # Re-aggregate the touched combinations and take the rest from the snapshot
+    keys = pd.MultiIndex.from_frame(records[COMBO_KEYS])
+    fresh = aggregate_hours(records[keys.isin(touched)]).set_index(COMBO_KEYS)
+    kept = previous.combos[~previous.combos.index.isin(touched)]
+    # Combinations keep the order in which they first appear in the new export
+    order = keys.drop_duplicates()
+    merged = pd.concat([kept, fresh]).reindex(order)
+    merged.index.names = COMBO_KEYS
+    merged = merged.reset_index()
+    merged[COMBO_KEYS] = merged[COMBO_KEYS].astype(object)
+    return merged
+
+
+def analyze_incremental(df, full_config, previous=None, processing_date=None):
+    """
+    engine.analyze for an export that may share rows with a previously processed one.
+
+    Returns (summary_df, warnings_df, report, snapshot). The frames equal those of a full
+    analyze; report adds 'new_warnings' (IDs not raised by the previous export) and
+    'reused_combinations' / 'changed_combinations'. Pass snapshot as previous next time.
+    """
+    grup_col = validate_columns(df)
+    with profiling.stage("row_hashes", rows=len(df)):
+        hashes = row_hashes(df)
+
+    usable = previous is not None and previous.columns == list(df.columns)
+    known_subjects = None
+    if usable:
+        known = previous.row_keys['Assignatura']
+        known_subjects = pd.Series(known.reindex(hashes.to_numpy()).to_numpy(), index=df.index)
+
+    with profiling.stage("records", rows=len(df)):
+        records, malformed = prepare_records(df, grup_col, known_subjects=known_subjects)
+        record_hashes = hashes[records.index]
+        new_counts = record_hashes.value_counts()
+
+    with profiling.stage("aggregate", rows=len(records)) as stage:
+        if usable:
+            touched = _touched_keys(record_hashes, records, previous, new_counts)
+            combos = _merge_combos(records, previous, touched)
+            changed = len(touched)
+        else:
+            combos = aggregate_hours(records)
+            changed = len(combos)
+        stage.rows = changed
+
+    with profiling.stage("evaluate", rows=len(combos)):
+        summary_df, warnings_df, findings = evaluate(combos, full_config, processing_date)
+    ids = warning_ids(warnings_df)
+    new_warnings = [] if previous is None else [wid for wid in ids if wid not in previous.warning_ids]
+
+    report = {
+        "rows": len(df),
+        "records": len(records),
+        "malformed_slots": malformed,
+        **findings,
+        "new_warnings": new_warnings,
+        "reused_combinations": len(combos) - changed,
+        "changed_combinations": changed,
+    }
+
+    row_keys = records[COMBO_KEYS].set_index(record_hashes.to_numpy())
+    snapshot = ExportSnapshot(
+        df.columns,
+        row_keys[~row_keys.index.duplicated()],
+        new_counts,
+        combos.set_index(COMBO_KEYS),
+        ids,
+    )
+    return summary_df, warnings_df, report, snapshot
+
+
+class SnapshotStore:
+    """
+    The latest snapshot of every export scope (export_scope), on disk so the next week's
+    upload can use it and the most recently used ones also in memory.
+
+    Each snapshot remembers which files it came from (source) and the warnings of the
+    export it replaced, so re-processing the same files reports the same new warnings.
+    """
+
+    def __init__(self, directory=SNAPSHOT_DIR, max_in_memory=SNAPSHOTS_IN_MEMORY):
+        self.directory = directory
+        self.max_in_memory = max_in_memory
+        self._snapshots = OrderedDict()  # scope -> snapshot or None
+        self._lock = threading.Lock()
+
+    def _path(self, scope):
+        return os.path.join(self.directory, f"{scope}.pkl")
+
+    def _remember(self, scope, snapshot):
+        self._snapshots[scope] = snapshot
+        self._snapshots.move_to_end(scope)
+        while len(self._snapshots) > self.max_in_memory:
+            self._snapshots.popitem(last=False)
+
+    def latest(self, scope):
+        with self._lock:
+            if scope in self._snapshots:
+                self._snapshots.move_to_end(scope)
+                return self._snapshots[scope]
+            snapshot = load_snapshot(self._path(scope))
+            self._remember(scope, snapshot)
+            return snapshot
+
+    def save(self, scope, source, snapshot):
+        """Stores the snapshot of the export made of source (content hashes of the files)."""
+        previous = self.latest(scope)
+        if previous is not None and previous.source == source:
+            snapshot.previous_warning_ids = previous.previous_warning_ids
+        elif previous is not None:
+            snapshot.previous_warning_ids = previous.warning_ids
+        snapshot.source = source
+        with self._lock:
+            self._remember(scope, snapshot)
+            os.makedirs(self.directory, exist_ok=True)
+            save_snapshot(snapshot, self._path(scope))
+
+    def new_warnings(self, scope, source, ids):
+        """IDs among ids not raised by the export processed before source, in this scope."""
+        latest = self.latest(scope)
+        if latest is None:
+            return []
+        baseline = latest.previous_warning_ids if latest.source == source else latest.warning_ids
+        if baseline is None:
+            return []
+        return [wid for wid in ids if wid not in baseline]
+
+
+def load_snapshot(path=SNAPSHOT_FILE):
+    """Snapshot saved by save_snapshot, or None if missing or unreadable."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+    return snapshot if isinstance(snapshot, ExportSnapshot) else None
+
+
+def save_snapshot(snapshot, path=SNAPSHOT_FILE):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
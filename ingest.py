@@ -0,0 +1,202 @@
+"""
+Single-pass Excel ingestion.
+
+The export has a few title rows before the real header ("Alumne/a", "Assignatura", ...).
+We stream each sheet once with openpyxl in read-only mode, look for the header only
+in the first HEADER_SCAN_ROWS rows and build the DataFrame from the rows that follow,
+instead of parsing the whole workbook twice with pd.read_excel. Sheets without the
+header are skipped.
+
+Several exports (per group, per term) are parsed in parallel worker processes and
+merged: rows present in more than one export are counted once.
+"""
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+# The header is expected near the top of the sheet (row 6 in the school export)
+HEADER_SCAN_ROWS = 50
+HEADER_MARKERS = ("Alumne/a", "Assignatura")
+
+# Cells that identify an incidence when merging exports (others, like comments, may differ)
+DEDUP_COLUMNS = ["Alumne/a", "Data", "Hora", "Tipus", "Assignatura"]
+
+
+class ExportFormatError(ValueError):
+    """The uploaded export does not have the expected layout."""
+
+
+def find_header_row(rows):
+    """Index of the row holding the "Alumne/a" and "Assignatura" headers, or None."""
+    for i, row in enumerate(rows):
+        row_str = [str(v).strip() for v in row if v is not None]
+        if all(marker in row_str for marker in HEADER_MARKERS):
+            return i
+    return None
+
+
+def _column_names(header):
+    # Same naming as pd.read_excel: blank headers become "Unnamed: <n>"
+    names = []
+    for i, value in enumerate(header):
+        if value is None or str(value).strip() == "":
+            names.append(f"Unnamed: {i}")
+        else:
+            names.append(str(value).strip())
+    return names
+
+
+def find_group_column(df):
+    # 'Grup (incidència)' is expected, but accept variations
+    return next((c for c in df.columns if "Grup" in c), None)
+
+
+def _iter_xlsx_sheets(source):
+    from openpyxl import load_workbook
+
+    wb = load_workbook(source, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            yield ws.title, ws.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _legacy_rows(raw):
+    for row in raw.itertuples(index=False, name=None):
+        yield tuple(None if pd.isna(v) else v for v in row)
+
+
+def _iter_legacy_sheets(source):
+    # .xls (or anything openpyxl cannot stream): still a single parse, through pandas
+    for title, raw in pd.read_excel(source, header=None, sheet_name=None).items():
+        yield title, _legacy_rows(raw)
+
+
+def _is_legacy(source):
+    name = getattr(source, "name", source)
+    return isinstance(name, str) and name.lower().endswith(".xls")
+
+
+def iter_sheets(source):
+    """Yields (sheet title, rows) for every sheet; rows yields the raw cell values, one tuple per row."""
+    if _is_legacy(source):
+        return _iter_legacy_sheets(source)
+    return _iter_xlsx_sheets(source)
+
+
+def frame_from_rows(rows, scan_rows=HEADER_SCAN_ROWS):
+    """Builds the export DataFrame from an iterator of raw rows."""
+    rows = iter(rows)
+    head = list(islice(rows, scan_rows))
+
+    header_row_idx = find_header_row(head)
+    if header_row_idx is None:
+        raise ExportFormatError("No s'ha trobat la fila de capçalera (Alumne/a, Assignatura...).")
+
+    columns = _column_names(head[header_row_idx])
+    width = len(columns)
+
+    # Rows may come shorter than the header when their last cells are empty
+    padding = (None,) * width
+    data = [tuple(row[:width]) + padding[len(row):] for row in head[header_row_idx + 1:]]
+    data.extend(row[:width] if len(row) >= width else tuple(row) + padding[len(row):] for row in rows)
+
+    # Drop trailing blank rows (formatted but empty cells at the end of the sheet)
+    while data and all(v is None for v in data[-1]):
+        data.pop()
+
+    df = pd.DataFrame.from_records(data, columns=columns, coerce_float=True)
+    # Empty cells come as None; use NaN like pd.read_excel
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].notna(), np.nan)
+    return df.infer_objects()
+
+
+def read_sheets(source, scan_rows=HEADER_SCAN_ROWS):
+    """DataFrames of every sheet that holds an export, in workbook order."""
+    if hasattr(source, "seek"):
+        source.seek(0)
+    frames = []
+    for _, rows in iter_sheets(source):
+        try:
+            frames.append(frame_from_rows(rows, scan_rows=scan_rows))
+        except ExportFormatError:
+            continue  # Cover or summary sheet
+    if not frames:
+        raise ExportFormatError("No s'ha trobat la fila de capçalera (Alumne/a, Assignatura...).")
+    return frames
+
+
+def combine_exports(frames):
+    """
+    Concatenates several exports, counting rows present in more than one of them once.
+
+    Repeated rows within one export are kept: the n-th copy of an incidence is only
+    dropped if another export already has n copies of it.
+    """
+    if len(frames) == 1:
+        return frames[0]
+    group_cols = [find_group_column(f) for f in frames]
+    target = next((g for g in group_cols if g), None)
+
+    aligned = []
+    for frame, group_col in zip(frames, group_cols):
+        if group_col and group_col != target:
+            frame = frame.rename(columns={group_col: target})
+        aligned.append(frame)
+
+    keys = [c for c in DEDUP_COLUMNS + [target] if c and all(c in f.columns for f in aligned)]
+    marked = [
+        f.assign(_copy=f.groupby(keys, dropna=False, sort=False).cumcount()) if keys else f
+        for f in aligned
+    ]
+    combined = pd.concat(marked, ignore_index=True)
+    if keys:
+        combined = combined.drop_duplicates(subset=keys + ["_copy"]).drop(columns="_copy")
+    return combined.reset_index(drop=True)
+
+
+def read_export(source, scan_rows=HEADER_SCAN_ROWS):
+    """Reads an Excel export (path or file-like) in a single pass; multi-sheet workbooks are merged."""
+    return combine_exports(read_sheets(source, scan_rows=scan_rows))
+
+
+def _read_upload(upload):
+    # Runs in a worker process: (name, bytes) -> frames of its sheets
+    name, data = upload
+    source = io.BytesIO(data)
+    source.name = name
+    try:
+        return read_sheets(source)
+    except ExportFormatError as e:
+        raise ExportFormatError(f"{name}: {e}") from None
+
+
+def parse_uploads(uploads, max_workers=None):
+    """
+    Sheet frames of several exports given as [(file name, bytes)], one list per file.
+
+    Each file is parsed in its own worker process, so the total time is close to the
+    time of the largest file.
+    """
+    if len(uploads) <= 1:
+        return [_read_upload(upload) for upload in uploads]
+    workers = min(len(uploads), max_workers or os.cpu_count() or 1)
+    # Spawned, not forked: forking the multi-threaded Streamlit server can copy locks
+    # held by other threads and deadlock the workers
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        return list(pool.map(_read_upload, uploads))
+
+
+def read_exports(uploads, max_workers=None):
+    """Reads several exports given as [(file name, bytes)] and merges them. Returns (df, duplicate_rows)."""
+    frames = [frame for part in parse_uploads(uploads, max_workers) for frame in part]
+    df = combine_exports(frames)
+    return df, sum(len(f) for f in frames) - len(df)
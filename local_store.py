@@ -0,0 +1,349 @@
+"""
+Local SQLite copy of the warnings history.
+
+The app reads history from here, so page loads are local queries and the app keeps
+working without Firebase credentials. When Firestore is available, HistorySync keeps
+both sides in step in the background: local changes (rows marked dirty) are pushed,
+and remote changes since the stored watermark are pulled.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import history_store
+
+LOCAL_DB_FILE = 'warnings_history.db'
+LEGACY_HISTORY_FILE = 'warnings_history.json'
+
+# Seconds between background syncs, and without any session using history before they pause
+SYNC_INTERVAL_SECONDS = 30
+SYNC_IDLE_SECONDS = 15 * 60
+
+FIELDS = ["notified", "student", "subject", "group", "cycle", "pct", "type", "last_update"]
+
+# "group" is an SQL keyword: stored as grp
+COLUMNS = {field: field for field in FIELDS}
+COLUMNS["group"] = "grp"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS warnings (
+    id TEXT PRIMARY KEY,
+    notified INTEGER NOT NULL DEFAULT 0,
+    student TEXT,
+    subject TEXT,
+    grp TEXT,
+    cycle TEXT,
+    pct TEXT,
+    type TEXT,
+    last_update TEXT,
+    updated_at TEXT,
+    dirty INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_warnings_student ON warnings(student);
+CREATE INDEX IF NOT EXISTS idx_warnings_grp ON warnings(grp);
+CREATE INDEX IF NOT EXISTS idx_warnings_cycle ON warnings(cycle);
+CREATE INDEX IF NOT EXISTS idx_warnings_last_update ON warnings(last_update);
+CREATE INDEX IF NOT EXISTS idx_warnings_sent ON warnings(notified, last_update);
+CREATE INDEX IF NOT EXISTS idx_warnings_dirty ON warnings(dirty) WHERE dirty = 1;
+CREATE TABLE IF NOT EXISTS sync_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+SELECT_COLUMNS = "id, " + ", ".join(COLUMNS[f] for f in FIELDS)
+
+
+def _row_to_doc(row):
+    doc = {field: row[i + 1] for i, field in enumerate(FIELDS)}
+    doc["notified"] = bool(doc["notified"])
+    return row[0], doc
+
+
+def _normalize(data):
+    doc = {field: data.get(field) for field in FIELDS}
+    doc["notified"] = bool(doc["notified"])
+    return doc
+
+
+def _doc_values(data):
+    values = [data.get(field) for field in FIELDS]
+    values[0] = 1 if data.get("notified") else 0
+    return values
+
+
+class LocalHistoryStore:
+    """History table in SQLite; thread-safe, shared by every session of the process."""
+
+    def __init__(self, path=LOCAL_DB_FILE):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- Reads ---
+
+    def get_many(self, ids):
+        """Returns {doc_id: data} for the given IDs (unknown IDs are left out)."""
+        ids = list(dict.fromkeys(ids))
+        found = {}
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT {SELECT_COLUMNS} FROM warnings WHERE id IN ({marks})", chunk
+                ).fetchall()
+                found.update(_row_to_doc(r) for r in rows)
+        return found
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM warnings").fetchone()[0]
+
+    # --- Sent-warnings view (same interface as the Firestore queries in history_store) ---
+
+    def _sent_where(self, filters):
+        clauses, params = ["notified = 1"], []
+        for field, values in filters.items():
+            if values:
+                clauses.append(f"{COLUMNS[field]} IN ({','.join('?' * len(values))})")
+                params.extend(values)
+        return " AND ".join(clauses), params
+
+    def fetch_sent_page(self, filters, page_size=history_store.HISTORY_PAGE_SIZE, cursor=None):
+        """One page of sent warnings, newest first; cursor is the (last_update, id) of the previous page's last row."""
+        where, params = self._sent_where(filters)
+        if cursor is not None:
+            where += " AND (COALESCE(last_update, ''), id) < (?, ?)"
+            params.extend(cursor)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {SELECT_COLUMNS} FROM warnings WHERE {where} "
+                "ORDER BY COALESCE(last_update, '') DESC, id DESC LIMIT ?",
+                [*params, page_size + 1],
+            ).fetchall()
+        page = dict(_row_to_doc(r) for r in rows[:page_size])
+        next_cursor = None
+        if len(rows) > page_size:
+            last_id, last = _row_to_doc(rows[page_size - 1])
+            next_cursor = (last["last_update"] or "", last_id)
+        return page, next_cursor
+
+    def count_sent(self, filters):
+        where, params = self._sent_where(filters)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM warnings WHERE {where}", params).fetchone()[0]
+
+    def aggregates(self):
+        """Sent-warning counts, shaped like history_store.load_aggregates."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, cycle, grp, type, last_update FROM warnings WHERE notified = 1"
+            ).fetchall()
+        docs = {
+            r[0]: {"notified": True, "cycle": r[1], "group": r[2], "type": r[3], "last_update": r[4]}
+            for r in rows
+        }
+        return history_store.aggregate_deltas({}, docs)
+
+    def facets(self):
+        """Filter options for the sent-warnings view, as {facet: sorted values}."""
+        found = {}
+        with self._lock:
+            for facet, field in history_store.FACET_FIELDS.items():
+                rows = self._conn.execute(
+                    f"SELECT DISTINCT {COLUMNS[field]} FROM warnings "
+                    f"WHERE notified = 1 AND {COLUMNS[field]} IS NOT NULL AND {COLUMNS[field]} != ''"
+                ).fetchall()
+                found[facet] = sorted(r[0] for r in rows)
+        return found
+
+    # --- Writes ---
+
+    def put(self, hist_updates, dirty=True):
+        """Upserts {doc_id: data}; dirty rows are pending upload to Firestore."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"""INSERT INTO warnings (id, {", ".join(COLUMNS[f] for f in FIELDS)}, dirty)
+                    VALUES (?, {", ".join("?" * len(FIELDS))}, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                    {", ".join(f"{COLUMNS[f]} = excluded.{COLUMNS[f]}" for f in FIELDS)},
+                    dirty = excluded.dirty""",
+                [(wid, *_doc_values(data), 1 if dirty else 0) for wid, data in hist_updates.items()],
+            )
+
+    def dirty(self):
+        """Local changes not yet uploaded, as {doc_id: data}."""
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {SELECT_COLUMNS} FROM warnings WHERE dirty = 1").fetchall()
+        return dict(_row_to_doc(r) for r in rows)
+
+    def mark_clean(self, hist_updates):
+        """Clears the dirty flag of rows that still hold exactly the uploaded data."""
+        current = self.get_many(hist_updates.keys())
+        clean = [wid for wid, data in hist_updates.items() if current.get(wid) == _normalize(data)]
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE warnings SET dirty = 0 WHERE id = ?", [(wid,) for wid in clean])
+
+    def merge_remote(self, docs, complete=False):
+        """
+        Stores documents read from Firestore; rows with pending local changes keep the local version.
+
+        With complete=True, docs is the whole collection: rows without pending changes that
+        are missing from it were deleted remotely and are deleted here too.
+        """
+        rows = []
+        for wid, data in docs.items():
+            stamp = data.get(history_store.UPDATED_AT_FIELD)
+            rows.append((wid, *_doc_values(data), stamp.isoformat() if stamp is not None else None))
+        with self._lock, self._conn:
+            if complete:
+                clean = self._conn.execute("SELECT id FROM warnings WHERE dirty = 0").fetchall()
+                self._conn.executemany(
+                    "DELETE FROM warnings WHERE id = ? AND dirty = 0",
+                    [(wid,) for (wid,) in clean if wid not in docs],
+                )
+            self._conn.executemany(
+                f"""INSERT INTO warnings (id, {", ".join(COLUMNS[f] for f in FIELDS)}, updated_at, dirty)
+                    VALUES (?, {", ".join("?" * len(FIELDS))}, ?, 0)
+                    ON CONFLICT(id) DO UPDATE SET
+                    {", ".join(f"{COLUMNS[f]} = excluded.{COLUMNS[f]}" for f in FIELDS)},
+                    updated_at = excluded.updated_at
+                    WHERE warnings.dirty = 0""",
+                rows,
+            )
+
+    # --- Sync metadata ---
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO sync_meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value),
+            )
+
+    def import_legacy_json(self, path=LEGACY_HISTORY_FILE):
+        """Seeds an empty store from the pre-Firestore JSON history. Returns the number of rows imported."""
+        if self.count() or not os.path.exists(path):
+            return 0
+        with open(path, 'r') as f:
+            legacy = json.load(f)
+        self.put(legacy, dirty=False)
+        return len(legacy)
+
+
+class HistorySync:
+    """
+    Two-way background sync between a LocalHistoryStore and Firestore.
+
+    Pushes go through a history_store.WriteQueue (coalesced, retried); rows stay dirty
+    until their commit succeeds, so failed pushes are retried on the next cycle, even
+    after a restart. Pulls download the whole collection when there is no watermark
+    yet and then at most every full_every seconds (the time of the last one is kept
+    in the store, so restarts do not repeat it), dropping the local rows deleted
+    remotely; otherwise only documents changed since the stored watermark are fetched.
+
+    The loop only runs while sessions use history: after idle_after seconds without
+    a touch() it stops querying Firestore until the next one. While pull_allowed()
+    is false (e.g. the daily read budget is spent), only pushes run.
+    """
+
+    def __init__(self, db, store, interval=SYNC_INTERVAL_SECONDS,
+                 full_every=history_store.HISTORY_TTL_SECONDS, idle_after=SYNC_IDLE_SECONDS,
+                 clock=time.time, pull_allowed=None):
+        self.db = db
+        self.store = store
+        self.interval = interval
+        self.full_every = full_every
+        self.idle_after = idle_after
+        self.clock = clock
+        self.pull_allowed = pull_allowed
+        self.queue = history_store.WriteQueue(db, on_commit=store.mark_clean)
+        self._last_used = clock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._sync_lock = threading.Lock()
+        self.last_sync = None
+        self.last_error = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="history-sync", daemon=True)
+            self._thread.start()
+
+    def touch(self):
+        """Marks history as in use; an idle loop syncs right away."""
+        idle = self.idle
+        self._last_used = self.clock()
+        if idle:
+            self._wake.set()
+
+    @property
+    def idle(self):
+        return self.clock() - self._last_used > self.idle_after
+
+    def push(self, hist_updates):
+        """Saves updates locally (dirty) and schedules their upload."""
+        self.store.put(hist_updates, dirty=True)
+        self.queue.put(hist_updates)
+
+    def refresh(self, ids):
+        """Pulls the current remote state of specific documents right away."""
+        self.store.merge_remote(history_store.fetch_by_ids(self.db, ids))
+
+    @property
+    def has_synced(self):
+        return self.store.get_meta("watermark") is not None
+
+    def sync_now(self):
+        """One sync cycle: upload dirty rows, then pull remote changes."""
+        with self._sync_lock:
+            # Rows left dirty by failed or interrupted uploads (the ones still queued are skipped)
+            pending = self.store.dirty()
+            if pending:
+                self.queue.requeue(pending)
+            if self.pull_allowed is not None and not self.pull_allowed():
+                return
+
+            stored = self.store.get_meta("watermark")
+            last_full = float(self.store.get_meta("last_full", 0))
+            complete = stored is None or self.clock() - last_full > self.full_every
+            if complete:
+                docs = history_store.fetch_all(self.db)
+                self.store.set_meta("last_full", repr(self.clock()))
+                watermark = history_store.latest_update(docs, default=history_store.EPOCH)
+            else:
+                watermark = datetime.fromisoformat(stored)
+                docs = history_store.fetch_changed_since(self.db, watermark)
+                watermark = history_store.latest_update(docs, default=watermark)
+
+            self.store.merge_remote(docs, complete=complete)
+            self.store.set_meta("watermark", watermark.isoformat())
+            self.last_sync = datetime.now()
+
+    def _run(self):
+        while True:
+            if not self.idle:
+                try:
+                    self.sync_now()
+                    self.last_error = None
+                except Exception as e:
+                    self.last_error = e
+            self._wake.wait(self.interval)
+            self._wake.clear()
@@ -0,0 +1,211 @@
+"""
+Bulk outbox for pending warnings.
+
+Every pending warning is rendered (with the compiled templates of email_templates) into
+an email message. The messages can be downloaded as a ZIP of .eml files or as a single
+mbox, or sent through SMTP: a few reused connections, shared by worker threads, with a
+global rate limit so the mail server does not throttle the account.
+
+SMTP settings come from st.secrets["smtp"] (host, port, username, password, sender,
+security = "starttls" | "ssl" | "none", per_minute, connections). Any local SMTP
+stand-in works for testing, e.g. `python -m aiosmtpd -n -l localhost:1025` with
+security = "none".
+"""
+import copy
+import io
+import re
+import smtplib
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+
+import pandas as pd
+
+SMTP_PORT = 587
+SMTP_TIMEOUT = 30
+
+# Conservative defaults for school accounts (Gmail/Workspace throttle bursts)
+SMTP_CONNECTIONS = 2
+SMTP_PER_MINUTE = 30
+
+# Recipients file: one row per student
+RECIPIENT_COLUMNS = ("Alumne", "Correu")
+
+
+def load_recipients(source):
+    """{student: email} from a CSV with 'Alumne' and 'Correu' columns."""
+    df = pd.read_csv(source, dtype=str)
+    missing = [c for c in RECIPIENT_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f"Falten columnes al fitxer de correus: {', '.join(missing)}")
+    df = df.dropna(subset=list(RECIPIENT_COLUMNS))
+    return dict(zip(df["Alumne"].str.strip(), df["Correu"].str.strip()))
+
+
+def build_messages(df, templates, sender=None, recipients=None):
+    """
+    Renders one EmailMessage per warning row, as a list of (Avís ID, message).
+    Rows without a known recipient get no To header.
+    """
+    recipients = recipients or {}
+    subjects, bodies = templates.render_all(df)
+    domain = sender.rsplit("@", 1)[-1] if sender and "@" in sender else None
+    date = formatdate(localtime=True)
+    messages = []
+    for wid, student, subject, body in zip(df["Avís ID"], df["Alumne"], subjects, bodies):
+        msg = EmailMessage()
+        msg["Subject"] = subject
+        if sender:
+            msg["From"] = sender
+        to = recipients.get(student)
+        if to:
+            msg["To"] = to
+        msg["Date"] = date
+        msg["Message-ID"] = make_msgid(domain=domain)
+        msg["X-Avis-ID"] = wid
+        msg.set_content(body)
+        messages.append((wid, msg))
+    return messages
+
+
+def _eml_name(i, wid):
+    safe = re.sub(r"[^\w.-]+", "_", wid)[:80]
+    return f"{i:04d}_{safe}.eml"
+
+
+def as_draft(msg):
+    """Copy of a message marked as unsent, so mail clients open it as an editable draft."""
+    draft = copy.deepcopy(msg)
+    draft["X-Unsent"] = "1"
+    return draft
+
+
+def eml_zip(messages):
+    """ZIP archive (bytes) with one .eml draft per message."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i, (wid, msg) in enumerate(messages, start=1):
+            zf.writestr(_eml_name(i, wid), as_draft(msg).as_bytes())
+    return buffer.getvalue()
+
+
+def mbox_bytes(messages):
+    """All messages in a single mbox file (bytes), as drafts."""
+    buffer = io.BytesIO()
+    generator = BytesGenerator(buffer, mangle_from_=True)
+    for _, msg in messages:
+        msg = as_draft(msg)
+        msg.set_unixfrom(f"From {msg['From'] or 'MAILER-DAEMON'} {time.asctime()}")
+        generator.flatten(msg, unixfrom=True)
+        buffer.write(b"\n")
+    return buffer.getvalue()
+
+
+class RateLimiter:
+    """Spaces calls at least 60 / per_minute seconds apart, across threads."""
+
+    def __init__(self, per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = self.clock()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            self.sleep(slot - now)
+
+
+class SMTPPool:
+    """
+    Sends messages over at most `connections` SMTP connections, each opened once and
+    reused for many messages (reopened if the server drops it), under a shared rate limit.
+    """
+
+    def __init__(self, host, port=SMTP_PORT, username=None, password=None, security="starttls",
+                 connections=SMTP_CONNECTIONS, per_minute=SMTP_PER_MINUTE, timeout=SMTP_TIMEOUT):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.security = security
+        self.connections = max(1, int(connections))
+        self.timeout = timeout
+        self.limiter = RateLimiter(per_minute)
+        self._local = threading.local()
+        self._open = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.security == "ssl":
+            conn = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.security == "starttls":
+                conn.starttls()
+        if self.username:
+            conn.login(self.username, self.password)
+        with self._lock:
+            self._open.append(conn)
+        return conn
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _send(self, msg):
+        self.limiter.wait()
+        try:
+            self._connection().send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # Idle connection closed by the server: reconnect once
+            self._local.conn = self._connect()
+            self._local.conn.send_message(msg)
+
+    def close(self):
+        with self._lock:
+            conns, self._open = self._open, []
+        for conn in conns:
+            try:
+                conn.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+    def send_all(self, messages, progress=None, on_finish=None):
+        """
+        Sends [(Avís ID, message)]. Returns (sent IDs, {Avís ID: error}).
+
+        progress(done, total) is called from the calling thread after each message.
+        on_finish(sent, failed) is called once every message has been handled, even when
+        progress raises (e.g. Streamlit stopping the script for a rerun): the messages
+        already queued are still sent, and on_finish is the place to record them.
+        """
+        futures = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.connections) as pool:
+                futures = {pool.submit(self._send, msg): wid for wid, msg in messages}
+                for done, _ in enumerate(as_completed(futures), start=1):
+                    if progress is not None:
+                        progress(done, len(futures))
+        finally:
+            self.close()
+            sent, failed = [], {}
+            for future, wid in futures.items():
+                error = future.exception()
+                if error is None:
+                    sent.append(wid)
+                else:
+                    failed[wid] = str(error)
+            if on_finish is not None:
+                on_finish(sent, failed)
+        return sent, failed
@@ -0,0 +1,136 @@
+"""
+Columnar cache of parsed exports.
+
+Parsing an .xlsx with openpyxl is by far the slowest step of the pipeline, and the
+same workbook is uploaded many times during a review session. The first parse of a
+file is stored as an uncompressed Feather (Arrow IPC) file named after the hash of
+its bytes, already cleaned and typed (engine.derive_columns: Tipus_Clean, Grup_Clean,
+Durada). Later loads, from the app or from engine.py, read that file instead of
+parsing the workbook again. The file is memory-mapped, but every column is still
+converted to pandas: merging exports and the incremental row hashes use all of them.
+
+Needs pyarrow (installed with streamlit); without it every load parses the workbook.
+"""
+import glob
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from engine import derive_columns
+from ingest import combine_exports, parse_uploads
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:
+    pa = feather = None
+
+PARSED_CACHE_DIR = '.parsed_cache'
+MAX_PARSED_FILES = 32
+
+# Bump when the parsing or the derived columns change, so old files are not reused
+PARSED_FORMAT = 2
+
+# Rows merged away when the sheets of a workbook were combined
+DUPLICATES_KEY = b'attendance.duplicate_rows'
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _clean_nulls(df):
+    # Arrow gives None for missing strings; use NaN like ingest.frame_from_rows
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
+
+
+class ParsedExportCache:
+    """Directory of parsed exports keyed by content hash, bounded to max_files (least recently used go first)."""
+
+    def __init__(self, directory=PARSED_CACHE_DIR, max_files=MAX_PARSED_FILES):
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return feather is not None
+
+    def path(self, digest):
+        return os.path.join(self.directory, f"{digest}.v{PARSED_FORMAT}.feather")
+
+    def load(self, digest):
+        """(df, duplicate_rows) for a cached file, or None."""
+        if not self.enabled:
+            return None
+        path = self.path(digest)
+        try:
+            table = feather.read_table(path, memory_map=True)
+            os.utime(path)
+        except (OSError, pa.ArrowException):
+            return None
+        duplicates = int((table.schema.metadata or {}).get(DUPLICATES_KEY, b'0'))
+        return _clean_nulls(table.to_pandas()), duplicates
+
+    def store(self, digest, df, duplicate_rows=0):
+        """Saves a parsed export; returns False if it cannot be stored (e.g. mixed-type columns)."""
+        if not self.enabled:
+            return False
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowException, TypeError, ValueError):
+            return False
+        metadata = dict(table.schema.metadata or {})
+        metadata[DUPLICATES_KEY] = str(duplicate_rows).encode()
+        table = table.replace_schema_metadata(metadata)
+
+        path = self.path(digest)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Uncompressed, so later loads can memory-map it
+            feather.write_feather(table, tmp, compression='uncompressed')
+            os.replace(tmp, path)
+        except OSError:
+            return False
+        self._evict()
+        return True
+
+    def _evict(self):
+        with self._lock:
+            files = glob.glob(os.path.join(self.directory, "*.feather"))
+            if len(files) <= self.max_files:
+                return
+            files.sort(key=lambda f: os.path.getmtime(f))
+            for old in files[:len(files) - self.max_files]:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+
+def read_exports(uploads, cache=None, max_workers=None):
+    """
+    ingest.read_exports with derived columns, through the cache: only files not
+    cached yet are parsed (in parallel), then stored. Returns (df, duplicate_rows).
+    """
+    digests = [content_hash(data) for _, data in uploads]
+    loaded = [cache.load(d) if cache is not None else None for d in digests]
+
+    misses = [i for i, hit in enumerate(loaded) if hit is None]
+    for i, frames in zip(misses, parse_uploads([uploads[i] for i in misses], max_workers)):
+        df = derive_columns(combine_exports(frames))
+        duplicates = sum(len(f) for f in frames) - len(df)
+        if cache is not None:
+            cache.store(digests[i], df, duplicates)
+        loaded[i] = (df, duplicates)
+
+    frames = [df for df, _ in loaded]
+    df = combine_exports(frames)
+    duplicates = sum(d for _, d in loaded) + sum(len(f) for f in frames) - len(df)
+    return df, duplicates
+
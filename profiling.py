@@ -0,0 +1,147 @@
+"""
+Optional per-run profiling.
+
+When enabled, a RunProfile records what one run of a page spent its time on: wall
+time, row count and process peak memory per stage, plus counters such as Firestore
+reads and writes. Runs are shown in the sidebar and appended as JSON lines to
+PROFILE_LOG_FILE for later analysis.
+
+Code anywhere in the pipeline marks stages with `with profiling.stage("name"):`.
+The profile is found through a context variable; when no profile is active or it
+is disabled, stage() returns a shared no-op object, so the cost is one lookup.
+"""
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROFILE_LOG_FILE = os.environ.get("PROFILE_LOG", "profile_log.jsonl")
+# Runs kept per session for the sidebar panel
+MAX_RUNS = 10
+
+_current = contextvars.ContextVar("run_profile", default=None)
+_log_lock = threading.Lock()
+
+
+def peak_rss_mb():
+    """Peak resident memory of the process so far, in MB (None if unknown)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+class _NullStage:
+    """Stage of a disabled profile: does nothing."""
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("profile", "name", "rows", "_start")
+
+    def __init__(self, profile, name, rows):
+        self.profile = profile
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.stages.append({
+            "name": self.name,
+            "seconds": round(time.perf_counter() - self._start, 4),
+            "rows": self.rows,
+            "peak_rss_mb": peak_rss_mb(),
+        })
+        return False
+
+
+class RunProfile:
+    """Stages and counters of one run; a disabled profile records nothing."""
+
+    def __init__(self, page, session=None, enabled=True):
+        self.page = page
+        self.session = session
+        self.enabled = enabled
+        self.stages = []
+        self.counters = {}
+        self._start = time.perf_counter()
+
+    def stage(self, name, rows=None):
+        """Context manager timing a stage; set `.rows` on it to record a row count."""
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name, rows)
+
+    def count(self, key, n=1):
+        if self.enabled:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def activate(self):
+        """Makes this the profile seen by stage() and count() in the current context."""
+        _current.set(self)
+        return self
+
+    def to_dict(self):
+        return {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "session": self.session,
+            "page": self.page,
+            "total_seconds": round(time.perf_counter() - self._start, 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": self.stages,
+            "counters": self.counters,
+        }
+
+    def finish(self, log_path=PROFILE_LOG_FILE):
+        """Ends the run: returns its record (None if disabled) and appends it to the log."""
+        _current.set(None)
+        if not self.enabled:
+            return None
+        record = self.to_dict()
+        if log_path:
+            line = json.dumps(record, ensure_ascii=False)
+            try:
+                with _log_lock, open(log_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError:
+                pass
+        return record
+
+
+def stage(name, rows=None):
+    """Stage of the active profile (no-op when there is none)."""
+    profile = _current.get()
+    if profile is None:
+        return NULL_STAGE
+    return profile.stage(name, rows)
+
+
+def count(key, n=1):
+    """Adds n to a counter of the active profile, if any."""
+    profile = _current.get()
+    if profile is not None:
+        profile.count(key, n)
@@ -0,0 +1,222 @@
+"""
+Lookups derived from modules_config.json.
+
+CycleResolver maps a group name from the export (e.g. "1 A AC") to its cycle code.
+The config keys are compiled once into a longest-match pattern and each distinct
+group name is resolved only once.
+
+SubjectIndex maps a subject name from the export to its configured hours within a
+cycle. Indexes are built once per config version and shared across uploads.
+"""
+import bisect
+import hashlib
+import json
+import re
+import unicodedata
+from functools import lru_cache
+
+import pandas as pd
+
+# Outcomes of SubjectIndex.lookup
+MATCH_EXACT = "exact"
+MATCH_NORMALIZED = "normalized"
+MATCH_FUZZY = "fuzzy"
+MATCH_AMBIGUOUS = "ambiguous"
+MATCH_TOKENS = "tokens"
+UNRESOLVED = "unresolved"
+
+# ESO and BATX groups are named by level ("3 ESO A", "1r BATX B"), not by config key
+LEVEL_CYCLES = [
+    ("3", "ESO", "3 ESO"),
+    ("4", "ESO", "4 ESO"),
+    ("1", "BATX", "1 BATX"),
+    ("2", "BATX", "2 BATX"),
+]
+
+
+class CycleResolver:
+    """Longest-match resolver from group names to cycle codes, memoized per group."""
+
+    def __init__(self, cycle_codes):
+        # Longest codes first: at each position the alternation tries them in that order
+        self.codes = sorted(cycle_codes, key=len, reverse=True)
+        self._rank = {code: i for i, code in enumerate(self.codes)}
+        self._pattern = None
+        if self.codes:
+            alternation = "|".join(re.escape(code) for code in self.codes)
+            # Lookahead so overlapping occurrences are all reported
+            self._pattern = re.compile(f"(?=({alternation}))")
+        self._cache = {}
+
+    def _match(self, group_name):
+        for level, stage, cycle in LEVEL_CYCLES:
+            if level in group_name and stage in group_name:
+                return cycle
+        if self._pattern is None:
+            return None
+        # The longest code contained anywhere in the name wins (ties: config order)
+        found = {m.group(1) for m in self._pattern.finditer(group_name)}
+        if not found:
+            return None
+        return min(found, key=self._rank.__getitem__)
+
+    def resolve(self, group_name):
+        """Cycle code for a group name, or None if no config key matches."""
+        try:
+            return self._cache[group_name]
+        except KeyError:
+            cycle = self._match(group_name)
+            self._cache[group_name] = cycle
+            return cycle
+
+    def resolve_series(self, groups):
+        """Resolves each distinct value of a Series once and maps the answers back onto every row."""
+        mapping = {g: self.resolve(g) for g in pd.unique(groups)}
+        return groups.map(mapping).astype(object)
+
+
+@lru_cache(maxsize=8)
+def _resolver_for(cycle_codes):
+    return CycleResolver(cycle_codes)
+
+
+def get_cycle_resolver(full_config):
+    """Shared CycleResolver for the cycles of a config (compiled once per set of keys)."""
+    return _resolver_for(tuple(full_config.keys()))
+
+
+def normalize_text(text):
+    """Lowercase, unify apostrophes and normalize Unicode to NFC."""
+    text = str(text).strip().lower()
+    text = text.replace("’", "'").replace("‘", "'").replace("´", "'").replace("`", "'")
+    return unicodedata.normalize('NFC', text)
+
+
+def normalize_subject_key(subj_key):
+    # Strip leading code like "0633. ", "MP1226 ", "MP3060_"
+    # Pattern: Start, optional chars, DIGIT(s), optional chars, (dot OR underscore OR dash OR space)
+    # This also handles "MP3060_Preparació" -> "Preparació"
+    return normalize_text(re.sub(r'^[^\s]*\d+[^\s]*[\._\-\s]\s*', '', subj_key))
+
+
+def token_key(name):
+    """Order-insensitive key built from the words of a normalized name."""
+    return frozenset(re.findall(r"\w+", name))
+
+
+def config_version(full_config):
+    """Short fingerprint of a config; changes whenever any cycle, subject or hour changes."""
+    canonical = json.dumps(full_config, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:12]
+
+
+# Separates the names in SubjectIndex's joined text (never part of a name)
+NAME_SEPARATOR = "\0"
+
+
+class SubjectIndex:
+    """
+    Configured hours for the subjects of one cycle, indexed by exact, normalized and
+    token keys. The substring fallback is indexed too: a compiled alternation finds
+    the config names contained in a subject in one pass, and the names containing
+    the subject are found with str.find over all the names joined in one string.
+    """
+
+    def __init__(self, cycle_conf):
+        self.exact = dict(cycle_conf)
+        self.normalized = {}
+        for subj_key, hrs in cycle_conf.items():
+            self.normalized[normalize_subject_key(subj_key)] = hrs
+        self.by_tokens = {}
+        for name in self.normalized:
+            self.by_tokens.setdefault(token_key(name), []).append(name)
+
+        names = [n for n in self.normalized if n and NAME_SEPARATOR not in n]
+        self._rank = {name: i for i, name in enumerate(self.normalized)}
+        self._contained = None
+        if names:
+            # Longest first; lookahead reports a match at every position
+            alternation = "|".join(re.escape(n) for n in sorted(names, key=len, reverse=True))
+            self._contained = re.compile(f"(?=({alternation}))")
+        # At a position only the longest name is reported: the names that are its prefixes match there too
+        self._prefixes = {n: [p for p in names if p != n and n.startswith(p)] for n in names}
+        self._joined = NAME_SEPARATOR.join(names)
+        self._names = names
+        self._starts = []
+        offset = 0
+        for name in names:
+            self._starts.append(offset)
+            offset += len(name) + len(NAME_SEPARATOR)
+        self._cache = {}
+
+    def _substring_candidates(self, text):
+        """Config names contained in text or containing it, in config order (the old linear scan's result)."""
+        if not text:
+            return list(self.normalized)
+        found = set()
+        if "" in self.normalized:
+            found.add("")
+        if self._contained is not None:
+            for m in self._contained.finditer(text):
+                found.add(m.group(1))
+                found.update(self._prefixes[m.group(1)])
+        if NAME_SEPARATOR not in text:
+            pos = self._joined.find(text)
+            while pos != -1:
+                i = bisect.bisect_right(self._starts, pos) - 1
+                found.add(self._names[i])
+                if i + 1 == len(self._names):
+                    break
+                pos = self._joined.find(text, self._starts[i + 1])
+        return sorted(found, key=self._rank.__getitem__)
+
+    def _resolve(self, subject):
+        if subject in self.exact:
+            return self.exact[subject], MATCH_EXACT, ()
+
+        excel_subj_norm = normalize_text(subject)
+        if excel_subj_norm in self.normalized:
+            return self.normalized[excel_subj_norm], MATCH_NORMALIZED, ()
+
+        # Fuzzy fallback: the first config name contained in (or containing) the subject wins
+        candidates = self._substring_candidates(excel_subj_norm)
+        if candidates:
+            hours = self.normalized[candidates[0]]
+            if any(self.normalized[c] != hours for c in candidates[1:]):
+                return hours, MATCH_AMBIGUOUS, tuple(candidates)
+            return hours, MATCH_FUZZY, tuple(candidates)
+
+        # Same words in a different order ("Comunicació i atenció" / "Atenció i comunicació")
+        same_words = self.by_tokens.get(token_key(excel_subj_norm), [])
+        if same_words:
+            hours = self.normalized[same_words[0]]
+            status = MATCH_AMBIGUOUS if len(same_words) > 1 else MATCH_TOKENS
+            return hours, status, tuple(same_words)
+
+        return 0, UNRESOLVED, ()
+
+    def lookup(self, subject):
+        """Returns (hours, status, candidates) for a subject; hours is 0 when unresolved."""
+        try:
+            return self._cache[subject]
+        except KeyError:
+            result = self._resolve(subject)
+            self._cache[subject] = result
+            return result
+
+
+# {config_version: {cycle: SubjectIndex}}; only the latest few configs are kept
+_subject_indexes = {}
+SUBJECT_INDEX_VERSIONS = 4
+
+
+def get_subject_index(full_config):
+    """Subject indexes for every cycle of a config, reused across uploads until the config changes."""
+    version = config_version(full_config)
+    indexes = _subject_indexes.get(version)
+    if indexes is None:
+        indexes = {c_code: SubjectIndex(c_conf) for c_code, c_conf in full_config.items()}
+        while len(_subject_indexes) >= SUBJECT_INDEX_VERSIONS:
+            _subject_indexes.pop(next(iter(_subject_indexes)))
+        _subject_indexes[version] = indexes
+    return indexes
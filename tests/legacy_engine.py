@@ -0,0 +1,296 @@
+"""
+The per-row analysis loop that engine.analyze replaced, kept as a reference for
+test_engine.py (the "Gestió d'Avisos" computation as it was before vectorizing).
+"""
+import re
+import unicodedata
+from datetime import datetime
+
+import pandas as pd
+
+# Codes: F, FJ, FJP (Absences); R, RJ, RJP (Delays)
+ABSENCE_CODES = ['F', 'FJ', 'FJP']
+DELAY_CODES = ['R', 'RJ', 'RJP']
+VALID_TYPES = ABSENCE_CODES + DELAY_CODES
+
+# PFI & ESO/BATX are "Global" cycles: attendance is calculated on TOTAL hours, not per module.
+GLOBAL_CYCLES = ["PFIPER", "PFICOM", "3 ESO", "4 ESO", "1 BATX", "2 BATX"]
+GLOBAL_SUBJECT = "GLOBAL (Còmput Total)"
+UNKNOWN_CYCLE = "Desconegut"
+
+SUMMARY_COLUMNS = [
+    "Alumne", "Cicle", "Grup", "Assignatura", "Hores Totals",
+    "Hores Faltes", "Hores Retards", "Hores Efectives", "% Assistència"
+]
+WARNING_COLUMNS = [
+    "Data Avís", "Alumne", "Grup", "Assignatura", "Cicle (Detectat)",
+    "Hores Faltes (Reals)", "Hores Retards", "Hores Efectives (F + R/3)",
+    "Hores Totals Mòdul", "% Actual", "Tipus Avís"
+]
+
+
+def calculate_duration(time_range_srt):
+    try:
+        if not isinstance(time_range_srt, str):
+            return 0
+        start_str, end_str = time_range_srt.split('-')
+        fmt = '%H:%M'
+        t_start = datetime.strptime(start_str.strip(), fmt)
+        t_end = datetime.strptime(end_str.strip(), fmt)
+        return (t_end - t_start).total_seconds() / 3600
+    except Exception:
+        return 0
+
+
+def normalize_text(text):
+    """Lowercase, unify apostrophes and normalize Unicode to NFC."""
+    text = str(text).strip().lower()
+    text = text.replace("’", "'").replace("‘", "'").replace("´", "'").replace("`", "'")
+    return unicodedata.normalize('NFC', text)
+
+
+def normalize_subject_key(subj_key):
+    # Strip leading code like "0633. ", "MP1226 ", "MP3060_"
+    # Pattern: Start, optional chars, DIGIT(s), optional chars, (dot OR underscore OR dash OR space)
+    # This also handles "MP3060_Preparació" -> "Preparació"
+    return normalize_text(re.sub(r'^[^\s]*\d+[^\s]*[\._\-\s]\s*', '', subj_key))
+
+
+def normalize_project_module(row):
+    # Merge "Mòdul projecte" into "Projecte intermodular" for groups containing "EB" or "PER"
+    grup = row['Grup_Clean']
+    subj = row['Assignatura']
+
+    if "EB" in grup or "PER" in grup:
+        if subj == "Mòdul projecte":
+            return "Projecte intermodular"
+    return subj
+
+
+def get_category(code):
+    if code in ABSENCE_CODES: return 'Absence'
+    if code in DELAY_CODES: return 'Delay'
+    return 'Other'
+
+
+def global_cycle_hours(full_config):
+    """Total yearly hours for each global cycle."""
+    global_total_hours = {}
+    for g_cycle in GLOBAL_CYCLES:
+        # Hardcoded defaults if missing in JSON, or specific overrides
+        if g_cycle in ("3 ESO", "4 ESO"):
+            global_total_hours[g_cycle] = 1080
+        elif g_cycle == "1 BATX":
+            # If in config, sum values. Otherwise typical fallback.
+            if g_cycle in full_config:
+                global_total_hours[g_cycle] = sum(full_config[g_cycle].values())
+            else:
+                global_total_hours[g_cycle] = 1020
+        elif g_cycle == "2 BATX":
+            global_total_hours[g_cycle] = 1020
+        elif g_cycle in full_config:
+            # For PFIs or others defined in JSON
+            global_total_hours[g_cycle] = sum(full_config[g_cycle].values())
+    return global_total_hours
+
+
+def find_group_column(df):
+    # 'Grup (incidència)' is expected, but accept variations
+    return next((c for c in df.columns if "Grup" in c), None)
+
+
+def analyze(df, full_config, processing_date=None):
+    """
+    Computes the attendance summary and the 15%/25% warnings for an export.
+
+    Returns (summary_df, warnings_df) with SUMMARY_COLUMNS and WARNING_COLUMNS.
+    """
+    grup_col = find_group_column(df)
+    if processing_date is None:
+        processing_date = datetime.now().strftime("%d/%m/%Y")
+
+    # Filter rows with valid types (use str.strip() to be safe)
+    mask = df['Tipus'].astype(str).str.strip().isin(VALID_TYPES)
+    records = df[mask].copy()
+
+    records['Durada'] = records['Hora'].apply(calculate_duration)
+    records['Grup_Clean'] = records[grup_col].astype(str).str.strip()
+    records['Tipus_Clean'] = records['Tipus'].astype(str).str.strip()
+    if not records.empty:
+        records['Assignatura'] = records.apply(normalize_project_module, axis=1)
+    records['Category'] = records['Tipus_Clean'].apply(get_category)
+
+    # Sum durations separately for Absences and Delays
+    grouped = records.groupby(['Alumne/a', 'Assignatura', 'Grup_Clean', 'Category'])['Durada'].sum().reset_index()
+
+    # Iterate unique (Student, Subject, Group) combinations
+    unique_combinations = records[['Alumne/a', 'Assignatura', 'Grup_Clean']].drop_duplicates()
+
+    warnings = []
+    summary_data = []
+
+    known_cycles = list(full_config.keys())
+    global_total_hours = global_cycle_hours(full_config)
+
+    # Buffer for Global aggregation: {(Student, Group): {'abs': 0, 'delay': 0, 'cycle': ''}}
+    global_buffer = {}
+
+    # Pre-calculate a normalized config map for each cycle
+    cycle_normalized_maps = {}
+    for c_code, c_conf in full_config.items():
+        cycle_normalized_maps[c_code] = {}
+        for subj_key, hrs in c_conf.items():
+            cycle_normalized_maps[c_code][normalize_subject_key(subj_key)] = hrs
+
+    for idx, row in unique_combinations.iterrows():
+        student = row['Alumne/a']
+        subject = row['Assignatura']
+        group_name = row['Grup_Clean']
+
+        combo_stats = grouped[
+            (grouped['Alumne/a'] == student) &
+            (grouped['Assignatura'] == subject) &
+            (grouped['Grup_Clean'] == group_name)
+        ]
+
+        abs_hours = combo_stats[combo_stats['Category'] == 'Absence']['Durada'].sum()
+        delay_hours = combo_stats[combo_stats['Category'] == 'Delay']['Durada'].sum()
+
+        # Formula: Effective = Absences + (Delays / 3)
+        effective_hours = abs_hours + (delay_hours / 3.0)
+
+        # 1. Determine Cycle from Group Name
+        matched_cycle = None
+
+        # Special check for ESO and BATX
+        if "3" in group_name and "ESO" in group_name:
+            matched_cycle = "3 ESO"
+        elif "4" in group_name and "ESO" in group_name:
+            matched_cycle = "4 ESO"
+        elif "1" in group_name and "BATX" in group_name:
+            matched_cycle = "1 BATX"
+        elif "2" in group_name and "BATX" in group_name:
+            matched_cycle = "2 BATX"
+        else:
+            for c_code in sorted(known_cycles, key=len, reverse=True):
+                if c_code in group_name:
+                    matched_cycle = c_code
+                    break
+
+        # --- SPECIAL LOGIC FOR GLOBAL CYCLES (PFI, ESO, BATX) ---
+        if matched_cycle in GLOBAL_CYCLES:
+            key = (student, group_name)
+            if key not in global_buffer:
+                global_buffer[key] = {'abs': 0, 'delay': 0, 'cycle': matched_cycle}
+
+            global_buffer[key]['abs'] += abs_hours
+            global_buffer[key]['delay'] += delay_hours
+
+        total_module_hours = 0
+        if matched_cycle:
+            # 2. Look up hours in that cycle's normalized config
+            excel_subj_norm = normalize_text(subject)
+            cycle_map = cycle_normalized_maps.get(matched_cycle, {})
+
+            if excel_subj_norm in cycle_map:
+                total_module_hours = cycle_map[excel_subj_norm]
+            else:
+                # Fuzzy fallback
+                for cfg_name, cfg_hours in cycle_map.items():
+                    if cfg_name in excel_subj_norm or excel_subj_norm in cfg_name:
+                        total_module_hours = cfg_hours
+                        break
+
+        # Prepare data for summary (regardless of warning)
+        pct = 0
+        if total_module_hours > 0:
+            pct = (effective_hours / total_module_hours) * 100
+
+        summary_data.append({
+            "Alumne": student,
+            "Cicle": matched_cycle if matched_cycle else UNKNOWN_CYCLE,
+            "Grup": group_name,
+            "Assignatura": subject,
+            "Hores Totals": total_module_hours,
+            "Hores Faltes": round(abs_hours, 2),
+            "Hores Retards": round(delay_hours, 2),
+            "Hores Efectives": round(effective_hours, 2),
+            "% Assistència": f"{round(pct, 1)}%"
+        })
+
+        # Check Thresholds (SKIP for Global Cycles)
+        if matched_cycle in GLOBAL_CYCLES:
+            continue
+
+        if total_module_hours > 0:
+            warning_type = None
+            if pct >= 25:
+                warning_type = "25%"
+            elif pct >= 15:
+                warning_type = "15%"
+
+            if warning_type:
+                warnings.append({
+                    "Data Avís": processing_date,
+                    "Alumne": student,
+                    "Grup": group_name,
+                    "Assignatura": subject,
+                    "Cicle (Detectat)": matched_cycle,
+                    "Hores Faltes (Reals)": round(abs_hours, 2),
+                    "Hores Retards": round(delay_hours, 2),
+                    "Hores Efectives (F + R/3)": round(effective_hours, 2),
+                    "Hores Totals Mòdul": total_module_hours,
+                    "% Actual": f"{round(pct, 1)}%",
+                    "Tipus Avís": warning_type
+                })
+
+    # --- PROCESS GLOBAL BUFFER (Global Warnings) ---
+    for (student, group_name), stats in global_buffer.items():
+        c_code = stats['cycle']
+        total_cycle_hours = global_total_hours.get(c_code, 0)
+
+        abs_hours = stats['abs']
+        delay_hours = stats['delay']
+        effective_hours = abs_hours + (delay_hours / 3.0)
+
+        pct = 0
+        if total_cycle_hours > 0:
+            pct = (effective_hours / total_cycle_hours) * 100
+
+        # Add GLOBAL line to Summary
+        summary_data.append({
+            "Alumne": student,
+            "Assignatura": GLOBAL_SUBJECT,
+            "Grup": group_name,
+            "Cicle": c_code,
+            "Hores Totals": total_cycle_hours,
+            "Hores Faltes": round(abs_hours, 2),
+            "Hores Retards": round(delay_hours, 2),
+            "Hores Efectives": round(effective_hours, 2),
+            "% Assistència": f"{round(pct, 2)}%"
+        })
+
+        warning_type = None
+        if pct >= 25:
+            warning_type = "25%"
+        elif pct >= 15:
+            warning_type = "15%"
+
+        if warning_type:
+            warnings.append({
+                "Data Avís": processing_date,
+                "Alumne": student,
+                "Grup": group_name,
+                "Assignatura": GLOBAL_SUBJECT,
+                "Cicle (Detectat)": c_code,
+                "Hores Faltes (Reals)": round(abs_hours, 2),
+                "Hores Retards": round(delay_hours, 2),
+                "Hores Efectives (F + R/3)": round(effective_hours, 2),
+                "Hores Totals Mòdul": total_cycle_hours,
+                "% Actual": f"{round(pct, 1)}%",
+                "Tipus Avís": warning_type
+            })
+
+    summary_df = pd.DataFrame(summary_data, columns=SUMMARY_COLUMNS)
+    warnings_df = pd.DataFrame(warnings, columns=WARNING_COLUMNS)
+    return summary_df, warnings_df
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+import engine
+import generate_export
+import legacy_engine
+
+PROCESSING_DATE = "01/10/2026"
+
+
+def synthetic_export(n_rows=8000, seed=7):
+    """
+    A fixed synthetic export, with the odd cells of real ones mixed in.
+
+    Subjects are written without their config code ("IPO II", not "1710. IPO II"):
+    exact config keys resolve differently since the subject index (the old loop took
+    the first substring match), and this test is about the aggregation, not the lookup.
+    """
+    config = engine.load_config()
+    df = generate_export.generate(n_rows, config, seed=seed)
+    df["Assignatura"] = [
+        legacy_engine.normalize_subject_key(s) if s not in generate_export.EXTRA_SUBJECTS else s
+        for s in df["Assignatura"]
+    ]
+    rng = np.random.default_rng(seed)
+    odd = rng.choice(len(df), 40, replace=False)
+    df.loc[odd[:10], "Tipus"] = " F "
+    df.loc[odd[10:20], "Hora"] = "9:00 - 10:30"
+    df.loc[odd[20:25], "Hora"] = "sense hora"
+    df.loc[odd[25:30], "Hora"] = np.nan
+    eb = df.index[df["Grup (incidència)"].str.endswith(" EB")][:20]
+    df.loc[eb, "Assignatura"] = "Mòdul projecte"
+    return config, df
+
+
+def test_analyze_matches_the_per_row_loop():
+    config, df = synthetic_export()
+    summary, warnings, _ = engine.analyze(df.copy(), config, processing_date=PROCESSING_DATE)
+    legacy_summary, legacy_warnings = legacy_engine.analyze(df.copy(), config, processing_date=PROCESSING_DATE)
+
+    assert len(warnings) > 0
+    pd.testing.assert_frame_equal(summary.reset_index(drop=True), legacy_summary)
+    pd.testing.assert_frame_equal(warnings.reset_index(drop=True), legacy_warnings)
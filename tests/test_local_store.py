@@ -0,0 +1,56 @@
+from datetime import datetime, timezone
+
+import history_store
+from local_store import HistorySync, LocalHistoryStore
+
+
+def _doc(student, minute):
+    return {
+        "notified": True, "student": student, "subject": "M01", "group": "1 SMX A",
+        "cycle": "SMX", "pct": "10%", "type": "10%", "last_update": "01/10/2026",
+        history_store.UPDATED_AT_FIELD: datetime(2026, 10, 1, 9, minute, tzinfo=timezone.utc),
+    }
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_full_reload_drops_documents_deleted_remotely(tmp_path, monkeypatch):
+    remote = {"a_M01_10%": _doc("a", 1), "b_M01_10%": _doc("b", 2), "c_M01_10%": _doc("c", 3)}
+    monkeypatch.setattr(history_store, "fetch_all", lambda db: dict(remote))
+    monkeypatch.setattr(history_store, "fetch_changed_since", lambda db, watermark: {})
+
+    store = LocalHistoryStore(str(tmp_path / "history.db"))
+    clock = FakeClock()
+    sync = HistorySync(None, store, full_every=3600, clock=clock)
+    sync.sync_now()
+    assert store.count() == 3
+
+    # Deleted in Firestore, plus a local row not pushed yet
+    del remote["b_M01_10%"]
+    store.put({"d_M01_10%": _doc("d", 4)}, dirty=True)
+    monkeypatch.setattr(sync.queue, "requeue", lambda updates: None)
+
+    # Incremental syncs cannot see deletions
+    sync.sync_now()
+    assert "b_M01_10%" in store.get_many(["b_M01_10%"])
+
+    clock.now += 3601
+    sync.sync_now()
+    assert set(store.get_many(["a_M01_10%", "b_M01_10%", "c_M01_10%", "d_M01_10%"])) == {
+        "a_M01_10%", "c_M01_10%", "d_M01_10%",
+    }
+    store.close()
+
+
+def test_partial_merge_keeps_missing_rows(tmp_path):
+    store = LocalHistoryStore(str(tmp_path / "history.db"))
+    store.merge_remote({"a_M01_10%": _doc("a", 1), "b_M01_10%": _doc("b", 2)}, complete=True)
+    store.merge_remote({"a_M01_10%": _doc("a", 5)})
+    assert store.count() == 2
+    store.close()
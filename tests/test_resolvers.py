@@ -0,0 +1,49 @@
+from resolvers import (
+    MATCH_AMBIGUOUS, MATCH_EXACT, MATCH_FUZZY, MATCH_NORMALIZED, MATCH_TOKENS, UNRESOLVED,
+    SubjectIndex, normalize_text,
+)
+
+CYCLE = {
+    "1709. IPO I": 99,
+    "1710. IPO II": 66,
+    "0237. Infraestructures de xarxes": 198,
+    "MP3060 Comunicació i atenció": 132,
+    "5082. Projecte intermodular": 99,
+}
+
+
+def _linear_scan(index, text):
+    # The fallback as it was before the substring index
+    return [name for name in index.normalized if name in text or text in name]
+
+
+def test_exact_key_wins_over_the_substring_fallback():
+    index = SubjectIndex(CYCLE)
+    # The old lookup normalized first and took the first substring match: "ipo i", 99 h
+    assert _linear_scan(index, normalize_text("1710. IPO II"))[0] == "ipo i"
+    assert index.lookup("1710. IPO II") == (66, MATCH_EXACT, ())
+    assert index.lookup("IPO II") == (66, MATCH_NORMALIZED, ())
+
+
+def test_names_matching_several_subjects_are_ambiguous():
+    index = SubjectIndex(CYCLE)
+    assert index.lookup("IPO") == (99, MATCH_AMBIGUOUS, ("ipo i", "ipo ii"))
+    assert index.lookup("Infraestructures de xarxes (grup B)") == (
+        198, MATCH_FUZZY, ("infraestructures de xarxes",),
+    )
+
+
+def test_same_words_in_another_order():
+    index = SubjectIndex(CYCLE)
+    assert index.lookup("Atenció i comunicació") == (132, MATCH_TOKENS, ("comunicació i atenció",))
+
+
+def test_unknown_subject_is_unresolved():
+    index = SubjectIndex(CYCLE)
+    assert index.lookup("Tutoria") == (0, UNRESOLVED, ())
+
+
+def test_substring_index_matches_the_linear_scan():
+    index = SubjectIndex(CYCLE)
+    for text in ["ipo", "ipo ii", "xarxes", "projecte intermodular i", "de", "i", "tutoria", "x"]:
+        assert index._substring_candidates(text) == _linear_scan(index, text)
@@ -0,0 +1,128 @@
+"""
+Cache of processed uploads.
+
+Streamlit re-executes the whole script on every widget interaction. The parsed and
+aggregated results of an upload are kept here under a hash of the uploaded bytes plus
+the config version, so a rerun only re-slices cached frames instead of re-reading
+and re-aggregating the Excel file.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import profiling
+from engine import analyze, warning_ids
+from incremental import analyze_incremental, export_scope
+from parsed_cache import content_hash, read_exports
+from resolvers import config_version
+
+# Bounds for the process-wide cache (shared by all sessions)
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+MAX_CACHE_ENTRIES = 16
+
+
+def frame_nbytes(*frames):
+    return int(sum(f.memory_usage(deep=True).sum() for f in frames))
+
+
+class ResultCache:
+    """LRU cache bounded by entry count and by approximate memory size."""
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, max_entries=MAX_CACHE_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self._size += nbytes
+            # Evict least recently used entries
+            while self._size > self.max_bytes or len(self._entries) > self.max_entries:
+                _, (_, old_bytes) = self._entries.popitem(last=False)
+                self._size -= old_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def analyze_uploads(uploads, full_config, cache=None, processing_date=None, snapshots=None, parse_cache=None):
+    """
+    Parses and analyzes exports given as [(file name, bytes)], merged into one.
+
+    Returns (summary_df, warnings_df, report) like engine.analyze, reusing the cached
+    result when the same files were already processed with the same config and date.
+    With a SnapshotStore, new uploads are diffed against the previous export of the same
+    groups (incremental.analyze_incremental) and become the snapshot for the next one;
+    report then adds 'new_warnings', computed outside the cache from the store because
+    it depends on what was processed before.
+    The files are parsed in parallel (parsed_cache.read_exports), skipping the ones in
+    parse_cache; report adds 'files' and 'duplicate_rows' (rows present in more than
+    one export, counted once).
+    """
+    if processing_date is None:
+        processing_date = datetime.now().strftime("%d/%m/%Y")
+    source = tuple(content_hash(data) for _, data in uploads)
+    key = (source, config_version(full_config), processing_date)
+
+    result = cache.get(key) if cache is not None else None
+    if result is not None:
+        profiling.count("result_cache_hits")
+    else:
+        result = _analyze(uploads, full_config, processing_date, source, snapshots, parse_cache)
+        if cache is not None:
+            cache.put(key, result, frame_nbytes(result[0], result[1]))
+
+    summary_df, warnings_df, report, scope = result
+    if snapshots is not None:
+        new_warnings = snapshots.new_warnings(scope, source, warning_ids(warnings_df))
+        report = {**report, "new_warnings": new_warnings}
+    return summary_df, warnings_df, report
+
+
+def _analyze(uploads, full_config, processing_date, source, snapshots, parse_cache):
+    # (summary_df, warnings_df, report, scope); scope is None without snapshots
+    with profiling.stage("parse") as stage:
+        df, duplicate_rows = read_exports(uploads, cache=parse_cache)
+        stage.rows = len(df)
+    scope = None
+    if snapshots is None:
+        summary_df, warnings_df, report = analyze(df, full_config, processing_date=processing_date)
+    else:
+        scope = export_scope(df)
+        summary_df, warnings_df, report, snapshot = analyze_incremental(
+            df, full_config, snapshots.latest(scope), processing_date
+        )
+        # Relative to whichever snapshot was used; analyze_uploads recomputes it per call
+        del report["new_warnings"]
+        with profiling.stage("save_snapshot"):
+            snapshots.save(scope, source, snapshot)
+    report.update(files=len(uploads), duplicate_rows=duplicate_rows)
+    return summary_df, warnings_df, report, scope